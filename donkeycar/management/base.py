@@ -7,6 +7,7 @@ import sys
 from socket import *
 import logging
 
+import numpy as np
 from progress.bar import IncrementalBar
 import donkeycar as dk
 from donkeycar.management.joystick_creator import CreateJoystick
@@ -273,6 +274,47 @@ class MakeMovieShell(BaseCommand):
         mm.run(args, parser)
 
 
+class TubCompact(BaseCommand):
+    '''
+    Physically removes deleted records and their images from tubs.
+    '''
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tubcompact',
+                                         usage='%(prog)s [options]')
+        parser.add_argument('--tub', nargs='+', help='The tubs to compact')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only report what would be removed')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    @staticmethod
+    def format_bytes(num_bytes):
+        for unit in ('B', 'kB', 'MB', 'GB'):
+            if num_bytes < 1024 or unit == 'GB':
+                return f'{num_bytes:.1f} {unit}'
+            num_bytes /= 1024
+
+    def run(self, args):
+        from donkeycar.parts.tub_v2 import compact_tub
+
+        args = self.parse_args(args)
+        for tub_path in args.tub:
+            report = compact_tub(os.path.expanduser(tub_path),
+                                 dry_run=args.dry_run)
+            verb = 'would be' if args.dry_run else 'were'
+            print(f'Tub {tub_path}:')
+            print(f'  records:  {report["records"]} -> '
+                  f'{report["kept_records"]}, '
+                  f'{report["records"] - report["kept_records"]} {verb} '
+                  f'removed')
+            print(f'  catalogs: '
+                  f'{self.format_bytes(report["catalog_bytes"])} -> '
+                  f'{self.format_bytes(report["kept_catalog_bytes"])}')
+            print(f'  images:   '
+                  f'{self.format_bytes(report["image_bytes"])} -> '
+                  f'{self.format_bytes(report["kept_image_bytes"])}')
+
+
 class ShowCnnActivations(BaseCommand):
 
     def __init__(self):
@@ -372,19 +414,24 @@ class ShowPredictionPlots(BaseCommand):
                              seq_size=model.seq_size())
         records = dataset.get_records()[:limit]
         bar = IncrementalBar('Inferencing', max=len(records))
-
-        for tub_record in records:
-            inputs = model.x_transform_and_process(
-                tub_record, lambda x: normalize_image(x))
-            input_dict = model.x_translate(inputs)
-            pilot_angle, pilot_throttle = \
-                model.inference_from_dict(input_dict)
-            user_angle, user_throttle = model.y_transform(tub_record)
-            user_angles.append(user_angle)
-            user_throttles.append(user_throttle)
-            pilot_angles.append(pilot_angle)
-            pilot_throttles.append(pilot_throttle)
-            bar.next()
+        batch_size = cfg.BATCH_SIZE
+
+        # the model is called once per batch
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            inputs = [model.x_translate(model.x_transform_and_process(
+                tub_record, lambda x: normalize_image(x, model.image_dtype)))
+                for tub_record in batch]
+            input_dict = {k: np.stack([x[k] for x in inputs])
+                          for k in inputs[0]}
+            angles, throttles = model.inference_batch(input_dict)[:2]
+            for tub_record in batch:
+                user_angle, user_throttle = model.y_transform(tub_record)
+                user_angles.append(user_angle)
+                user_throttles.append(user_throttle)
+            pilot_angles.extend(angles)
+            pilot_throttles.extend(throttles)
+            bar.next(len(batch))
 
         angles_df = pd.DataFrame({'user_angle': user_angles,
                                   'pilot_angle': pilot_angles})
@@ -430,7 +477,10 @@ class Train(BaseCommand):
         parser = argparse.ArgumentParser(prog='train', usage='%(prog)s [options]')
         parser.add_argument('--tub', nargs='+', help='tub data for training')
         parser.add_argument('--model', default=None, help='output model name')
-        parser.add_argument('--type', default=None, help='model type')
+        parser.add_argument('--type', default=None,
+                            help='model type, several comma separated types '
+                                 'are trained together in one pass over '
+                                 'the data')
         parser.add_argument('--config', default='./config.py', help=HELP_CONFIG)
         parser.add_argument('--framework',
                             choices=['tensorflow', 'pytorch', None],
@@ -443,6 +493,9 @@ class Train(BaseCommand):
                             help='comment added to model database - use '
                                  'double quotes for multiple words')
         parsed_args = parser.parse_args(args)
+        if parsed_args.transfer and parsed_args.type \
+                and ',' in parsed_args.type:
+            parser.error('--transfer needs a single model --type')
         return parsed_args
 
     def run(self, args):
@@ -452,7 +505,11 @@ class Train(BaseCommand):
         framework = args.framework if args.framework \
             else getattr(cfg, 'DEFAULT_AI_FRAMEWORK', 'tensorflow')
 
-        if framework == 'tensorflow':
+        model_types = args.type.split(',') if args.type else []
+        if framework == 'tensorflow' and len(model_types) > 1:
+            from donkeycar.pipeline.training import train_models
+            train_models(cfg, args.tub, model_types, args.model, args.comment)
+        elif framework == 'tensorflow':
             from donkeycar.pipeline.training import train
             train(cfg, args.tub, args.model, args.type, args.transfer,
                   args.comment)
@@ -465,6 +522,101 @@ class Train(BaseCommand):
                   f"'tensorflow' or 'pytorch'")
 
 
+class BenchmarkPipeline(BaseCommand):
+    '''
+    Measures the throughput of the training pipeline and the time spent in
+    each of its stages.
+    '''
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='benchmark-pipeline',
+                                         usage='%(prog)s [options]')
+        parser.add_argument('--tub', nargs='+', help='tub data for training')
+        parser.add_argument('--type', default=None, help='model type')
+        parser.add_argument('--config', default='./config.py', help=HELP_CONFIG)
+        parser.add_argument('--pipeline', default=None,
+                            choices=['generator', 'native', 'stream'],
+                            help='training pipeline, defaults to '
+                                 'config.TRAIN_DATA_PIPELINE')
+        parser.add_argument('--batches', type=int, default=50,
+                            help='number of timed batches')
+        parser.add_argument('--warmup', type=int, default=2,
+                            help='number of batches before the timing starts')
+        parser.add_argument('--no-model-step', action='store_true',
+                            help='only time the input pipeline')
+        parser.add_argument('--json', default=None,
+                            help='file to write the report to')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        import json
+        from donkeycar.pipeline.profiler import format_report
+        from donkeycar.pipeline.training import benchmark
+
+        args = self.parse_args(args)
+        cfg = load_config(args.config)
+        if cfg is None:
+            return
+        if args.pipeline:
+            cfg.TRAIN_DATA_PIPELINE = args.pipeline
+        report = benchmark(cfg, ','.join(args.tub), args.type, args.batches,
+                           args.warmup, not args.no_model_step)
+        print(f'Pipeline {report["pipeline"]["pipeline"]}, '
+              f'model {report["pipeline"]["model_type"]}:')
+        print(format_report(report['pipeline']))
+        print('Image loading without cache:')
+        print(format_report(report['image_loading']))
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump(report, file, indent=2)
+
+
+class BenchmarkPilot(BaseCommand):
+    '''
+    Measures the single frame inference latency of a model under every
+    interpreter it is available for.
+    '''
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='benchmark-pilot',
+                                         usage='%(prog)s [options]')
+        parser.add_argument('--model', required=True,
+                            help='model to benchmark, the .h5, .savedmodel, '
+                                 '.tflite, .onnx and .trt files with the same '
+                                 'name are benchmarked as well')
+        parser.add_argument('--type', default=None, help='model type')
+        parser.add_argument('--config', default='./config.py', help=HELP_CONFIG)
+        parser.add_argument('--tub', nargs='+', default=None,
+                            help='tubs whose records are the inputs, random '
+                                 'inputs are used without tubs')
+        parser.add_argument('--frames', type=int, default=500,
+                            help='number of timed frames')
+        parser.add_argument('--warmup', type=int, default=20,
+                            help='number of frames before the timing starts')
+        parser.add_argument('--threads', type=int, nargs='+', default=None,
+                            help='thread counts of the tflite interpreter, '
+                                 'defaults to one and all cores')
+        parser.add_argument('--json', default=None,
+                            help='file to write the report to')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        import json
+        from donkeycar.parts.pilot_benchmark import benchmark_pilot, \
+            format_report
+
+        args = self.parse_args(args)
+        cfg = load_config(args.config)
+        if cfg is None:
+            return
+        report = benchmark_pilot(cfg, args.model, args.type, args.tub,
+                                 args.frames, args.warmup, args.threads)
+        print(format_report(report))
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump(report, file, indent=2)
+
+
 class Gui(BaseCommand):
     def run(self, args):
         from donkeycar.management.kivy_ui import main
@@ -480,12 +632,15 @@ def execute_from_command_line():
         'findcar': FindCar,
         'calibrate': CalibrateCar,
         'tubclean': TubManager,
+        'tubcompact': TubCompact,
         'tubplot': ShowPredictionPlots,
         'makemovie': MakeMovieShell,
         'createjs': CreateJoystick,
         'cnnactivations': ShowCnnActivations,
         'update': UpdateCar,
         'train': Train,
+        'benchmark-pipeline': BenchmarkPipeline,
+        'benchmark-pilot': BenchmarkPilot,
         'ui': Gui,
     }
     
@@ -34,7 +34,7 @@ from kivy.uix.spinner import SpinnerOption, Spinner
 
 from donkeycar import load_config
 from donkeycar.parts.keras import KerasMemory
-from donkeycar.parts.tub_v2 import Tub
+from donkeycar.parts.tub_v2 import Tub, ColumnCache
 from donkeycar.pipeline.augmentations import ImageAugmentation
 from donkeycar.pipeline.database import PilotDatabase
 from donkeycar.pipeline.types import TubRecord
@@ -272,7 +272,8 @@ class TubLoader(BoxLayout, FileChooserBase):
                     return True
 
         self.records = [TubRecord(cfg, self.tub.base_path, record)
-                        for record in self.tub if select(record)]
+                        for record in self.tub.load_records()
+                        if select(record)]
         self.len = len(self.records)
         if self.len > 0:
             tub_screen().index = 0
@@ -617,8 +618,15 @@ class DataPlot(PaddedBoxLayout):
         """ Called from TubManager when a tub is reloaded/recreated. Fills
             the DataFrame from records, and updates the dropdown menu in the
             data panel."""
-        generator = (t.underlying for t in tub_screen().ids.tub_loader.records)
-        self.df = pd.DataFrame(generator).dropna()
+        tub_loader = tub_screen().ids.tub_loader
+        # Vectors go into the DataFrame as lists, see unravel_vectors()
+        columns = {k: ColumnCache.to_list(v) if v.ndim > 1 else v
+                   for k, v in tub_loader.tub.columns().items()}
+        self.df = pd.DataFrame(columns)
+        indexes = [t.underlying['_index'] for t in tub_loader.records]
+        # Inputs which were never recorded don't show up as columns
+        self.df = self.df[self.df['_index'].isin(indexes)] \
+            .dropna(axis=1, how='all').dropna()
         to_drop = {'cam/image_array'}
         self.df.drop(labels=to_drop, axis=1, errors='ignore', inplace=True)
         self.df.set_index('_index', inplace=True)
@@ -670,7 +678,7 @@ class PilotLoader(BoxLayout, FileChooserBase):
     num = StringProperty()
     model_type = StringProperty()
     pilot = ObjectProperty(None)
-    filters = ['*.h5', '*.tflite', '*.savedmodel', '*.trt']
+    filters = ['*.h5', '*.tflite', '*.savedmodel', '*.trt', '*.onnx']
 
     def load_action(self):
         if self.file_path and self.pilot:
@@ -696,6 +704,8 @@ class PilotLoader(BoxLayout, FileChooserBase):
                     self.filters = ['*.tflite']
                 elif 'tensorrt' in self.model_type:
                     self.filters = ['*.trt']
+                elif 'onnx' in self.model_type:
+                    self.filters = ['*.onnx']
                 else:
                     self.filters = ['*.h5', '*.savedmodel']
 
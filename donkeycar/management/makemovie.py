@@ -15,6 +15,8 @@ from donkeycar.utils import *
 
 
 DEG_TO_RAD = math.pi / 180.0
+# number of frames the model predicts in one call
+PREDICTION_BATCH = 64
 
 
 class MakeMovie(object):
@@ -60,11 +62,10 @@ class MakeMovie(object):
         num_frames = self.end_index - start
 
         # Move to the correct offset
-        self.current = 0
-        self.iterator = self.tub.__iter__()
-        while self.current < start:
-            self.iterator.next()
-            self.current += 1
+        self.current = start
+        self.iterator = self.tub.iter_from(start)
+        # frames read ahead with their predictions
+        self.frames = []
 
         self.scale = args.scale
         self.keras_part = None
@@ -105,14 +106,11 @@ class MakeMovie(object):
         green = (0, 255, 0)
         self.draw_line_into_image(user_angle, user_throttle, False, img_drawon, green)
 
-    def draw_model_prediction(self, img, img_drawon):
+    def model_input(self, img):
         """
-        query the model for it's prediction, draw the predictions
-        as a blue line on the image
+        converts the image to the input of the model, or returns None if
+        it doesn't fit
         """
-        if self.keras_part is None:
-            return
-
         expected = tuple(self.keras_part.get_input_shapes()[0][1:])
         actual = img.shape
 
@@ -126,10 +124,51 @@ class MakeMovie(object):
         if expected != actual:
             print(f"expected input dim {expected} didn't match actual dim "
                   f"{actual}")
+            return None
+        return img
+
+    def predict(self, images):
+        """
+        predicts angle and throttle of the images in one batch if the model
+        only takes images, otherwise one by one
+        """
+        inputs = [self.model_input(img) for img in images]
+        if any(img is None for img in inputs):
+            return [None] * len(images)
+        if len(self.keras_part.get_input_shapes()) > 1:
+            return [self.keras_part.run(img) for img in inputs]
+        xs = [self.keras_part.x_translate(
+            normalize_image(img, self.keras_part.image_dtype))
+            for img in inputs]
+        batch = {k: np.stack([x[k] for x in xs]) for k in xs[0]}
+        angles, throttles = self.keras_part.inference_batch(batch)[:2]
+        return list(zip(angles, throttles))
+
+    def next_frame(self):
+        """
+        returns the next record, its image and the prediction. The frames
+        are read ahead, so the model predicts them in batches.
+        """
+        if not self.frames:
+            count = min(PREDICTION_BATCH, self.end_index - self.current)
+            records = [self.iterator.next() for _ in range(count)]
+            images = [img_to_arr(Image.open(
+                self.tub.image_file(rec['cam/image_array'])))
+                for rec in records]
+            predictions = self.predict(images) \
+                if self.keras_part is not None else [None] * count
+            self.frames = list(zip(records, images, predictions))[::-1]
+        return self.frames.pop()
+
+    def draw_model_prediction(self, prediction, img_drawon):
+        """
+        draw the predictions of the model as a blue line on the image
+        """
+        if self.keras_part is None or prediction is None:
             return
 
         blue = (0, 0, 255)
-        pilot_angle, pilot_throttle = self.keras_part.run(img)
+        pilot_angle, pilot_throttle = prediction
         self.draw_line_into_image(pilot_angle, pilot_throttle, True, img_drawon, blue)
 
     def draw_steering_distribution(self, img, img_drawon):
@@ -241,9 +280,7 @@ class MakeMovie(object):
         if self.current >= self.end_index:
             return None
 
-        rec = self.iterator.next()
-        img_path = os.path.join(self.tub.images_base_path, rec['cam/image_array'])
-        image_input = img_to_arr(Image.open(img_path))
+        rec, image_input, prediction = self.next_frame()
         image = image_input
         
         if self.do_salient:
@@ -252,7 +289,7 @@ class MakeMovie(object):
         
         if self.user: self.draw_user_input(rec, image_input, image)
         if self.keras_part is not None:
-            self.draw_model_prediction(image_input, image)
+            self.draw_model_prediction(prediction, image)
             self.draw_steering_distribution(image_input, image)
 
         if self.scale != 1:
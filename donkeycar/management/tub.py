@@ -13,7 +13,7 @@ from stat import S_ISREG, ST_ATIME, ST_CTIME, ST_MODE, ST_MTIME
 
 import tornado.web
 
-from donkeycar.parts.tub_v2 import Tub
+from donkeycar.parts.tub_v2 import PackedImages, Tub, read_image_bytes
 
 
 class TubManager:
@@ -37,6 +37,7 @@ class WebServer(tornado.web.Application):
             (r"/tubs/?(?P<tub_id>[^/]+)?", TubView),
             (r"/api/tubs/?(?P<tub_id>[^/]+)?", TubApi, dict(data_path=data_path)),
             (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": static_file_path}),
+            (r"/tub_data/(?P<tub_id>[^/]+)/images/(?P<name>[^/]+)", TubImage, dict(data_path=data_path)),
             (r"/tub_data/(.*)", tornado.web.StaticFileHandler, {"path": data_path}),
             ]
 
@@ -71,6 +72,33 @@ class TubView(tornado.web.RequestHandler):
         self.render("tub_web/tub.html", **data)
 
 
+class TubImage(tornado.web.RequestHandler):
+    ''' Serves the images of tubs, no matter if they are files or packed. '''
+
+    def initialize(self, data_path):
+        path = Path(os.path.expanduser(data_path))
+        self.data_path = path.absolute()
+
+    def get(self, tub_id, name):
+        # tornado decodes the path arguments, so they can contain separators
+        for part in (tub_id, name):
+            if '/' in part or '\\' in part or os.sep in part or '..' in part:
+                raise tornado.web.HTTPError(404)
+        base_path = os.path.join(self.data_path, tub_id)
+        images_path = os.path.realpath(os.path.join(base_path, Tub.images()))
+        packed = PackedImages.parse_reference(name)
+        file_name = packed[0] if packed else name
+        path = os.path.realpath(os.path.join(images_path, file_name))
+        if os.path.dirname(path) != images_path:
+            raise tornado.web.HTTPError(404)
+        try:
+            data = read_image_bytes(base_path, name)
+        except (OSError, IndexError):
+            raise tornado.web.HTTPError(404)
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(data)
+
+
 class TubApi(tornado.web.RequestHandler):
 
     def initialize(self, data_path):
@@ -1,73 +1,237 @@
+import io
 import json
+import logging
 import mmap
 import os
+import struct
+import threading
 import time
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
 from pathlib import Path
 
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
 
 NEWLINE = '\n'
 NEWLINE_STRIP = '\r\n'
 
 
+class LineIndex(object):
+    """
+    An index of line end offsets for a Seekable. \n
+    Entry ``i`` holds the offset at which line ``i + 1`` ends. When a path is
+    given, the index is persisted as fixed-width little-endian unsigned 64 bit
+    integers in an append-only file. Adding a line is then a single 8 byte
+    write and opening the index only requires the size of the file. Read-only
+    indexes are memory mapped.
+    """
+
+    ENTRY = struct.Struct('<Q')
+    ENTRY_DTYPE = np.dtype('<u8')
+
+    def __init__(self, path=None, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.offsets = None
+        self.file = None
+        self.mmap = None
+        self.length = 0
+        if path is None:
+            self.offsets = array('Q')
+        else:
+            self.file = open(path, 'rb' if read_only else 'a+b')
+            size = os.fstat(self.file.fileno()).st_size
+            # A partially written trailing entry is ignored
+            self.length = size // self.ENTRY.size
+            if read_only:
+                if self.length > 0:
+                    self.mmap = mmap.mmap(self.file.fileno(), length=0,
+                                          access=mmap.ACCESS_READ)
+            elif size % self.ENTRY.size != 0:
+                self.file.truncate(self.length * self.ENTRY.size)
+
+    def __len__(self):
+        return len(self.offsets) if self.offsets is not None else self.length
+
+    def __getitem__(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError(f'LineIndex index {index} out of range')
+        if self.offsets is not None:
+            return self.offsets[index]
+        position = index * self.ENTRY.size
+        if self.mmap is not None:
+            return self.ENTRY.unpack_from(self.mmap, position)[0]
+        self.file.seek(position)
+        return self.ENTRY.unpack(self.file.read(self.ENTRY.size))[0]
+
+    def end_offset(self):
+        return self[-1] if len(self) > 0 else 0
+
+    def append(self, offset):
+        self.extend([offset])
+
+    def extend(self, offsets):
+        if self.read_only:
+            raise RuntimeError(f'LineIndex {self.path} is read-only.')
+        if isinstance(offsets, np.ndarray):
+            entries = offsets.astype(np.uint64, copy=False)
+        else:
+            entries = np.fromiter(offsets, dtype=np.uint64)
+        if self.offsets is not None:
+            self.offsets.frombytes(entries.tobytes())
+        else:
+            self.file.write(entries.astype(self.ENTRY_DTYPE).tobytes())
+            self.file.flush()
+            self.length += len(entries)
+
+    def to_array(self):
+        """
+        :return: all offsets as numpy array
+        """
+        if self.offsets is not None:
+            return np.array(self.offsets, dtype=np.uint64)
+        size = self.length * self.ENTRY.size
+        if self.mmap is not None:
+            contents = self.mmap[:size]
+        else:
+            self.file.seek(0)
+            contents = self.file.read(size)
+        return np.frombuffer(contents, dtype=self.ENTRY_DTYPE) \
+            .astype(np.uint64)
+
+    def sync(self):
+        if self.file is not None and not self.read_only:
+            os.fsync(self.file.fileno())
+
+    def truncate(self, length):
+        if self.read_only:
+            raise RuntimeError(f'LineIndex {self.path} is read-only.')
+        if self.offsets is not None:
+            del self.offsets[length:]
+        else:
+            self.length = min(length, self.length)
+            self.file.truncate(self.length * self.ENTRY.size)
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        if self.file is not None:
+            self.file.close()
+
+
 class Seekable(object):
     """
     A seekable file reader, writer which deals with newline delimited
     records. \n
-    This reader maintains an index of line lengths, so seeking a line is a
-    O(1) operation.
+    This reader maintains an index of line end offsets, so seeking a line is
+    a O(1) operation. The index is kept in memory unless a persistent
+    LineIndex is passed in. Missing indexes are rebuilt by scanning the
+    memory mapped file for newlines in bulk.
     """
+    SCAN_CHUNK_SIZE = 1 << 26
 
-    def __init__(self, file, read_only=False, line_lengths=list()):
-        self.line_lengths = list()
-        self.cumulative_lengths = list()
+    def __init__(self, file, read_only=False, line_lengths=list(),
+                 index=None):
+        self.index = index if index is not None else LineIndex()
+        self.path = file
         self.method = 'r' if read_only else 'a+'
         self.file = open(file, self.method, newline=NEWLINE)
         # If file is read only improve performance by memory mapping the file.
         if self.method == 'r':
-            self.file = mmap.mmap(self.file.fileno(), length=0,
-                                  access=mmap.ACCESS_READ)
+            file = self.file
+            # empty files can't be memory mapped
+            self.file = mmap.mmap(file.fileno(), length=0,
+                                  access=mmap.ACCESS_READ) \
+                if os.fstat(file.fileno()).st_size > 0 else io.BytesIO()
+            file.close()
         self.total_length = 0
-        if len(line_lengths) <= 0:
+        if len(self.index) > 0:
+            self.total_length = self.index.end_offset()
+        elif len(line_lengths) > 0:
+            self.index.extend(np.cumsum(line_lengths, dtype=np.uint64))
+            self.total_length = self.index.end_offset()
+        elif os.path.getsize(self.path) > 0:
             self._read_contents()
-        else:
-            self.line_lengths.extend(line_lengths)
-            for line_length in self.line_lengths:
-                self.total_length += line_length
-                self.cumulative_lengths.append(self.total_length)
+
+    @property
+    def line_lengths(self):
+        return np.diff(self.cumulative_lengths, prepend=np.uint64(0))
+
+    @property
+    def cumulative_lengths(self):
+        return self.index.to_array()
 
     def _read_contents(self):
-        self.line_lengths.clear()
-        self.cumulative_lengths.clear()
-        self.total_length = 0
-        self.file.seek(0)
-        contents = self.file.readline()
-        while len(contents) > 0:
-            line_length = len(contents)
-            self.line_lengths.append(line_length)
-            self.total_length += line_length
-            self.cumulative_lengths.append(self.total_length)
-            contents = self.file.readline()
+        self.index.truncate(0)
+        self.index.extend(self._scan_line_ends())
+        self.total_length = self.index.end_offset()
         self.seek_end_of_file()
 
+    def _scan_line_ends(self):
+        size = os.path.getsize(self.path)
+        if size == 0:
+            return np.empty(0, dtype=np.uint64)
+        newline = ord(NEWLINE)
+        ends = list()
+        with open(self.path, 'rb') as file, \
+                mmap.mmap(file.fileno(), length=0,
+                          access=mmap.ACCESS_READ) as contents:
+            # Chunks bound the memory of the temporary comparison array
+            for start in range(0, size, self.SCAN_CHUNK_SIZE):
+                chunk = np.frombuffer(contents, dtype=np.uint8,
+                                      count=min(self.SCAN_CHUNK_SIZE,
+                                                size - start),
+                                      offset=start)
+                ends.append(np.flatnonzero(chunk == newline) + start + 1)
+                # Release the buffer, the mmap can't close while it's in use
+                del chunk
+        ends = np.concatenate(ends).astype(np.uint64)
+        # Like readline(), count a last line without newline
+        if len(ends) == 0 or ends[-1] != size:
+            ends = np.append(ends, np.uint64(size))
+        return ends
+
     def __enter__(self):
         return self
 
     def writeline(self, contents):
+        self.writelines([contents])
+
+    def writelines(self, lines):
+        """ Appends a group of lines with a single flush. """
         if self.method == 'r':
             raise RuntimeError(f'Seekable {self.file} is read-only.')
 
-        has_newline = contents[-1] == NEWLINE
-        if has_newline:
-            line = contents
-        else:
-            line = f'{contents}{NEWLINE}'
+        offsets = list()
+        for contents in lines:
+            has_newline = contents[-1] == NEWLINE
+            if has_newline:
+                line = contents
+            else:
+                line = f'{contents}{NEWLINE}'
+
+            self.total_length += len(line)
+            offsets.append(self.total_length)
+            self.file.write(line)
+        self.file.flush()
+        # The index is only extended once the lines are on disk, so a
+        # persistent index never points past the end of the file.
+        self.index.extend(offsets)
 
-        offset = len(line)
-        self.total_length += offset
-        self.line_lengths.append(offset)
-        self.cumulative_lengths.append(self.total_length)
-        self.file.write(line)
+    def sync(self):
+        """ Forces written lines and their index onto the storage device. """
+        if self.method == 'r':
+            return
         self.file.flush()
+        os.fsync(self.file.fileno())
+        self.index.sync()
 
     def _line_start_offset(self, line_number):
         return self._offset_until(line_number - 1)
@@ -77,8 +241,8 @@ class Seekable(object):
 
     def _offset_until(self, line_index):
         end_index = line_index - 1
-        return self.cumulative_lengths[end_index] \
-            if 0 <= end_index < len(self.cumulative_lengths) else 0
+        return self.index[end_index] \
+            if 0 <= end_index < len(self.index) else 0
 
     def readline(self):
         contents = self.file.readline()
@@ -94,10 +258,8 @@ class Seekable(object):
         self.file.seek(self.total_length)
 
     def truncate_until_end(self, line_number):
-        self.line_lengths = self.line_lengths[:line_number]
-        self.cumulative_lengths = self.cumulative_lengths[:line_number]
-        self.total_length = self.cumulative_lengths[-1] \
-            if len(self.cumulative_lengths) > 0 else 0
+        self.index.truncate(line_number)
+        self.total_length = self.index.end_offset()
         self.seek_end_of_file()
         self.file.truncate()
     
@@ -123,13 +285,14 @@ class Seekable(object):
                 self.writeline(line)
 
     def lines(self):
-        return len(self.line_lengths)
+        return len(self.index)
 
     def has_content(self):
         return self.lines() > 0
 
     def close(self):
         self.file.close()
+        self.index.close()
 
     def __exit__(self, type, value, traceback):
         self.close()
@@ -142,28 +305,96 @@ class Catalog(object):
     [ json object record ] \n
     [ json object record ] \n
     ...
+
+    The line offsets are kept in an append-only LineIndex next to the
+    catalog, so writing a record and opening a catalog are O(1). The
+    CatalogMetadata is only opened when it is first accessed, unless a new
+    catalog is created.
     '''
     def __init__(self, path, read_only=False, start_index=0):
         self.path = Path(os.path.expanduser(path))
-        self.manifest = CatalogMetadata(self.path,
-                                        read_only=read_only,
-                                        start_index=start_index)
+        self.read_only = read_only
+        self.start_index = start_index
+        self._manifest = None
+        if not read_only and not CatalogMetadata.path_of(self.path).exists():
+            # Create the metadata of a new catalog right away
+            self._manifest = self.manifest
+        self.index = self._open_index(read_only)
         self.seekable = Seekable(self.path.as_posix(),
-                                 line_lengths=self.manifest.line_lengths(),
-                                 read_only=read_only)
+                                 read_only=read_only,
+                                 index=self.index)
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = CatalogMetadata(self.path,
+                                             read_only=self.read_only,
+                                             start_index=self.start_index)
+        return self._manifest
+
+    def _open_index(self, read_only):
+        index_path = CatalogMetadata.index_path_of(self.path)
+        catalog_size = os.path.getsize(self.path) if self.path.exists() else 0
+        if index_path.exists():
+            index = LineIndex(index_path, read_only=read_only)
+            if index.end_offset() == catalog_size:
+                return index
+            # The index is stale, i.e. the catalog was changed without it,
+            # or a writer has flushed records but not yet indexed them.
+            # An empty index lets the Seekable rebuild it from the catalog.
+            logger.warning(f'Rebuilding stale catalog index {index_path}')
+            index.close()
+            if read_only:
+                return LineIndex()
+            self._rebuild_index(index_path)
+            return LineIndex(index_path)
+
+        # Catalogs written before the LineIndex existed store their line
+        # lengths in the catalog manifest.
+        index = LineIndex() if read_only else LineIndex(index_path)
+        offsets = list(accumulate(self.manifest.line_lengths()))
+        if offsets and offsets[-1] == catalog_size:
+            index.extend(offsets)
+        if not read_only and offsets:
+            # Catalog has been migrated to the LineIndex
+            self.manifest.drop_line_lengths()
+        return index
+
+    def _rebuild_index(self, index_path):
+        """
+        Writes a new index of the catalog and moves it over the stale one.
+        A writer may still append to the stale index, so it is replaced
+        rather than truncated in place. The entries of that writer then go
+        to the replaced file and the next opener rebuilds the index again.
+        """
+        temp_path = index_path.with_name(
+            f'{index_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        index = LineIndex(temp_path)
+        index.truncate(0)
+        seekable = Seekable(self.path.as_posix(), read_only=True)
+        index.extend(seekable.cumulative_lengths)
+        seekable.close()
+        index.close()
+        os.replace(temp_path, index_path)
 
     def _exit_handler(self):
         self.close()
 
     def write_record(self, record):
-        # Add record and update manifest
-        contents = json.dumps(record, allow_nan=False, sort_keys=True)
-        self.seekable.writeline(contents)
-        line_lengths = self.seekable.line_lengths
-        self.manifest.update_line_lengths(line_lengths)
+        self.write_records([record])
+
+    def write_records(self, records):
+        # Add records, the seekable appends their offsets to the index
+        lines = [json.dumps(record, allow_nan=False, sort_keys=True)
+                 for record in records]
+        self.seekable.writelines(lines)
+
+    def sync(self):
+        self.seekable.sync()
 
     def close(self):
-        self.manifest.close()
+        if self._manifest is not None:
+            self._manifest.close()
         self.seekable.close()
 
 
@@ -172,10 +403,8 @@ class CatalogMetadata(object):
     Manifest for a Catalog
     '''
     def __init__(self, catalog_path, read_only=False, start_index=0):
-        path = Path(catalog_path)
-        manifest_name = f'{path.stem}.catalog_manifest'
-        self.manifest_path = Path(os.path.join(path.parent.as_posix(),
-                                               manifest_name))
+        self.manifest_path = CatalogMetadata.path_of(catalog_path)
+        self.index_path = CatalogMetadata.index_path_of(catalog_path)
         self.seekeable = Seekable(self.manifest_path, read_only=read_only)
         has_contents = False
         if os.path.exists(self.manifest_path) and self.seekeable.has_content():
@@ -192,15 +421,16 @@ class CatalogMetadata(object):
             created_at = time.time()
             self.contents['created_at'] = created_at
             self.contents['start_index'] = start_index
-            self.contents['line_lengths'] = list()
             self._update()
 
-    def update_line_lengths(self, new_lengths):
-        self.contents['line_lengths'] = new_lengths
-        self._update()
-
     def line_lengths(self):
-        return self.contents['line_lengths']
+        """ Line lengths of catalogs which have not been migrated to a
+            LineIndex yet. """
+        return self.contents.get('line_lengths', [])
+
+    def drop_line_lengths(self):
+        self.contents.pop('line_lengths', None)
+        self._update()
 
     def start_index(self):
         return self.contents['start_index']
@@ -213,6 +443,193 @@ class CatalogMetadata(object):
     def close(self):
         self.seekeable.close()
 
+    @staticmethod
+    def path_of(catalog_path):
+        path = Path(catalog_path)
+        return path.parent / f'{path.stem}.catalog_manifest'
+
+    @staticmethod
+    def index_path_of(catalog_path):
+        path = Path(catalog_path)
+        return path.parent / f'{path.stem}.catalog_index'
+
+
+class DeletedIndexes(object):
+    """
+    The set of deleted record indexes, kept as sorted runs of consecutive
+    indexes, i.e. run k covers the indexes in [starts[k], ends[k]). \n
+    Membership, next alive and last alive queries are O(log n) in the number
+    of runs. Changes are appended to a log of fixed-width entries, which is
+    folded into the manifest whenever the catalog metadata is written.
+    """
+
+    ENTRY = struct.Struct('<BQQ')
+    DELETE = 1
+    RESTORE = 0
+
+    def __init__(self, runs=()):
+        self.starts = list()
+        self.ends = list()
+        self.length = 0
+        self.log = None
+        self.pending = 0
+        for start, end in runs:
+            self._add_run(start, end)
+
+    @classmethod
+    def from_metadata(cls, catalog_metadata):
+        if 'deleted_runs' in catalog_metadata:
+            return cls(catalog_metadata['deleted_runs'])
+        # Manifests written before the runs existed list every index
+        deleted = cls()
+        deleted.update(catalog_metadata.get('deleted_indexes', []))
+        return deleted
+
+    def open_log(self, path, read_only=False):
+        """ Replays the changes in the log and appends new ones to it. """
+        if read_only and not os.path.exists(path):
+            return
+        log = open(path, 'rb' if read_only else 'a+b')
+        log.seek(0)
+        contents = log.read()
+        # A partially written trailing entry is ignored
+        length = len(contents) // self.ENTRY.size
+        for op, start, end in self.ENTRY.iter_unpack(
+                contents[:length * self.ENTRY.size]):
+            if op == self.DELETE:
+                self._add_run(start, end)
+            else:
+                self._remove_run(start, end)
+        self.pending = length
+        if read_only:
+            log.close()
+        else:
+            log.truncate(length * self.ENTRY.size)
+            self.log = log
+
+    def checkpoint(self):
+        """ Empties the log, after the runs have been saved elsewhere. """
+        if self.log is not None:
+            self.log.truncate(0)
+            self.log.flush()
+        self.pending = 0
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def update(self, indexes):
+        self._change(indexes, self.DELETE)
+
+    def difference_update(self, indexes):
+        self._change(indexes, self.RESTORE)
+
+    def _change(self, indexes, op):
+        runs = self._runs_of(indexes)
+        for start, end in runs:
+            if op == self.DELETE:
+                self._add_run(start, end)
+            else:
+                self._remove_run(start, end)
+        if self.log is not None and runs:
+            self.log.write(b''.join(self.ENTRY.pack(op, start, end)
+                                    for start, end in runs))
+            self.log.flush()
+            self.pending += len(runs)
+
+    @staticmethod
+    def _runs_of(indexes):
+        indexes = np.unique(np.fromiter(indexes, dtype=np.int64))
+        if len(indexes) == 0:
+            return []
+        breaks = np.flatnonzero(np.diff(indexes) != 1) + 1
+        starts = indexes[np.concatenate([[0], breaks])]
+        ends = indexes[np.concatenate([breaks - 1, [-1]])] + 1
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    def _add_run(self, start, end):
+        # Overlapping and adjacent runs are merged
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.length -= sum(e - s for s, e in
+                           zip(self.starts[i:j], self.ends[i:j]))
+        self.length += end - start
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def _remove_run(self, start, end):
+        i = bisect_right(self.ends, start)
+        j = bisect_left(self.starts, end)
+        if i >= j:
+            return
+        remaining = list()
+        if self.starts[i] < start:
+            remaining.append((self.starts[i], start))
+        if self.ends[j - 1] > end:
+            remaining.append((end, self.ends[j - 1]))
+        self.length -= sum(e - s for s, e in
+                           zip(self.starts[i:j], self.ends[i:j]))
+        self.length += sum(e - s for s, e in remaining)
+        self.starts[i:j] = [s for s, _ in remaining]
+        self.ends[i:j] = [e for _, e in remaining]
+
+    def __contains__(self, index):
+        position = bisect_right(self.starts, index) - 1
+        return position >= 0 and index < self.ends[position]
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end)
+
+    def runs(self):
+        return [[start, end] for start, end in zip(self.starts, self.ends)]
+
+    def mask(self, indexes):
+        """
+        :param indexes: numpy array of indexes
+        :return:        boolean numpy array, True where indexes are deleted
+        """
+        starts = np.asarray(self.starts, dtype=np.int64)
+        ends = np.asarray(self.ends, dtype=np.int64)
+        position = np.searchsorted(starts, indexes, side='right') - 1
+        return (position >= 0) & (indexes < ends[np.maximum(position, 0)]) \
+            if len(starts) else np.zeros(len(indexes), dtype=bool)
+
+    def next_alive(self, index):
+        """ Returns the first index from index on which is not deleted. """
+        position = bisect_right(self.starts, index) - 1
+        if position >= 0 and index < self.ends[position]:
+            return self.ends[position]
+        return index
+
+    def last_alive(self, n, end):
+        """
+        :param n:   number of indexes
+        :param end: indexes below end are considered
+        :return:    sorted list of the last n indexes which are not deleted
+        """
+        alive = list()
+        upper = end
+        position = bisect_left(self.starts, upper) - 1
+        while upper > 0 and len(alive) < n:
+            if position >= 0 and self.ends[position] >= upper:
+                # upper - 1 is deleted, jump over its run
+                upper = self.starts[position]
+                position -= 1
+                continue
+            lower = self.ends[position] if position >= 0 else 0
+            count = min(n - len(alive), upper - lower)
+            alive.extend(range(upper - 1, upper - 1 - count, -1))
+            upper -= count
+        return alive[::-1]
+
 
 class Manifest(object):
     '''
@@ -229,6 +646,8 @@ class Manifest(object):
                  max_len=1000, read_only=False):
         self.base_path = Path(os.path.expanduser(base_path)).absolute()
         self.manifest_path = Path(os.path.join(self.base_path, 'manifest.json'))
+        self.deletions_path = Path(os.path.join(self.base_path,
+                                                'manifest.deletions'))
         self.inputs = inputs
         self.types = types
         self._read_metadata(metadata)
@@ -239,8 +658,12 @@ class Manifest(object):
         self.current_index = 0
         self.catalog_paths = list()
         self.catalog_metadata = dict()
-        self.deleted_indexes = set()
+        self.deleted_indexes = DeletedIndexes()
         self._updated_session = False
+        self._catalog_starts = list()
+        self._alive_indexes = None
+        # Guards the files against a background writer, see AsyncTubWriter
+        self.lock = threading.RLock()
         has_catalogs = False
 
         if self.manifest_path.exists():
@@ -257,6 +680,9 @@ class Manifest(object):
                 print(f'Created a new datastore at {self.base_path.as_posix()}')
             self.seekeable = Seekable(self.manifest_path, read_only=self.read_only)
 
+        # Deletions since the catalog metadata was last written
+        self.deleted_indexes.open_log(self.deletions_path,
+                                      read_only=self.read_only)
         if not has_catalogs:
             self._write_contents()
             self._add_catalog()
@@ -267,44 +693,147 @@ class Manifest(object):
             self.current_catalog = Catalog(last_known_catalog,
                                            read_only=self.read_only,
                                            start_index=self.current_index)
+            # The catalog metadata is not rewritten for every record, so the
+            # last catalog knows best how many records have been written.
+            catalog_end = self.current_catalog.manifest.start_index() \
+                + self.current_catalog.seekable.lines()
+            self.current_index = max(self.current_index, catalog_end)
         # Create a new session_id, which will be added to each record in the
         # tub, when Tub.write_record() is called.
         self.session_id = self.create_new_session()
 
     def write_record(self, record):
-        new_catalog = self.current_index > 0 \
-                      and (self.current_index % self.max_len) == 0
-        if new_catalog:
-            self._add_catalog()
-
-        self.current_catalog.write_record(record)
-        self.current_index += 1
-        # Update metadata to keep track of the last index
-        self._update_catalog_metadata(update=True)
-        # Set session_id update status to True if this method is called at
-        # least once. Then session id metadata  will be updated when the
-        # session gets closed
-        if not self._updated_session:
-            self._updated_session = True
+        self.write_records([record])
+
+    def write_records(self, records):
+        """ Writes a group of records, flushing each catalog only once. """
+        with self.lock:
+            written = 0
+            while written < len(records):
+                new_catalog = self.current_index > 0 \
+                              and (self.current_index % self.max_len) == 0
+                if new_catalog:
+                    self._add_catalog()
+
+                space = self.max_len - (self.current_index % self.max_len)
+                group = records[written:written + space]
+                self.current_catalog.write_records(group)
+                self.current_index += len(group)
+                written += len(group)
+            # The last index is recovered from the catalog index when the
+            # manifest is opened, so the catalog metadata is only written when
+            # catalogs are added, records are deleted or the manifest is
+            # closed. Set session_id update status to True if this method is
+            # called at least once. Then session id metadata  will be updated
+            # when the session gets closed
+            if records and not self._updated_session:
+                self._updated_session = True
+
+    def sync(self):
+        with self.lock:
+            self.current_catalog.sync()
 
     def delete_records(self, record_indexes):
-        # Does not actually delete the record, but marks it as deleted.
+        # Does not actually delete the record, but marks it as deleted. Only
+        # the deleted runs are appended to the deletions log.
         if isinstance(record_indexes, int):
             record_indexes = {record_indexes}
-        self.deleted_indexes.update(record_indexes)
-        self._update_catalog_metadata(update=True)
+        with self.lock:
+            self.deleted_indexes.update(record_indexes)
+            self._alive_indexes = None
 
     def restore_records(self, record_indexes):
         # Does not actually delete the record, but marks it as deleted.
         if isinstance(record_indexes, int):
             record_indexes = {record_indexes}
-        self.deleted_indexes.difference_update(record_indexes)
-        self._update_catalog_metadata(update=True)
+        with self.lock:
+            self.deleted_indexes.difference_update(record_indexes)
+            self._alive_indexes = None
+
+    def alive_indexes(self):
+        """
+        :return: sorted numpy array of the indexes of the records which are
+                 not deleted, i.e. position i holds the index of the i-th
+                 record the ManifestIterator returns
+        """
+        with self.lock:
+            if self._alive_indexes is None \
+                    or self._alive_indexes[1] != self.current_index:
+                alive = np.ones(self.current_index, dtype=bool)
+                for start, end in self.deleted_indexes.runs():
+                    alive[start:end] = False
+                self._alive_indexes = (np.flatnonzero(alive),
+                                       self.current_index)
+            return self._alive_indexes[0]
+
+    def catalog_of(self, record_index):
+        """
+        :param record_index:    index of a record
+        :return:                tuple of the position of the catalog in
+                                catalog_paths and its start index
+        """
+        with self.lock:
+            # Catalog start indexes never change, so they are read only once
+            while len(self._catalog_starts) < len(self.catalog_paths):
+                catalog_path = os.path.join(
+                    self.base_path,
+                    self.catalog_paths[len(self._catalog_starts)])
+                metadata = CatalogMetadata(catalog_path, read_only=True)
+                self._catalog_starts.append(metadata.start_index())
+                metadata.close()
+            position = bisect_right(self._catalog_starts, record_index) - 1
+            return max(position, 0), self._catalog_starts[max(position, 0)]
+
+    def read_records(self, record_indexes):
+        """
+        Reads records by their index, no matter if they are deleted. Indexes
+        are grouped by catalog and consecutive lines are read after a single
+        seek.
+
+        :param record_indexes:  record indexes
+        :return:                list of records in the order of the indexes,
+                                None for records which can't be read
+        """
+        by_catalog = dict()
+        for record_index in sorted(set(record_indexes)):
+            if not 0 <= record_index < self.current_index:
+                raise IndexError(f'Record index {record_index} out of range')
+            position, start = self.catalog_of(record_index)
+            by_catalog.setdefault(position, []).append(record_index - start)
+        records = dict()
+        for position, lines in by_catalog.items():
+            catalog_path = os.path.join(self.base_path,
+                                        self.catalog_paths[position])
+            catalog = Catalog(catalog_path, read_only=True)
+            start = catalog.manifest.start_index()
+            previous = None
+            for line in lines:
+                if previous is None or line != previous + 1:
+                    catalog.seekable.seek_line_start(line + 1)
+                previous = line
+                if line >= catalog.seekable.lines():
+                    records[start + line] = None
+                    continue
+                contents = catalog.seekable.readline()
+                try:
+                    records[start + line] = json.loads(contents)
+                except Exception:
+                    print(f'Ignoring record at index {start + line}')
+                    records[start + line] = None
+            catalog.close()
+        return [records[record_index] for record_index in record_indexes]
 
     def _add_catalog(self):
-        current_length = len(self.catalog_paths)
-        catalog_name = f'catalog_{current_length}.catalog'
-        catalog_path = os.path.join(self.base_path, catalog_name)
+        # After a compaction catalogs are not numbered by their position and
+        # an interrupted one can leave unreferenced catalogs behind
+        number = len(self.catalog_paths)
+        while True:
+            catalog_name = f'catalog_{number}.catalog'
+            catalog_path = os.path.join(self.base_path, catalog_name)
+            if catalog_name not in self.catalog_paths \
+                    and not os.path.exists(catalog_path):
+                break
+            number += 1
         current_catalog = self.current_catalog
         self.current_catalog = Catalog(catalog_path,
                                        start_index=self.current_index,
@@ -331,7 +860,7 @@ class Manifest(object):
         self.catalog_paths = catalog_metadata['paths']
         self.current_index = catalog_metadata['current_index']
         self.max_len = catalog_metadata['max_len']
-        self.deleted_indexes = set(catalog_metadata['deleted_indexes'])
+        self.deleted_indexes = DeletedIndexes.from_metadata(catalog_metadata)
 
     def _write_contents(self):
         self.seekeable.truncate_until_end(0)
@@ -349,9 +878,16 @@ class Manifest(object):
         catalog_metadata['paths'] = self.catalog_paths
         catalog_metadata['current_index'] = self.current_index
         catalog_metadata['max_len'] = self.max_len
-        catalog_metadata['deleted_indexes'] = list(self.deleted_indexes)
+        catalog_metadata['deleted_runs'] = self.deleted_indexes.runs()
         self.catalog_metadata = catalog_metadata
         self.seekeable.writeline(json.dumps(catalog_metadata))
+        self.deleted_indexes.checkpoint()
+
+    def replace_manifest_metadata(self, manifest_metadata):
+        """ Replaces the manifest metadata, e.g. the sessions. """
+        with self.lock:
+            self.manifest_metadata = dict(manifest_metadata)
+            self.seekeable.update_line(4, json.dumps(self.manifest_metadata))
 
     def create_new_session(self):
         """ Creates a new session id and appends it to the metadata."""
@@ -375,10 +911,16 @@ class Manifest(object):
             manifest.json"""
         # If records were received, write updated session_id dictionary into
         # the metadata, otherwise keep the session_id information unchanged
-        if self._updated_session:
-            self.seekeable.update_line(4, json.dumps(self.manifest_metadata))
-        self.current_catalog.close()
-        self.seekeable.close()
+        with self.lock:
+            if self._updated_session:
+                self.seekeable.update_line(4,
+                                           json.dumps(self.manifest_metadata))
+            if self._updated_session or (self.deleted_indexes.pending
+                                         and not self.read_only):
+                self._update_catalog_metadata(update=True)
+            self.current_catalog.close()
+            self.seekeable.close()
+            self.deleted_indexes.close()
 
     def __iter__(self):
         return ManifestIterator(self)
@@ -393,19 +935,48 @@ class ManifestIterator(object):
     An iterator for the Manifest type. \n
 
     Returns catalog entries lazily when a consumer calls __next__().
+    Iteration can start at any record index. Runs of deleted records are
+    skipped with a single seek.
     """
-    def __init__(self, manifest):
+    def __init__(self, manifest, start_index=0):
         self.manifest = manifest
         self.has_catalogs = len(self.manifest.catalog_paths) > 0
         self.current_index = 0
         self.current_catalog_index = 0
         self.current_catalog = None
+        self.start_line = 1
+        if self.has_catalogs and start_index > 0:
+            self._seek(start_index)
+
+    def _seek(self, index):
+        """ Moves the iterator to the record index. """
+        if index >= self.manifest.current_index:
+            # Nothing left to iterate
+            position, line = len(self.manifest.catalog_paths), 1
+        else:
+            position, catalog_start = self.manifest.catalog_of(index)
+            line = index - catalog_start + 1
+        if self.current_catalog is not None \
+                and position == self.current_catalog_index:
+            self.current_catalog.seekable.seek_line_start(line)
+        else:
+            if self.current_catalog is not None:
+                self.current_catalog.close()
+                self.current_catalog = None
+            self.current_catalog_index = position
+            self.start_line = line
+        self.current_index = index
 
     def __next__(self):
         while True:
             if not self.has_catalogs:
                 raise StopIteration('No catalogs')
 
+            if self.current_index in self.manifest.deleted_indexes:
+                # Skip over the whole run of records marked deleted
+                self._seek(self.manifest.deleted_indexes.next_alive(
+                    self.current_index))
+
             if self.current_catalog_index >= len(self.manifest.catalog_paths):
                 raise StopIteration('No more catalogs')
 
@@ -413,31 +984,32 @@ class ManifestIterator(object):
                 current_catalog_path = os.path.join(
                     self.manifest.base_path,
                     self.manifest.catalog_paths[self.current_catalog_index])
+                # Iterators never write, and a writable catalog would rebuild
+                # the index of one which is being written to
                 self.current_catalog = Catalog(current_catalog_path,
-                                               read_only=self.manifest.read_only)
-                self.current_catalog.seekable.seek_line_start(1)
+                                               read_only=True)
+                self.current_catalog.seekable.seek_line_start(self.start_line)
+                self.start_line = 1
 
             contents = self.current_catalog.seekable.readline()
             if contents is not None and len(contents) > 0:
-                # Check for current_index when we are ready to advance the
-                # underlying iterator.
                 current_index = self.current_index
                 self.current_index += 1
-                if current_index in self.manifest.deleted_indexes:
-                    # Skip over index, because it has been marked deleted
+                try:
+                    record = json.loads(contents)
+                    return record
+                except Exception:
+                    print(f'Ignoring record at index {current_index}')
                     continue
-                else:
-                    try:
-                        record = json.loads(contents)
-                        return record
-                    except Exception:
-                        print(f'Ignoring record at index {current_index}')
-                        continue
             else:
+                self.current_catalog.close()
                 self.current_catalog = None
                 self.current_catalog_index += 1
 
     next = __next__
 
+    def __iter__(self):
+        return self
+
     def __len__(self):
         return self.manifest.__len__()
@@ -1,8 +1,10 @@
 import os
+import time
 from abc import ABC, abstractmethod
+from collections import deque
 import logging
 import numpy as np
-from typing import Union, Sequence, List
+from typing import Callable, Dict, Optional, Union, Sequence, List
 
 import tensorflow as tf
 from tensorflow import keras
@@ -50,6 +52,25 @@ def keras_to_tflite(model, out_filename, data_gen=None):
     open(out_filename, "wb").write(tflite_model)
 
 
+def keras_model_to_onnx(in_filename, out_filename, opset=13):
+    logger.info(f'Convert model {in_filename} to ONNX {out_filename}')
+    model = tf.keras.models.load_model(in_filename, compile=False)
+    keras_to_onnx(model, out_filename, opset)
+    logger.info('ONNX conversion done.')
+
+
+def keras_to_onnx(model: tf.keras.Model, out_filename: str,
+                  opset: int = 13) -> None:
+    """ Converts the keras model into an ONNX graph with the keras input
+        names and a variable batch size, requires tf2onnx. """
+    import tf2onnx
+    signature = [tf.TensorSpec((None, *inp.shape[1:]), inp.dtype,
+                               name=inp.name.split(':')[0])
+                 for inp in model.inputs]
+    tf2onnx.convert.from_keras(model, input_signature=signature, opset=opset,
+                               output_path=out_filename)
+
+
 def saved_model_to_tensor_rt(saved_path: str, tensor_rt_path: str):
     """ Converts TF SavedModel format into TensorRT for cuda. Note,
         this works also without cuda as all GPU specific magic is handled
@@ -72,6 +93,55 @@ def saved_model_to_tensor_rt(saved_path: str, tensor_rt_path: str):
         logger.error(f'TensorRT conversion failed because: {e}')
 
 
+def cast_input(arr: np.ndarray, dtype) -> np.ndarray:
+    """ Casts an input to the type of the model input, without a copy if the
+        types match already. """
+    return np.asarray(arr).astype(dtype, copy=False)
+
+
+def compiled_function(function: Callable, input_signature: List[tf.TensorSpec],
+                      xla: bool = False) -> Callable:
+    """ Wraps the function into a tf.function with a fixed signature,
+        optionally compiled with XLA. """
+    if not xla:
+        return tf.function(function, input_signature=input_signature)
+    try:
+        return tf.function(function, input_signature=input_signature,
+                           jit_compile=True)
+    except TypeError:
+        # tf < 2.5
+        return tf.function(function, input_signature=input_signature,
+                           experimental_compile=True)
+
+
+class LatencyStats(object):
+    """ Latencies of the last calls of an interpreter. """
+
+    def __init__(self, size: int = 1000) -> None:
+        """
+        :param size:    number of calls kept for the percentiles
+        """
+        self.latencies = deque(maxlen=size)
+        self.calls = 0
+
+    def add(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+        self.calls += 1
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: number of calls and mean, p50, p90, p99 and max latency in
+                 ms of the kept calls, empty without calls
+        """
+        if not self.latencies:
+            return {}
+        ms = np.array(self.latencies) * 1000.
+        p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+        return dict(calls=self.calls, mean_ms=float(ms.mean()),
+                    p50_ms=float(p50), p90_ms=float(p90), p99_ms=float(p99),
+                    max_ms=float(ms.max()))
+
+
 class Interpreter(ABC):
     """ Base class to delegate between Keras, TFLite and TensorRT """
 
@@ -104,19 +174,102 @@ class Interpreter(ABC):
     def predict_from_dict(self, input_dict) -> Sequence[Union[float, np.ndarray]]:
         pass
 
+    def predict_batch(self, input_dict: Dict[str, np.ndarray]) \
+            -> Union[np.ndarray, List[np.ndarray]]:
+        """
+        Predicts a batch in one call, e.g. for offline evaluation.
+
+        :param input_dict:  batched inputs by input name
+        :return:            batched outputs, no list if there is only one
+        """
+        raise NotImplementedError('Requires implementation')
+
+    def latency_stats(self) -> Dict[str, float]:
+        """ Latency statistics of the predictions, empty if they are not
+            recorded """
+        return {}
+
+    def raw_image_input(self) -> bool:
+        """ Whether the model takes the uint8 [0,255] images as they are,
+            like quantized models whose image input has the scale 1/255 """
+        return False
+
     def __str__(self) -> str:
         """ For printing interpreter """
         return type(self).__name__
 
 
 class KerasInterpreter(Interpreter):
+    """
+    Runs the keras model. Single predictions go through a tf.function with
+    a fixed input signature, which avoids the eager dispatch of every
+    layer. The function is traced and warmed up when a model is loaded or
+    at the first prediction, the inputs are copied into preallocated
+    buffers.
+    """
 
-    def __init__(self):
+    def __init__(self, compiled: bool = True, xla: bool = False):
+        """
+        :param compiled:    run single predictions through a tf.function,
+                            otherwise the model is called eagerly
+        :param xla:         compile the tf.function with XLA
+        """
         super().__init__()
         self.model: tf.keras.Model = None
+        self.compiled = compiled
+        self.xla = xla
+        self.function = None
+        self.input_names: List[str] = []
+        self.buffers: List[np.ndarray] = []
+        self.latency = LatencyStats()
 
     def set_model(self, pilot: 'KerasPilot') -> None:
         self.model = pilot.create_model()
+        self.function = None
+
+    def build(self) -> None:
+        """ Traces the model for a batch of one into a tf.function and
+            calls it once, so the first frame doesn't pay for tracing. """
+        assert self.model, 'Model not set'
+        inputs = self.model.inputs
+        self.input_names = [inp.name.split(':')[0] for inp in inputs]
+        self.buffers = [np.zeros((1, *inp.shape[1:]),
+                                 dtype=inp.dtype.as_numpy_dtype)
+                        for inp in inputs]
+        signature = [tf.TensorSpec(buffer.shape, inp.dtype)
+                     for buffer, inp in zip(self.buffers, inputs)]
+        model = self.model
+
+        def call(*args):
+            return model(list(args) if len(args) > 1 else args[0],
+                         training=False)
+
+        self.function = compiled_function(call, signature, self.xla)
+        self.function(*self.buffers)
+        logger.info(f'Built {"XLA " if self.xla else ""}compiled inference '
+                    f'function for inputs {self.input_names}')
+
+    def invoke_compiled(self, arrays: Sequence[np.ndarray]) \
+            -> Union[np.ndarray, List[np.ndarray]]:
+        """ Runs the compiled function on single samples in input order.
+        """
+        if self.function is None:
+            self.build()
+        start = time.perf_counter()
+        for buffer, arr in zip(self.buffers, arrays):
+            # casts to the input type in place
+            buffer[0] = arr
+        outputs = self.function(*self.buffers)
+        # remove the batch dimension
+        if isinstance(outputs, (list, tuple)):
+            result = [output.numpy()[0] for output in outputs]
+        else:
+            result = outputs.numpy()[0]
+        self.latency.add(time.perf_counter() - start)
+        return result
+
+    def latency_stats(self) -> Dict[str, float]:
+        return self.latency.stats()
 
     def set_optimizer(self, optimizer: tf.keras.optimizers.Optimizer) -> None:
         self.model.optimizer = optimizer
@@ -129,35 +282,75 @@ class KerasInterpreter(Interpreter):
         assert self.model, 'Model not set'
         self.model.compile(**kwargs)
 
+    def invoke_batch(self, inputs) -> Union[np.ndarray, List[np.ndarray]]:
+        outputs = self.model(inputs, training=False)
+        # for functional models the output here is a list
+        if type(outputs) is list:
+            return [output.numpy() for output in outputs]
+        return outputs.numpy()
+
     def invoke(self, inputs):
+        start = time.perf_counter()
         outputs = self.model(inputs, training=False)
         # for functional models the output here is a list
         if type(outputs) is list:
             # as we invoke the interpreter with a batch size of one we remove
             # the additional dimension here again
             output = [output.numpy().squeeze(axis=0) for output in outputs]
-            return output
         # for sequential models the output shape is (1, n) with n = output dim
         else:
-            return outputs.numpy().squeeze(axis=0)
+            output = outputs.numpy().squeeze(axis=0)
+        self.latency.add(time.perf_counter() - start)
+        return output
+
+    def input_dtypes(self) -> List[np.dtype]:
+        assert self.model, 'Model not set'
+        return [inp.dtype.as_numpy_dtype for inp in self.model.inputs]
 
     def predict(self, img_arr: np.ndarray, other_arr: np.ndarray) \
             -> Sequence[Union[float, np.ndarray]]:
-        img_arr = np.expand_dims(img_arr, axis=0)
+        if self.compiled:
+            return self.invoke_compiled([img_arr] if other_arr is None
+                                        else [img_arr, other_arr])
+        dtypes = self.input_dtypes()
+        img_arr = np.expand_dims(cast_input(img_arr, dtypes[0]), axis=0)
         inputs = img_arr
         if other_arr is not None:
-            other_arr = np.expand_dims(other_arr, axis=0)
+            other_arr = np.expand_dims(cast_input(other_arr, dtypes[1]),
+                                       axis=0)
             inputs = [img_arr, other_arr]
         return self.invoke(inputs)
 
     def predict_from_dict(self, input_dict):
+        if self.compiled:
+            if self.function is None:
+                self.build()
+            return self.invoke_compiled([input_dict[name]
+                                         for name in self.input_names])
+        dtypes = {inp.name.split(':')[0]: inp.dtype.as_numpy_dtype
+                  for inp in self.model.inputs}
+        inputs = dict()
         for k, v in input_dict.items():
-            input_dict[k] = np.expand_dims(v, axis=0)
-        return self.invoke(input_dict)
+            if k in dtypes:
+                v = cast_input(v, dtypes[k])
+            inputs[k] = np.expand_dims(v, axis=0)
+        return self.invoke(inputs)
+
+    def predict_batch(self, input_dict: Dict[str, np.ndarray]) \
+            -> Union[np.ndarray, List[np.ndarray]]:
+        assert self.model, 'Model not set'
+        inputs = {inp.name.split(':')[0]:
+                  cast_input(input_dict[inp.name.split(':')[0]],
+                             inp.dtype.as_numpy_dtype)
+                  for inp in self.model.inputs}
+        return self.invoke_batch(inputs)
 
     def load(self, model_path: str) -> None:
         logger.info(f'Loading model {model_path}')
         self.model = keras.models.load_model(model_path, compile=False)
+        self.function = None
+        if self.compiled:
+            self.build()
 
     def load_weights(self, model_path: str, by_name: bool = True) -> \
             None:
@@ -167,31 +360,78 @@ class KerasInterpreter(Interpreter):
 
 class TfLite(Interpreter):
     """
-    This class wraps around the TensorFlow Lite interpreter.
+    This class wraps around the TensorFlow Lite interpreter. The inputs are
+    written directly into the input tensors of the interpreter. Float inputs
+    of quantized models are quantized on the way, inputs which have the type
+    of the model input already are copied as they are, and quantized outputs
+    are dequantized.
     """
 
-    def __init__(self):
+    def __init__(self, num_threads: Optional[int] = None,
+                 xnnpack: bool = True, delegate: Optional[str] = None,
+                 delegate_options: Optional[Dict[str, str]] = None):
+        """
+        :param num_threads:         number of cpu threads of the
+                                    interpreter, None uses all cores
+        :param xnnpack:             run float models through the XNNPACK
+                                    delegate of tflite
+        :param delegate:            library of an external delegate, e.g.
+                                    libedgetpu.so.1 for the Coral TPU
+        :param delegate_options:    options of the external delegate
+        """
         super().__init__()
+        self.num_threads = num_threads
+        self.xnnpack = xnnpack
+        self.delegate = delegate
+        self.delegate_options = delegate_options
         self.interpreter = None
         self.input_shapes = None
         self.input_details = None
         self.output_details = None
-    
+        # accessors of the input tensors, the returned arrays are views into
+        # the interpreter and must not be kept when invoking it
+        self.input_tensors: List[Callable[[], np.ndarray]] = []
+        # batch size the input tensors are allocated for
+        self.batch_size = 1
+        self.latency = LatencyStats()
+
     def load(self, model_path):
         assert os.path.splitext(model_path)[1] == '.tflite', \
             'TFlitePilot should load only .tflite files'
         logger.info(f'Loading model {model_path}')
+        delegates = None
+        if self.delegate:
+            logger.info(f'Using tflite delegate {self.delegate}')
+            delegates = [tf.lite.experimental.load_delegate(
+                self.delegate, self.delegate_options)]
+        kwargs = dict(model_path=model_path,
+                      num_threads=self.num_threads or os.cpu_count(),
+                      experimental_delegates=delegates)
+        if not self.xnnpack:
+            kwargs['experimental_op_resolver_type'] = tf.lite.experimental.\
+                OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
         # Load TFLite model and allocate tensors.
-        self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        try:
+            self.interpreter = tf.lite.Interpreter(**kwargs)
+        except TypeError:
+            # tf < 2.5 has no op resolver type and always uses xnnpack
+            # where it is compiled in
+            kwargs.pop('experimental_op_resolver_type', None)
+            self.interpreter = tf.lite.Interpreter(**kwargs)
         self.interpreter.allocate_tensors()
+        self.batch_size = 1
 
         # Get input and output tensors.
         self.input_details = self.interpreter.get_input_details()
-        self.output_details = self.interpreter.get_output_details()
+        self.output_details = self.sorted_outputs(
+            self.interpreter.get_output_details())
+        self.input_tensors = [self.interpreter.tensor(detail['index'])
+                              for detail in self.input_details]
 
         # Get Input shape
         self.input_shapes = []
-        logger.info('Load model with tflite input tensor details:')
+        logger.info(f'Load model with {kwargs["num_threads"]} threads and '
+                    f'tflite input tensor details:')
         for detail in self.input_details:
             logger.debug(detail)
             self.input_shapes.append(detail['shape'])
@@ -199,14 +439,87 @@ class TfLite(Interpreter):
     def compile(self, **kwargs):
         pass
 
-    def invoke(self) -> Sequence[Union[float, np.ndarray]]:
-        self.interpreter.invoke()
+    @staticmethod
+    def input_name(detail: Dict) -> str:
+        """ The keras input name of a tflite input, converters of newer tf
+            versions name them like serving_default_img_in:0 """
+        name = detail['name'].split(':')[0]
+        prefix = 'serving_default_'
+        return name[len(prefix):] if name.startswith(prefix) else name
+
+    def sorted_outputs(self, output_details: List[Dict]) -> List[Dict]:
+        """ The converter doesn't keep the order of the keras outputs. The
+            signature maps the keras output names to the tensors, and the
+            output names of the pilots sort in output order. """
+        try:
+            outputs = self.interpreter.get_signature_runner() \
+                .get_output_details()
+        except (AttributeError, ValueError):
+            # models without signature or tf < 2.10
+            return output_details
+        order = {outputs[name]['index']: i
+                 for i, name in enumerate(sorted(outputs))}
+        if order.keys() != {detail['index'] for detail in output_details}:
+            return output_details
+        return sorted(output_details, key=lambda d: order[d['index']])
+
+    def raw_image_input(self) -> bool:
+        assert self.input_details, "Tflite model not loaded"
+        detail = next((d for d in self.input_details
+                       if self.input_name(d) == 'img_in'),
+                      self.input_details[0])
+        scale, zero_point = detail['quantization']
+        return detail['dtype'] == np.uint8 and zero_point == 0 \
+            and np.isclose(scale, 1. / 255.)
+
+    def resize(self, batch_size: int) -> None:
+        """ Resizes the input tensors to the batch size. """
+        if batch_size == self.batch_size:
+            return
+        for shape, detail in zip(self.input_shapes, self.input_details):
+            self.interpreter.resize_tensor_input(
+                detail['index'], [batch_size, *shape[1:]])
+        self.interpreter.allocate_tensors()
+        self.batch_size = batch_size
+
+    def set_input(self, i: int, arr: np.ndarray) -> None:
+        """ Writes the array into the i-th input tensor, float arrays are
+            quantized for quantized inputs. """
+        tensor = self.input_tensors[i]()
+        arr = np.asarray(arr)
+        scale, zero_point = self.input_details[i]['quantization']
+        if scale and arr.dtype != tensor.dtype \
+                and np.issubdtype(arr.dtype, np.floating):
+            info = np.iinfo(tensor.dtype)
+            arr = np.clip(np.round(arr / scale + zero_point), info.min,
+                          info.max)
+        # casts to the input type while copying
+        tensor[...] = arr.reshape(tensor.shape)
+
+    def get_outputs(self) -> List[np.ndarray]:
+        """ The outputs of the last invocation, dequantized if needed. """
         outputs = []
-        for tensor in self.output_details:
-            output_data = self.interpreter.get_tensor(tensor['index'])
-            # as we invoke the interpreter with a batch size of one we remove
-            # the additional dimension here again
-            outputs.append(output_data[0])
+        for detail in self.output_details:
+            # get_tensor copies, the interpreter reuses its buffers
+            output = self.interpreter.get_tensor(detail['index'])
+            scale, zero_point = detail['quantization']
+            if scale:
+                output = (output.astype(np.float32) - zero_point) * scale
+            outputs.append(output)
+        return outputs
+
+    def invoke(self, arrays: Sequence[np.ndarray]) \
+            -> Sequence[Union[float, np.ndarray]]:
+        """ Runs the interpreter on single samples in input order. """
+        start = time.perf_counter()
+        self.resize(1)
+        for i, arr in enumerate(arrays):
+            self.set_input(i, arr)
+        self.interpreter.invoke()
+        # as we invoke the interpreter with a batch size of one we remove
+        # the additional dimension here again
+        outputs = [output[0] for output in self.get_outputs()]
+        self.latency.add(time.perf_counter() - start)
         # don't return list if output is 1d
         return outputs if len(outputs) > 1 else outputs[0]
 
@@ -214,26 +527,165 @@ class TfLite(Interpreter):
             -> Sequence[Union[float, np.ndarray]]:
         assert self.input_shapes and self.input_details, \
             "Tflite model not loaded"
-        input_arrays = (img_arr, other_arr)
-        for arr, shape, detail \
-                in zip(input_arrays, self.input_shapes, self.input_details):
-            in_data = arr.reshape(shape).astype(np.float32)
-            self.interpreter.set_tensor(detail['index'], in_data)
-        return self.invoke()
+        # the converter doesn't keep the order of the keras inputs, so the
+        # image goes into img_in and the other array into the other input
+        names = [self.input_name(detail) for detail in self.input_details]
+        if 'img_in' in names:
+            input_arrays = [img_arr if name == 'img_in' else other_arr
+                            for name in names]
+        else:
+            input_arrays = (img_arr, other_arr)[:len(names)]
+        return self.invoke(input_arrays)
 
     def predict_from_dict(self, input_dict):
-        for detail in self.input_details:
-            k = detail['name']
-            inp_k = input_dict[k]
-            inp_k_res = inp_k.reshape(detail['shape']).astype(np.float32)
-            self.interpreter.set_tensor(detail['index'], inp_k_res)
-        return self.invoke()
+        assert self.input_shapes and self.input_details, \
+            "Tflite model not loaded"
+        return self.invoke([input_dict[self.input_name(detail)]
+                            for detail in self.input_details])
+
+    def predict_batch(self, input_dict: Dict[str, np.ndarray]) \
+            -> Union[np.ndarray, List[np.ndarray]]:
+        assert self.input_shapes and self.input_details, \
+            "Tflite model not loaded"
+        batch_size = len(next(iter(input_dict.values())))
+        self.resize(batch_size)
+        for i, detail in enumerate(self.input_details):
+            self.set_input(i, input_dict[self.input_name(detail)])
+        self.interpreter.invoke()
+        outputs = self.get_outputs()
+        # don't return list if output is 1d
+        return outputs if len(outputs) > 1 else outputs[0]
+
+    def latency_stats(self) -> Dict[str, float]:
+        return self.latency.stats()
 
     def get_input_shapes(self):
         assert self.input_shapes is not None, "Need to load model first"
         return self.input_shapes
 
 
+class OnnxInterpreter(Interpreter):
+    """
+    Runs ONNX graphs with ONNX Runtime, e.g. keras pilots exported in
+    training or torch models exported by the torch training. Requires
+    onnxruntime.
+    """
+    DTYPES = {'tensor(float)': np.float32, 'tensor(float16)': np.float16,
+              'tensor(double)': np.float64, 'tensor(uint8)': np.uint8,
+              'tensor(int8)': np.int8, 'tensor(int32)': np.int32,
+              'tensor(int64)': np.int64}
+    OPTIMIZATION_LEVELS = {'disable': 'ORT_DISABLE_ALL',
+                           'basic': 'ORT_ENABLE_BASIC',
+                           'extended': 'ORT_ENABLE_EXTENDED',
+                           'all': 'ORT_ENABLE_ALL'}
+
+    def __init__(self, graph_optimization: str = 'all',
+                 intra_op_threads: Optional[int] = None,
+                 inter_op_threads: Optional[int] = None,
+                 providers: Optional[List[str]] = None):
+        """
+        :param graph_optimization:  graph optimization level of onnxruntime,
+                                    one of disable, basic, extended, all
+        :param intra_op_threads:    threads used within an operator, None
+                                    lets onnxruntime use all cores
+        :param inter_op_threads:    threads running independent operators in
+                                    parallel, None runs them sequentially
+        :param providers:           execution providers in order of
+                                    preference, None uses the cpu
+        """
+        super().__init__()
+        assert graph_optimization in self.OPTIMIZATION_LEVELS, \
+            f'Unknown graph optimization {graph_optimization}, use one of ' \
+            f'{", ".join(self.OPTIMIZATION_LEVELS)}'
+        self.graph_optimization = graph_optimization
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.providers = providers or ['CPUExecutionProvider']
+        self.session = None
+        self.input_names: List[str] = []
+        self.input_dtypes: List[np.dtype] = []
+        self.input_shapes = None
+        self.latency = LatencyStats()
+
+    def load(self, model_path: str) -> None:
+        assert os.path.splitext(model_path)[1] == '.onnx', \
+            'OnnxInterpreter should load only .onnx files'
+        import onnxruntime as ort
+        logger.info(f'Loading model {model_path}')
+        options = ort.SessionOptions()
+        options.graph_optimization_level = getattr(
+            ort.GraphOptimizationLevel,
+            self.OPTIMIZATION_LEVELS[self.graph_optimization])
+        if self.intra_op_threads:
+            options.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+            options.inter_op_num_threads = self.inter_op_threads
+        self.session = ort.InferenceSession(model_path, sess_options=options,
+                                            providers=self.providers)
+        inputs = self.session.get_inputs()
+        self.input_names = [inp.name for inp in inputs]
+        self.input_dtypes = [np.dtype(self.DTYPES[inp.type])
+                             for inp in inputs]
+        # the batch dimension is symbolic
+        self.input_shapes = [[None, *inp.shape[1:]] for inp in inputs]
+        logger.info(f'Load model with onnx inputs {self.input_names} and '
+                    f'providers {self.session.get_providers()}')
+
+    def compile(self, **kwargs):
+        pass
+
+    def get_input_shapes(self) -> List[List[Optional[int]]]:
+        assert self.input_shapes is not None, "Need to load model first"
+        return self.input_shapes
+
+    def raw_image_input(self) -> bool:
+        assert self.session, "Onnx model not loaded"
+        i = self.input_names.index('img_in') \
+            if 'img_in' in self.input_names else 0
+        return self.input_dtypes[i] == np.uint8
+
+    def invoke_batch(self, arrays: Sequence[np.ndarray]) -> List[np.ndarray]:
+        """ Runs the session on batched inputs in input order. """
+        assert self.session, "Onnx model not loaded"
+        feeds = {name: cast_input(arr, dtype) for name, dtype, arr
+                 in zip(self.input_names, self.input_dtypes, arrays)}
+        return self.session.run(None, feeds)
+
+    def invoke(self, arrays: Sequence[np.ndarray]) \
+            -> Sequence[Union[float, np.ndarray]]:
+        """ Runs the session on single samples in input order. """
+        start = time.perf_counter()
+        outputs = self.invoke_batch([np.expand_dims(arr, axis=0)
+                                     for arr in arrays])
+        # remove the batch dimension
+        outputs = [output[0] for output in outputs]
+        self.latency.add(time.perf_counter() - start)
+        # don't return list if output is 1d
+        return outputs if len(outputs) > 1 else outputs[0]
+
+    def predict(self, img_arr: np.ndarray, other_arr: np.ndarray) \
+            -> Sequence[Union[float, np.ndarray]]:
+        # like in tflite the exported inputs needn't be in keras order
+        if 'img_in' in self.input_names:
+            return self.invoke([img_arr if name == 'img_in' else other_arr
+                                for name in self.input_names])
+        return self.invoke((img_arr, other_arr)[:len(self.input_names)])
+
+    def predict_from_dict(self, input_dict):
+        return self.invoke([input_dict[name] for name in self.input_names])
+
+    def predict_batch(self, input_dict: Dict[str, np.ndarray]) \
+            -> Union[np.ndarray, List[np.ndarray]]:
+        outputs = self.invoke_batch([input_dict[name]
+                                     for name in self.input_names])
+        # don't return list if output is 1d
+        return outputs if len(outputs) > 1 else outputs[0]
+
+    def latency_stats(self) -> Dict[str, float]:
+        return self.latency.stats()
+
+
 class TensorRT(Interpreter):
     """
     Uses TensorRT to do the inference.
@@ -259,10 +711,12 @@ class TensorRT(Interpreter):
     def predict(self, img_arr: np.ndarray, other_arr: np.ndarray) \
             -> Sequence[Union[float, np.ndarray]]:
         # first reshape as usual
-        img_arr = np.expand_dims(img_arr, axis=0).astype(np.float32)
+        dtypes = [inp.dtype.as_numpy_dtype for inp in self.frozen_func.inputs]
+        img_arr = np.expand_dims(cast_input(img_arr, dtypes[0]), axis=0)
         img_tensor = self.convert(img_arr)
         if other_arr is not None:
-            other_arr = np.expand_dims(other_arr, axis=0).astype(np.float32)
+            other_arr = np.expand_dims(cast_input(other_arr, dtypes[1]),
+                                       axis=0)
             other_tensor = self.convert(other_arr)
             output_tensors = self.frozen_func(img_tensor, other_tensor)
         else:
@@ -278,7 +732,8 @@ class TensorRT(Interpreter):
         for inp in self.frozen_func.inputs:
             name = inp.name.split(':')[0]
             val = input_dict[name]
-            val_res = np.expand_dims(val, axis=0).astype(np.float32)
+            val_res = np.expand_dims(cast_input(val, inp.dtype.as_numpy_dtype),
+                                     axis=0)
             val_conv = self.convert(val_res)
             args.append(val_conv)
         output_tensors = self.frozen_func(*args)
@@ -287,9 +742,21 @@ class TensorRT(Interpreter):
         # don't return list if output is 1d
         return outputs if len(outputs) > 1 else outputs[0]
 
+    def predict_batch(self, input_dict: Dict[str, np.ndarray]) \
+            -> Union[np.ndarray, List[np.ndarray]]:
+        args = []
+        for inp in self.frozen_func.inputs:
+            name = inp.name.split(':')[0]
+            val = cast_input(input_dict[name], inp.dtype.as_numpy_dtype)
+            args.append(self.convert(val))
+        outputs = [out.numpy() for out in self.frozen_func(*args)]
+        # don't return list if output is 1d
+        return outputs if len(outputs) > 1 else outputs[0]
+
     @staticmethod
     def convert(arr):
         """ Helper function. """
-        value = tf.compat.v1.get_variable("features", dtype=tf.float32,
+        value = tf.compat.v1.get_variable("features",
+                                          dtype=tf.as_dtype(arr.dtype),
                                           initializer=tf.constant(arr))
         return tf.convert_to_tensor(value=value)
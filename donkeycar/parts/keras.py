@@ -55,6 +55,8 @@ class KerasPilot(ABC):
         # self.model: Optional[Model] = None
         self.input_shape = input_shape
         self.optimizer = "adam"
+        self.dtype = np.dtype(np.float32)
+        self.image_dtype = np.dtype(np.float32)
         self.interpreter = interpreter
         self.interpreter.set_model(self)
         logger.info(f'Created {self} with interpreter: {interpreter}')
@@ -62,12 +64,17 @@ class KerasPilot(ABC):
     def load(self, model_path: str) -> None:
         logger.info(f'Loading model {model_path}')
         self.interpreter.load(model_path)
+        if self.interpreter.raw_image_input() and self.image_dtype != np.uint8:
+            logger.info(f'{self} feeds the raw uint8 images to the model')
+            self.image_dtype = np.dtype(np.uint8)
 
     def load_weights(self, model_path: str, by_name: bool = True) -> None:
         self.interpreter.load_weights(model_path, by_name=by_name)
 
     def shutdown(self) -> None:
-        pass
+        stats = self.interpreter.latency_stats()
+        if stats:
+            logger.info(f'{self} inference latency: {stats}')
 
     def compile(self) -> None:
         pass
@@ -91,6 +98,22 @@ class KerasPilot(ABC):
     def get_input_shapes(self) -> List[tf.TensorShape]:
         return self.interpreter.get_input_shapes()
 
+    def set_dtype_policy(self, dtype: str = 'float32',
+                         image_dtype: Optional[str] = None) -> None:
+        """
+        Sets the types of the tensors fed into the model in training and
+        when driving.
+
+        :param dtype:       float type of the model inputs and labels
+        :param image_dtype: type of the image input, defaults to dtype. With
+                            uint8 the images are not normalized, this only
+                            works for models which normalize internally
+        """
+        self.dtype = np.dtype(dtype)
+        self.image_dtype = np.dtype(image_dtype or dtype)
+        logger.info(f'{self} uses {self.dtype} inputs and '
+                    f'{self.image_dtype} images')
+
     def seq_size(self) -> int:
         return 0
 
@@ -105,15 +128,16 @@ class KerasPilot(ABC):
                             state vector in the Behavioural model
         :return:            tuple of (angle, throttle)
         """
-        norm_arr = normalize_image(img_arr)
-        np_other_array = np.array(other_arr) if other_arr else None
+        norm_arr = normalize_image(img_arr, self.image_dtype)
+        np_other_array = np.array(other_arr, dtype=self.dtype) \
+            if other_arr else None
         return self.inference(norm_arr, np_other_array)
 
     def inference(self, img_arr: np.ndarray, other_arr: Optional[np.ndarray]) \
             -> Tuple[Union[float, np.ndarray], ...]:
         """ Inferencing using the interpreter
-            :param img_arr:     float32 [0,1] numpy array with normalized image
-                                data
+            :param img_arr:     numpy array with image data normalized as
+                                in the dtype policy
             :param other_arr:   numpy array of additional data to be used in the
                                 pilot, like IMU array for the IMU model or a
                                 state vector in the Behavioural model
@@ -131,6 +155,35 @@ class KerasPilot(ABC):
         output = self.interpreter.predict_from_dict(input_dict)
         return self.interpreter_to_output(output)
 
+    def inference_batch(self, input_dict: Dict[str, np.ndarray]) \
+            -> Tuple[np.ndarray, ...]:
+        """ Inferencing of a batch in one interpreter call
+            :param input_dict:  batched input dictionary of str and
+                                np.ndarray, i.e. stacked x_translate() dicts
+            :return:            tuple of np.ndarray, typically angles and
+                                throttles
+        """
+        output = self.interpreter.predict_batch(input_dict)
+        return self.interpreter_to_output_batch(output)
+
+    def interpreter_to_output_batch(
+            self,
+            interpreter_out: Union[np.ndarray, List[np.ndarray]]) \
+            -> Tuple[np.ndarray, ...]:
+        """ Converts batched interpreter outputs like interpreter_to_output()
+            converts single ones. Child classes vectorize this, by default
+            the rows are converted one by one.
+            :param interpreter_out:  batched output or list of them
+            :return:                 tuple of np.ndarray
+        """
+        if isinstance(interpreter_out, list):
+            rows = [[out[i] for out in interpreter_out]
+                    for i in range(len(interpreter_out[0]))]
+        else:
+            rows = list(interpreter_out)
+        outputs = [self.interpreter_to_output(row) for row in rows]
+        return tuple(np.array(values) for values in zip(*outputs))
+
     @abstractmethod
     def interpreter_to_output(
             self,
@@ -253,9 +306,12 @@ class KerasPilot(ABC):
                                   f'pipeline')
 
     def output_types(self) -> Tuple[Dict[str, np.typename], ...]:
-        """ Used in tf.data, assume all types are doubles"""
+        """ Used in tf.data, the image inputs use the image type and all other
+            tensors the float type of the dtype policy """
         shapes = self.output_shapes()
-        types = tuple({k: tf.float64 for k in d} for d in shapes)
+        types = tuple({k: tf.as_dtype(self.image_dtype if k == 'img_in'
+                                      else self.dtype) for k in d}
+                      for d in shapes)
         return types
 
     def output_shapes(self) -> Dict[str, tf.TensorShape]:
@@ -306,6 +362,14 @@ class KerasCategorical(KerasPilot):
         angle = dk.utils.linear_unbin(angle_binned)
         return angle, throttle
 
+    def interpreter_to_output_batch(self, interpreter_out):
+        angle_binned, throttle_binned = interpreter_out
+        N = throttle_binned.shape[-1]
+        throttle = dk.utils.linear_unbin(throttle_binned, N=N,
+                                         offset=0.0, R=self.throttle_range)
+        angle = dk.utils.linear_unbin(angle_binned)
+        return angle, throttle
+
     def y_transform(self, record: Union[TubRecord, List[TubRecord]]) -> XY:
         assert isinstance(record, TubRecord), "TubRecord expected"
         angle: float = record.underlying['user/angle']
@@ -352,6 +416,10 @@ class KerasLinear(KerasPilot):
         throttle = interpreter_out[1]
         return steering[0], throttle[0]
 
+    def interpreter_to_output_batch(self, interpreter_out):
+        steering, throttle = interpreter_out[:2]
+        return steering[:, 0], throttle[:, 0]
+
     def y_transform(self, record: Union[TubRecord, List[TubRecord]]) -> XY:
         assert isinstance(record, TubRecord), 'TubRecord expected'
         angle: float = record.underlying['user/angle']
@@ -407,8 +475,9 @@ class KerasMemory(KerasLinear):
             Tuple[Union[float, np.ndarray], ...]:
         # Only called at start to fill the previous values
 
-        np_mem_arr = np.array(self.mem_seq).reshape((2 * self.mem_length,))
-        img_arr_norm = normalize_image(img_arr)
+        np_mem_arr = np.array(self.mem_seq, dtype=self.dtype)\
+            .reshape((2 * self.mem_length,))
+        img_arr_norm = normalize_image(img_arr, self.image_dtype)
         angle, throttle = super().inference(img_arr_norm, np_mem_arr)
         # fill new values into back of history list for next call
         self.mem_seq.popleft()
@@ -553,6 +622,11 @@ class KerasIMU(KerasPilot):
         throttle = interpreter_out[1]
         return steering[0], throttle[0]
 
+    def interpreter_to_output_batch(self, interpreter_out) \
+            -> Tuple[np.ndarray, ...]:
+        steering, throttle = interpreter_out[:2]
+        return steering[:, 0], throttle[:, 0]
+
     def x_transform(self, record: Union[TubRecord, List[TubRecord]]) -> XY:
         assert isinstance(record, TubRecord), 'TubRecord expected'
         img_arr = record.image(cached=True)
@@ -673,6 +747,11 @@ class KerasLocalizer(KerasPilot):
         loc = np.argmax(track_loc)
         return angle[0], throttle[0], loc
 
+    def interpreter_to_output_batch(self, interpreter_out) \
+            -> Tuple[np.ndarray, ...]:
+        angle, throttle, track_loc = interpreter_out
+        return angle[:, 0], throttle[:, 0], np.argmax(track_loc, axis=-1)
+
     def y_transform(self, record: Union[TubRecord, List[TubRecord]]) -> XY:
         assert isinstance(record, TubRecord), "TubRecord expected"
         angle: float = record.underlying['user/angle']
@@ -770,7 +849,7 @@ class KerasLSTM(KerasPilot):
         self.img_seq.append(img_arr)
         new_shape = (self.seq_length, *self.input_shape)
         img_arr = np.array(self.img_seq).reshape(new_shape)
-        img_arr_norm = normalize_image(img_arr)
+        img_arr_norm = normalize_image(img_arr, self.image_dtype)
         return self.inference(img_arr_norm, other_arr)
 
     def interpreter_to_output(self, interpreter_out) \
@@ -779,6 +858,10 @@ class KerasLSTM(KerasPilot):
         throttle = interpreter_out[1]
         return steering, throttle
 
+    def interpreter_to_output_batch(self, interpreter_out) \
+            -> Tuple[np.ndarray, ...]:
+        return interpreter_out[:, 0], interpreter_out[:, 1]
+
     def output_shapes(self):
         # need to cut off None from [None, 120, 160, 3] tensor shape
         img_shape = self.get_input_shapes()[0][1:]
@@ -862,7 +945,7 @@ class Keras3D_CNN(KerasPilot):
         self.img_seq.append(img_arr)
         new_shape = (self.seq_length, *self.input_shape)
         img_arr = np.array(self.img_seq).reshape(new_shape)
-        img_arr_norm = normalize_image(img_arr)
+        img_arr_norm = normalize_image(img_arr, self.image_dtype)
         return self.inference(img_arr_norm, other_arr)
 
     def interpreter_to_output(self, interpreter_out) \
@@ -871,6 +954,10 @@ class Keras3D_CNN(KerasPilot):
         throttle = interpreter_out[1]
         return steering, throttle
 
+    def interpreter_to_output_batch(self, interpreter_out) \
+            -> Tuple[np.ndarray, ...]:
+        return interpreter_out[:, 0], interpreter_out[:, 1]
+
     def output_shapes(self):
         # need to cut off None from [None, 120, 160, 3] tensor shape
         img_shape = self.get_input_shapes()[0][1:]
@@ -0,0 +1,213 @@
+import copy
+import logging
+import os
+import platform
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import psutil
+
+from donkeycar.config import Config
+from donkeycar.parts.interpreter import LatencyStats
+from donkeycar.parts.keras import KerasPilot
+from donkeycar.utils import get_model_by_type, normalize_image
+
+
+logger = logging.getLogger(__name__)
+
+# number of distinct inputs which are cycled through, so long runs don't
+# hold every frame in memory
+MAX_INPUTS = 100
+
+
+def interpreter_variants(model_path: str, tflite_threads: Sequence[int]) \
+        -> List[Tuple[str, str, str, Dict[str, Any]]]:
+    """
+    The interpreters to benchmark for the model and its converted versions,
+    i.e. the .h5, .savedmodel, .tflite, .onnx and .trt files with the same
+    name next to it.
+
+    :param model_path:      path of the model
+    :param tflite_threads:  thread counts the tflite model runs with
+    :return:                list of name, model type prefix, model path and
+                            config overrides
+    """
+    base, ext = os.path.splitext(model_path)
+    paths = {ext: model_path}
+    for sibling in ('.h5', '.savedmodel', '.tflite', '.onnx', '.trt'):
+        if sibling not in paths and os.path.exists(base + sibling):
+            paths[sibling] = base + sibling
+    variants = []
+    keras_path = paths.get('.h5') or paths.get('.savedmodel')
+    if keras_path:
+        variants.append(('keras', '', keras_path,
+                         dict(KERAS_COMPILED_INFERENCE=False)))
+        variants.append(('keras compiled', '', keras_path,
+                         dict(KERAS_COMPILED_INFERENCE=True,
+                              KERAS_XLA_INFERENCE=False)))
+    if '.tflite' in paths:
+        for threads in tflite_threads:
+            variants.append((f'tflite {threads} threads', 'tflite_',
+                             paths['.tflite'],
+                             dict(TFLITE_NUM_THREADS=threads)))
+    if '.onnx' in paths:
+        variants.append(('onnx', 'onnx_', paths['.onnx'], dict()))
+    if '.trt' in paths:
+        variants.append(('tensorrt', 'tensorrt_', paths['.trt'], dict()))
+    return variants
+
+
+def random_inputs(pilot: KerasPilot, count: int) \
+        -> List[Dict[str, np.ndarray]]:
+    """ Random camera images and other inputs of the pilot, normalized like
+        when driving. """
+    x_shapes = pilot.output_shapes()[0]
+    inputs = []
+    for _ in range(count):
+        x = dict()
+        for k, shape in x_shapes.items():
+            if k == 'img_in':
+                img = np.random.randint(0, 256, size=tuple(shape),
+                                        dtype=np.uint8)
+                x[k] = normalize_image(img, pilot.image_dtype)
+            else:
+                x[k] = np.random.rand(*shape).astype(pilot.dtype)
+        inputs.append(x)
+    return inputs
+
+
+def tub_inputs(pilot: KerasPilot, cfg: Config, tub_paths: List[str],
+               count: int) -> List[Dict[str, np.ndarray]]:
+    """ The inputs of the first records of the tubs, normalized like when
+        driving. """
+    from donkeycar.pipeline.types import TubDataset
+
+    dataset = TubDataset(config=cfg, tub_paths=tub_paths,
+                         seq_size=pilot.seq_size())
+    records = dataset.get_records()[:count]
+    assert records, f'No records in {tub_paths}'
+    return [pilot.x_translate(pilot.x_transform_and_process(
+        record, lambda x: normalize_image(x, pilot.image_dtype)))
+        for record in records]
+
+
+def benchmark_interpreter(pilot: KerasPilot,
+                          inputs: List[Dict[str, np.ndarray]],
+                          frames: int, warmup: int) -> Dict[str, Any]:
+    """
+    Times single frame inference of the loaded pilot.
+
+    :param pilot:   loaded pilot
+    :param inputs:  inputs which are cycled through
+    :param frames:  number of timed frames
+    :param warmup:  number of frames before the timing starts
+    :return:        latency percentiles in ms, frames per second, cpu time
+                    and resident memory
+    """
+    for i in range(warmup):
+        pilot.inference_from_dict(inputs[i % len(inputs)])
+    latency = LatencyStats(size=frames)
+    process = psutil.Process()
+    cpu_start = process.cpu_times()
+    start = time.perf_counter()
+    for i in range(frames):
+        frame_start = time.perf_counter()
+        pilot.inference_from_dict(inputs[i % len(inputs)])
+        latency.add(time.perf_counter() - frame_start)
+    elapsed = time.perf_counter() - start
+    cpu_end = process.cpu_times()
+    cpu_s = cpu_end.user - cpu_start.user + cpu_end.system - cpu_start.system
+    return dict(latency=latency.stats(), elapsed_s=elapsed,
+                fps=frames / elapsed if elapsed else 0., cpu_s=cpu_s,
+                cpu_percent=100. * cpu_s / elapsed if elapsed else 0.,
+                rss_mb=process.memory_info().rss / 2 ** 20)
+
+
+def benchmark_pilot(cfg: Config, model_path: str,
+                    model_type: Optional[str] = None,
+                    tub_paths: Optional[List[str]] = None,
+                    frames: int = 500, warmup: int = 20,
+                    tflite_threads: Optional[Sequence[int]] = None) \
+        -> Dict[str, Any]:
+    """
+    Benchmarks the model under every interpreter it is available for. Each
+    interpreter loads the model, runs the warmup frames and then the timed
+    frames one by one, like when driving. Interpreters which fail to load,
+    e.g. because their runtime isn't installed, are reported with the error.
+
+    :param cfg:             donkey config
+    :param model_path:      path of the model, converted versions with the
+                            same name next to it are benchmarked as well
+    :param model_type:      model type without interpreter prefix, defaults
+                            to config.DEFAULT_MODEL_TYPE
+    :param tub_paths:       tubs whose records are the inputs, random inputs
+                            are used without tubs
+    :param frames:          number of timed frames
+    :param warmup:          number of frames before the timing starts
+    :param tflite_threads:  thread counts the tflite model runs with,
+                            defaults to one and all cores
+    :return:                report of the host and per interpreter
+    """
+    import tensorflow as tf
+
+    model_path = os.path.expanduser(model_path)
+    model_type = model_type or cfg.DEFAULT_MODEL_TYPE
+    for prefix in ('tflite_', 'tensorrt_', 'onnx_'):
+        model_type = model_type.replace(prefix, '')
+    if tflite_threads is None:
+        tflite_threads = sorted({1, os.cpu_count() or 1})
+    process = psutil.Process()
+    report = dict(
+        model=model_path, model_type=model_type,
+        inputs='tub' if tub_paths else 'random', frames=frames,
+        warmup=warmup,
+        host=dict(node=platform.node(), machine=platform.machine(),
+                  platform=platform.platform(), cpu_count=os.cpu_count(),
+                  python=platform.python_version(),
+                  tensorflow=tf.__version__),
+        interpreters=list())
+    for name, prefix, path, overrides in \
+            interpreter_variants(model_path, tflite_threads):
+        result = dict(name=name, path=path)
+        report['interpreters'].append(result)
+        variant_cfg = copy.copy(cfg)
+        for key, value in overrides.items():
+            setattr(variant_cfg, key, value)
+        try:
+            rss_before = process.memory_info().rss
+            start = time.perf_counter()
+            pilot = get_model_by_type(prefix + model_type, variant_cfg)
+            pilot.load(path)
+            result['load_s'] = time.perf_counter() - start
+            count = min(frames, MAX_INPUTS)
+            inputs = tub_inputs(pilot, cfg, tub_paths, count) if tub_paths \
+                else random_inputs(pilot, count)
+            result.update(benchmark_interpreter(pilot, inputs, frames,
+                                                warmup))
+            result['rss_increase_mb'] = \
+                (process.memory_info().rss - rss_before) / 2 ** 20
+        except Exception as e:
+            logger.warning(f'Benchmark of {name} failed: {e}')
+            result['error'] = str(e)
+    return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """ Formats a report of benchmark_pilot() as a table. """
+    lines = [f'{report["model"]} ({report["model_type"]}), '
+             f'{report["frames"]} frames of {report["inputs"]} inputs on '
+             f'{report["host"]["machine"]} with '
+             f'{report["host"]["cpu_count"]} cores',
+             f'{"interpreter":<20}{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}'
+             f'{"max ms":>9}{"fps":>9}{"cpu %":>8}{"rss MB":>9}']
+    for r in report['interpreters']:
+        if 'error' in r:
+            lines.append(f'{r["name"]:<20}failed: {r["error"]}')
+            continue
+        lat = r['latency']
+        lines.append(f'{r["name"]:<20}{lat["p50_ms"]:>9.2f}'
+                     f'{lat["p90_ms"]:>9.2f}{lat["p99_ms"]:>9.2f}'
+                     f'{lat["max_ms"]:>9.2f}{r["fps"]:>9.1f}'
+                     f'{r["cpu_percent"]:>8.0f}{r["rss_mb"]:>9.0f}')
+    return '\n'.join(lines)
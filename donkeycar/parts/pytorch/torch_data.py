@@ -1,12 +1,15 @@
 # PyTorch
+import random
+import numpy as np
 import torch
-from torch.utils.data import IterableDataset, DataLoader
+from torch.utils.data import Dataset, DataLoader
 from donkeycar.utils import train_test_split
 from donkeycar.parts.tub_v2 import Tub
 from torchvision import transforms
-from typing import List, Any
-from donkeycar.pipeline.types import TubRecord, TubDataset
-from donkeycar.pipeline.sequence import TubSequence
+from typing import List, Any, Callable, Tuple
+from donkeycar.pipeline.cache import ImageCache
+from donkeycar.pipeline.types import TubRecord, TubDataset, RecordTable, \
+    split_groups
 import pytorch_lightning as pl
 
 
@@ -41,20 +44,70 @@ def get_default_transform(for_video=False, for_inference=False):
     return transform
 
 
-class TorchTubDataset(IterableDataset):
+class SharedTensorCache(object):
+    """
+    Transformed image tensors in shared memory, which is shared with the
+    DataLoader workers, so every image is decoded and transformed only once
+    over all workers and epochs. Rows beyond the memory budget are not
+    cached.
+    """
+
+    def __init__(self, size: int, sample: torch.Tensor, max_bytes: int):
+        """
+        :param size:        number of rows of the dataset
+        :param sample:      a transformed tensor, to size the cache
+        :param max_bytes:   memory budget of the cache
+        """
+        item_bytes = sample.numel() * sample.element_size()
+        self.capacity = min(size, max_bytes // max(item_bytes, 1))
+        self.tensors = torch.empty((self.capacity, *sample.shape),
+                                   dtype=sample.dtype).share_memory_()
+        self.filled = torch.zeros(self.capacity,
+                                  dtype=torch.bool).share_memory_()
+
+    def get(self, row: int, transform: Callable[[], torch.Tensor]) \
+            -> torch.Tensor:
+        """
+        :param row:         row of the dataset
+        :param transform:   creates the tensor if it is not cached
+        :return:            the tensor
+        """
+        if row >= self.capacity:
+            return transform()
+        if not self.filled[row]:
+            self.tensors[row].copy_(transform())
+            self.filled[row] = True
+        return self.tensors[row]
+
+
+def seed_worker(worker_id: int) -> None:
+    """ Seeds numpy and random in each DataLoader worker from the torch
+        seed, which differs per worker and epoch. """
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+class TorchTubDataset(Dataset):
     '''
-    Loads the dataset, and creates a train/test split.
+    Map-style dataset of the records, which can be loaded by several
+    DataLoader workers.
     '''
 
-    def __init__(self, config, records: List[TubRecord], transform=None):
+    def __init__(self, config, records: List[TubRecord], transform=None,
+                 cache_share: float = 1.):
         """Create a PyTorch Tub Dataset
 
         Args:
             config (object): the configuration information
-            records (List[TubRecord]): a list of tub records
+            records (List[TubRecord]): a list of tub records or a RecordTable
             transform (function, optional): a transform to apply to the data
+            cache_share (float, optional): fraction of TORCH_TENSOR_CACHE_MB
+                                           for this dataset, datasets which
+                                           are used together share it
         """
         self.config = config
+        self.records = records
 
         # Handle the transforms
         if transform:
@@ -62,36 +115,39 @@ class TorchTubDataset(IterableDataset):
         else:
             self.transform = get_default_transform()
 
-        self.sequence = TubSequence(records)
-        self.pipeline = self._create_pipeline()
-
-    def _create_pipeline(self):
-        """ This can be overridden if more complicated pipelines are
-            required """
-
-        def y_transform(record: TubRecord):
-            angle: float = record.underlying['user/angle']
-            throttle: float = record.underlying['user/throttle']
-            predictions = torch.tensor([angle, throttle], dtype=torch.float)
-
-            # Normalize to be between [0, 1]
-            # angle and throttle are originally between [-1, 1]
-            predictions = (predictions + 1) / 2
-            return predictions
-
-        def x_transform(record: TubRecord):
-            # Loads the result of Image.open()
-            img_arr = record.image(cached=True, as_nparray=False)
-            return self.transform(img_arr)
-
-        # Build pipeline using the transformations
-        pipeline = self.sequence.build_pipeline(x_transform=x_transform,
-                                                y_transform=y_transform)
-
-        return pipeline
-
-    def __iter__(self):
-        return iter(self.pipeline)
+        # the transformed images in shared memory
+        self.tensor_cache = None
+        max_mb = getattr(config, 'TORCH_TENSOR_CACHE_MB', 0) * cache_share
+        if max_mb > 0 and len(records) > 0:
+            self.tensor_cache = SharedTensorCache(
+                len(records), self.x_transform(records[0]),
+                int(max_mb * 1024 * 1024))
+
+    def y_transform(self, record: TubRecord) -> torch.Tensor:
+        angle: float = record.underlying['user/angle']
+        throttle: float = record.underlying['user/throttle']
+        predictions = torch.tensor([angle, throttle], dtype=torch.float)
+
+        # Normalize to be between [0, 1]
+        # angle and throttle are originally between [-1, 1]
+        predictions = (predictions + 1) / 2
+        return predictions
+
+    def x_transform(self, record: TubRecord) -> torch.Tensor:
+        # Loads the result of Image.open()
+        img_arr = record.image(cached=True, as_nparray=False)
+        return self.transform(img_arr)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        record = self.records[index]
+        if self.tensor_cache is None:
+            x = self.x_transform(record)
+        else:
+            x = self.tensor_cache.get(index, lambda: self.x_transform(record))
+        return x, self.y_transform(record)
 
 
 class TorchTubDataModule(pl.LightningDataModule):
@@ -119,6 +175,7 @@ class TorchTubDataModule(pl.LightningDataModule):
         self.tubs: List[Tub] = [Tub(tub_path, read_only=True)
                                 for tub_path in self.tub_paths]
         self.records: List[TubRecord] = []
+        self.image_cache = ImageCache.from_config(config)
 
     def setup(self, stage=None):
         """Load all the tub data and set up the datasets.
@@ -128,29 +185,64 @@ class TorchTubDataModule(pl.LightningDataModule):
                                         It is used to separate setup logic for trainer.fit 
                                         and trainer.test. Defaults to None.
         """
-        # Loop through all the different tubs and load all the records for each of them
-        for tub in self.tubs:
-            for underlying in tub:
-                record = TubRecord(self.config, tub.base_path,
-                                   underlying=underlying)
-                self.records.append(record)
-
+        if getattr(self.config, 'TRAIN_RECORD_TABLE', False):
+            self.records = RecordTable.from_tubs(self.config, self.tubs,
+                                                 self.image_cache)
+        else:
+            # Loop through all the different tubs and load all the records for each of them
+            for tub in self.tubs:
+                for underlying in tub:
+                    record = TubRecord(self.config, tub.base_path,
+                                       underlying=underlying,
+                                       image_cache=self.image_cache)
+                    self.records.append(record)
+
+        groups = split_groups(
+            self.records, getattr(self.config, 'TRAIN_SPLIT_BY', 'record'),
+            getattr(self.config, 'TRAIN_SPLIT_BLOCK_SIZE', 100))
         train_records, val_records = train_test_split(
-            self.records, test_size=(1. - self.config.TRAIN_TEST_SPLIT))
+            self.records, test_size=(1. - self.config.TRAIN_TEST_SPLIT),
+            seed=getattr(self.config, 'TRAIN_SPLIT_SEED', None),
+            groups=groups)
 
         assert len(val_records) > 0, "Not enough validation data. Add more data"
 
+        # both datasets share the tensor cache budget by their size
+        train_share = len(train_records) / len(self.records)
         self.train_dataset = TorchTubDataset(
-            self.config, train_records, transform=self.transform)
+            self.config, train_records, transform=self.transform,
+            cache_share=train_share)
         self.val_dataset = TorchTubDataset(
-            self.config, val_records, transform=self.transform)
+            self.config, val_records, transform=self.transform,
+            cache_share=1. - train_share)
+        # each persistent worker of the training and the validation loader
+        # gets a copy of the image cache
+        num_workers = getattr(self.config, 'TORCH_NUM_WORKERS', 0)
+        if num_workers > 0:
+            self.image_cache.copies = 2 * num_workers
+
+    def _dataloader(self, dataset: TorchTubDataset, shuffle: bool) \
+            -> DataLoader:
+        # The number of workers defaults to 0 to avoid errors on Macs and Windows
+        # See: https://github.com/rusty1s/pytorch_geometric/issues/366#issuecomment-498022534
+        num_workers = getattr(self.config, 'TORCH_NUM_WORKERS', 0)
+        pin_memory = getattr(self.config, 'TORCH_PIN_MEMORY', None)
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        seed = getattr(self.config, 'TRAIN_SPLIT_SEED', None)
+        generator = torch.Generator()
+        if seed is not None:
+            generator.manual_seed(seed)
+        else:
+            generator.seed()
+        return DataLoader(dataset, batch_size=self.config.BATCH_SIZE,
+                          shuffle=shuffle, num_workers=num_workers,
+                          persistent_workers=num_workers > 0,
+                          pin_memory=pin_memory, worker_init_fn=seed_worker,
+                          generator=generator)
 
     def train_dataloader(self):
-        # The number of workers are set to 0 to avoid errors on Macs and Windows
-        # See: https://github.com/rusty1s/pytorch_geometric/issues/366#issuecomment-498022534
-        return DataLoader(self.train_dataset, batch_size=self.config.BATCH_SIZE, num_workers=0)
+        return self._dataloader(self.train_dataset, shuffle=True)
 
     def val_dataloader(self):
-        # The number of workers are set to 0 to avoid errors on Macs and Windows
-        # See: https://github.com/rusty1s/pytorch_geometric/issues/366#issuecomment-498022534
-        return DataLoader(self.val_dataset, batch_size=self.config.BATCH_SIZE, num_workers=0)
+        return self._dataloader(self.val_dataset, shuffle=False)
@@ -3,7 +3,8 @@ from pathlib import Path
 import torch
 import pytorch_lightning as pl
 from donkeycar.parts.pytorch.torch_data import TorchTubDataModule
-from donkeycar.parts.pytorch.torch_utils import get_model_by_type
+from donkeycar.parts.pytorch.torch_utils import get_model_by_type, \
+    torch_to_onnx
 
 
 def train(cfg, tub_paths, model_output_path, model_type, checkpoint_path=None):
@@ -58,4 +59,8 @@ def train(cfg, tub_paths, model_output_path, model_type, checkpoint_path=None):
         trainer.save_checkpoint(checkpoint_model_path)
         print("Saved final model to {}".format(checkpoint_model_path))
 
+    if getattr(cfg, 'CREATE_ONNX_MODEL', False):
+        torch_to_onnx(model, f'{os.path.splitext(output_path)[0]}.onnx', cfg,
+                      getattr(cfg, 'ONNX_OPSET', 13))
+
     return model.loss_history
@@ -1,5 +1,9 @@
 import os
 
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
 
 def get_model_by_type(model_type, cfg, checkpoint_path=None):
     '''
@@ -29,3 +33,46 @@ def get_model_by_type(model_type, cfg, checkpoint_path=None):
         model.load_from_checkpoint(checkpoint_path)
 
     return model
+
+
+class OnnxPilotGraph(nn.Module):
+    """
+    Wraps a torch pilot for the onnx export, the graph takes the uint8
+    camera images like the keras pilots, does the inference transform and
+    returns angle and throttle in [-1, 1] as two outputs. So the exported
+    model drives as onnx_linear without torch or PIL on the car.
+    """
+
+    def __init__(self, model, input_size=(224, 224),
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super().__init__()
+        self.model = model
+        self.input_size = input_size
+        self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1))
+        self.register_buffer('std', torch.tensor(std).view(1, -1, 1, 1))
+
+    def forward(self, img_in):
+        x = img_in.permute(0, 3, 1, 2).float() / 255.
+        x = F.interpolate(x, size=self.input_size, mode='bilinear',
+                          align_corners=False)
+        x = (x - self.mean) / self.std
+        # convert from being normalized between [0, 1] to [-1, 1]
+        result = self.model(x) * 2 - 1
+        return result[:, 0:1], result[:, 1:2]
+
+
+def torch_to_onnx(model, out_filename, cfg, opset=13):
+    """
+    Exports the torch pilot into an onnx graph which takes the camera images
+    of the config, requires onnx.
+    """
+    print("Exporting model to onnx {}".format(out_filename))
+    graph = OnnxPilotGraph(model).eval()
+    img = torch.zeros((1, cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH),
+                      dtype=torch.uint8)
+    output_names = ['n_outputs0', 'n_outputs1']
+    dynamic_axes = {name: {0: 'batch'} for name in ['img_in'] + output_names}
+    with torch.no_grad():
+        torch.onnx.export(graph, img, out_filename, input_names=['img_in'],
+                          output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset)
@@ -1,13 +1,415 @@
 import atexit
+import io
+import logging
+import mmap
 import os
+import re
+import shutil
+import threading
 import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
 import json
 
 import numpy as np
 from PIL import Image
 
-from donkeycar.parts.datastore_v2 import Manifest, ManifestIterator
+from donkeycar.parts.datastore_v2 import Catalog, CatalogMetadata, \
+    LineIndex, Manifest, ManifestIterator
+
+
+logger = logging.getLogger(__name__)
+
+
+class PackedImages(object):
+    """
+    An append-only store, which packs the encoded images of a catalog into a
+    single blob file instead of writing one file per image. \n
+    The end offset of every image is kept in a LineIndex next to the blob, so
+    image i spans the bytes between the end offsets of image i - 1 and i.
+    Images are read through a memory map of the blob. Records refer to a
+    packed image as '<store name>:<slot>'.
+    """
+    EXTENSION = '.images'
+    INDEX_EXTENSION = '.images_index'
+    SEPARATOR = ':'
+    MAX_READERS = 32
+    _readers = OrderedDict()
+    _readers_lock = threading.Lock()
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.read_only = read_only
+        self.index_path = os.path.splitext(path)[0] + self.INDEX_EXTENSION
+        self.lock = threading.Lock()
+        self.mmap = None
+        self.file = open(path, 'rb' if read_only else 'a+b')
+        self.index = LineIndex(self.index_path, read_only=read_only)
+        if not read_only:
+            self._recover()
+
+    def _recover(self):
+        # The blob is flushed before the index, so after a crash the blob
+        # can hold images which are not indexed. Without an fsync the index
+        # could also point past the end of the blob.
+        size = os.fstat(self.file.fileno()).st_size
+        length = len(self.index)
+        while length > 0 and self.index[length - 1] > size:
+            length -= 1
+        if length < len(self.index):
+            logger.warning(f'Dropping {len(self.index) - length} truncated '
+                           f'images from {self.path}')
+            self.index.truncate(length)
+        if size > self.index.end_offset():
+            self.file.truncate(self.index.end_offset())
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, data):
+        """
+        Appends the encoded image and returns its slot in the store.
+        """
+        if self.read_only:
+            raise RuntimeError(f'PackedImages {self.path} is read-only.')
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+            self.index.append(self.index.end_offset() + len(data))
+            return len(self.index) - 1
+
+    def read(self, slot):
+        """
+        Returns the encoded image bytes of the given slot.
+        """
+        with self.lock:
+            if slot >= len(self.index) and self.read_only:
+                # The store might still be written to, pick up new images
+                self.index.close()
+                self.index = LineIndex(self.index_path, read_only=True)
+            if not 0 <= slot < len(self.index):
+                raise IndexError(f'No image {slot} in {self.path}')
+            start = self.index[slot - 1] if slot > 0 else 0
+            end = self.index[slot]
+            if self.mmap is None or len(self.mmap) < end:
+                if self.mmap is not None:
+                    self.mmap.close()
+                self.mmap = mmap.mmap(self.file.fileno(), length=0,
+                                      access=mmap.ACCESS_READ)
+            return self.mmap[start:end]
+
+    def image_size(self, slot):
+        """ Returns the number of bytes of the image in the slot. """
+        with self.lock:
+            start = self.index[slot - 1] if slot > 0 else 0
+            return self.index[slot] - start
+
+    def sync(self):
+        if not self.read_only:
+            os.fsync(self.file.fileno())
+            self.index.sync()
+
+    def close(self):
+        with self.lock:
+            if self.mmap is not None:
+                self.mmap.close()
+                self.mmap = None
+            self.file.close()
+            self.index.close()
+
+    @classmethod
+    def reader(cls, path):
+        """
+        Returns a shared read-only store. The least recently used stores are
+        closed to bound the number of open files.
+        """
+        with cls._readers_lock:
+            store = cls._readers.pop(path, None)
+            if store is None:
+                store = cls(path, read_only=True)
+                while len(cls._readers) >= cls.MAX_READERS:
+                    _, evicted = cls._readers.popitem(last=False)
+                    evicted.close()
+            cls._readers[path] = store
+            return store
+
+    @classmethod
+    def close_readers(cls):
+        with cls._readers_lock:
+            for store in cls._readers.values():
+                store.close()
+            cls._readers.clear()
+
+    @classmethod
+    def reference(cls, name, slot):
+        return f'{name}{cls.SEPARATOR}{slot}'
+
+    @classmethod
+    def parse_reference(cls, reference):
+        """
+        :return: tuple of store name and slot, None for image file names
+        """
+        name, separator, slot = reference.rpartition(cls.SEPARATOR)
+        if separator and name.endswith(cls.EXTENSION) and slot.isdigit():
+            return name, int(slot)
+        return None
+
+
+def read_image_bytes(base_path, name):
+    """
+    Reads the encoded image of a tub, no matter if it is packed or a file.
+
+    :param base_path:   tub path
+    :param name:        image reference stored in the record
+    :return:            encoded image bytes
+    """
+    images_path = os.path.join(base_path, Tub.images())
+    packed = PackedImages.parse_reference(name)
+    if packed:
+        store_name, slot = packed
+        store = PackedImages.reader(os.path.join(images_path, store_name))
+        return store.read(slot)
+    with open(os.path.join(images_path, name), 'rb') as file:
+        return file.read()
+
+
+def image_file(base_path, name):
+    """
+    Returns what PIL.Image.open() needs to load an image of a tub, i.e. the
+    image path or a file object over the bytes of a packed image.
+
+    :param base_path:   tub path
+    :param name:        image reference stored in the record
+    """
+    if PackedImages.parse_reference(name):
+        return io.BytesIO(read_image_bytes(base_path, name))
+    return os.path.join(base_path, Tub.images(), name)
+
+
+class ColumnCache(object):
+    """
+    A columnar sidecar of the records of a tub, so scalar values can be
+    loaded without parsing every catalog line. \n
+    Every input which is not an image gets a typed NumPy column, images get a
+    column with their references. Inputs which do not fit into a regular
+    array are kept as json strings. Rows without a value are flagged in a
+    mask. The cache remembers the size of each catalog, only catalogs which
+    changed since are read again. Deleted records stay in the cache and are
+    filtered when the columns are loaded.
+    """
+    FILE_NAME = 'columns.npz'
+    MASK_SUFFIX = '.missing'
+    PRIVATE_KEYS = (('_index', 'int'), ('_timestamp_ms', 'int'),
+                    ('_session_id', 'str'), ('_gap', 'boolean'))
+    DTYPES = {'float': np.float64, 'int': np.int64, 'boolean': np.bool_,
+              'str': np.str_, 'image_array': np.str_}
+    FILL_VALUES = {'float': np.nan, 'int': 0, 'boolean': False, 'str': '',
+                   'image_array': ''}
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.path = os.path.join(manifest.base_path, self.FILE_NAME)
+        self.keys = [(key, input_type) for key, input_type
+                     in zip(manifest.inputs, manifest.types)
+                     if input_type != 'image']
+        self.keys += [k for k in self.PRIVATE_KEYS if k[0] not in
+                      manifest.inputs]
+        self._reset()
+
+    def _reset(self):
+        self.columns = dict()
+        self.masks = dict()
+        self.json_keys = set()
+        self.catalogs = list()
+        self.catalog_sizes = list()
+        self.catalog_rows = list()
+
+    def load(self):
+        """
+        Brings the cache up to date with the catalogs and saves it if
+        anything changed.
+        """
+        if not self.catalogs and os.path.exists(self.path):
+            self._read()
+        sizes = [os.path.getsize(os.path.join(self.manifest.base_path, name))
+                 for name in self.manifest.catalog_paths]
+        valid = 0
+        while valid < min(len(self.catalogs), len(sizes)) \
+                and self.catalogs[valid] == self.manifest.catalog_paths[valid] \
+                and self.catalog_sizes[valid] == sizes[valid]:
+            valid += 1
+        if valid == len(self.catalogs) == len(sizes):
+            return self
+        rows = sum(self.catalog_rows[:valid])
+        self._truncate(valid, rows)
+        records = list()
+        for name in self.manifest.catalog_paths[valid:]:
+            size, catalog_records = self._read_catalog(name)
+            self.catalogs.append(name)
+            self.catalog_sizes.append(size)
+            self.catalog_rows.append(len(catalog_records))
+            records += catalog_records
+        self._append(records)
+        self._write()
+        return self
+
+    def _read_catalog(self, name):
+        catalog = Catalog(os.path.join(self.manifest.base_path, name),
+                          read_only=True)
+        # The size of the memory mapped catalog matches the lines we read,
+        # even if a writer appends to it in the meantime.
+        size = catalog.seekable.total_length
+        lines = catalog.seekable.read_from(1)
+        catalog.close()
+        records = list()
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except Exception:
+                logger.warning(f'Ignoring record {line} in {name}')
+        return size, records
+
+    def _truncate(self, catalogs, rows):
+        del self.catalogs[catalogs:]
+        del self.catalog_sizes[catalogs:]
+        del self.catalog_rows[catalogs:]
+        for key in self.columns:
+            self.columns[key] = self.columns[key][:rows]
+        for key in self.masks:
+            self.masks[key] = self.masks[key][:rows]
+
+    def _append(self, records):
+        rows = sum(self.catalog_rows) - len(records)
+        for key, input_type in self.keys:
+            values = [record.get(key) for record in records]
+            missing = np.fromiter((v is None for v in values), dtype=bool,
+                                  count=len(values))
+            if key in self.columns and len(self.columns[key]) == 0:
+                # Nothing to append to and the shape might not fit yet
+                del self.columns[key]
+            column = self._to_column(key, input_type, values, missing)
+            if key in self.columns:
+                column = np.concatenate([self.columns[key], column])
+            self.columns[key] = column
+            if missing.any() or key in self.masks:
+                previous = self.masks.get(key, np.zeros(rows, dtype=bool))
+                self.masks[key] = np.concatenate([previous, missing])
+
+    def _to_column(self, key, input_type, values, missing):
+        if key not in self.json_keys:
+            dtype = self.DTYPES.get(input_type)
+            if input_type in self.FILL_VALUES:
+                fill = self.FILL_VALUES[input_type]
+            else:
+                # vector types, fill with zeros of the shape of the others
+                present = [v for v in values if v is not None]
+                fill = np.zeros_like(present[0]).tolist() if present else 0
+            filled = [fill if m else v for v, m in zip(values, missing)]
+            try:
+                column = np.asarray(filled, dtype=dtype)
+                if column.dtype != object and \
+                        (key not in self.columns
+                         or column.shape[1:] == self.columns[key].shape[1:]):
+                    return column
+            except (ValueError, TypeError):
+                pass
+            # Irregular values are stored as json strings from now on
+            logger.info(f'Storing column {key} as json')
+            self.json_keys.add(key)
+            if key in self.columns:
+                self.columns[key] = np.asarray(
+                    [json.dumps(v) for v in self.columns[key].tolist()])
+        return np.asarray([json.dumps(v) for v in values], dtype=np.str_)
+
+    def _read(self):
+        try:
+            with np.load(self.path) as data:
+                self.catalogs = data['__catalogs__'].tolist()
+                self.catalog_sizes = data['__catalog_sizes__'].tolist()
+                self.catalog_rows = data['__catalog_rows__'].tolist()
+                self.json_keys = set(data['__json_keys__'].tolist())
+                for key, _ in self.keys:
+                    self.columns[key] = data[key]
+                    if key + self.MASK_SUFFIX in data.files:
+                        self.masks[key] = data[key + self.MASK_SUFFIX]
+        except Exception as e:
+            logger.warning(f'Rebuilding column cache {self.path}: {e}')
+            self._reset()
+
+    def _write(self):
+        contents = dict(self.columns)
+        contents.update({key + self.MASK_SUFFIX: mask
+                         for key, mask in self.masks.items()})
+        contents['__catalogs__'] = np.asarray(self.catalogs, dtype=np.str_)
+        contents['__catalog_sizes__'] = np.asarray(self.catalog_sizes,
+                                                   dtype=np.int64)
+        contents['__catalog_rows__'] = np.asarray(self.catalog_rows,
+                                                  dtype=np.int64)
+        contents['__json_keys__'] = np.asarray(sorted(self.json_keys),
+                                               dtype=np.str_)
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as file:
+                np.savez(file, **contents)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            # The cache is only an optimisation, e.g. the tub could be on a
+            # read-only file system.
+            logger.warning(f'Could not save column cache {self.path}: {e}')
+
+    def get(self, keys=None, include_deleted=False):
+        """
+        :param keys:            keys to return, defaults to all cached keys
+        :param include_deleted: also return the deleted records
+        :return:                dictionary of key and column. Columns with
+                                missing values are masked arrays, json
+                                columns are object arrays of the values.
+        """
+        keys = keys or [key for key, _ in self.keys]
+        selection = slice(None)
+        if not include_deleted and self.manifest.deleted_indexes:
+            selection = ~self.manifest.deleted_indexes.mask(
+                self.columns['_index'])
+        columns = dict()
+        for key in keys:
+            column = self.columns[key][selection]
+            if key in self.json_keys:
+                decoded = np.empty(len(column), dtype=object)
+                decoded[:] = [json.loads(v) for v in column.tolist()]
+                column = decoded
+            if key in self.masks:
+                mask = self.masks[key][selection]
+                if column.ndim > 1:
+                    mask = np.broadcast_to(mask.reshape(-1, *[1] * (
+                        column.ndim - 1)), column.shape)
+                column = np.ma.masked_array(column, mask=mask)
+            columns[key] = column
+        return columns
+
+    def records(self, include_deleted=False):
+        """
+        :return:    list of the records like the tub iterator returns them,
+                    but built from the columns
+        """
+        columns = self.get(include_deleted=include_deleted)
+        keys = list(columns.keys())
+        values = [self.to_list(columns[key]) for key in keys]
+        return [{key: value for key, value in zip(keys, row)
+                 if value is not None} for row in zip(*values)]
+
+    @staticmethod
+    def to_list(column):
+        """ Column as list of python values, None where values are missing """
+        values = column.tolist()
+        if np.ma.isMaskedArray(column):
+            missing = np.ma.getmaskarray(column)
+            if column.ndim > 1:
+                missing = missing.reshape(len(column), -1).all(axis=1)
+            values = [None if m else v for v, m in zip(values, missing)]
+        return values
 
 
 class Tub(object):
@@ -17,12 +419,20 @@ class Tub(object):
     """
 
     def __init__(self, base_path, inputs=[], types=[], metadata=[],
-                 max_catalog_len=1000, read_only=False):
+                 max_catalog_len=1000, read_only=False, packed_images=False):
+        """
+        :param packed_images:   write images into one PackedImages store per
+                                catalog instead of one file per image. Both
+                                layouts are always readable.
+        """
         self.base_path = base_path
         self.images_base_path = os.path.join(self.base_path, Tub.images())
         self.inputs = inputs
         self.types = types
         self.metadata = metadata
+        self.packed_images = packed_images
+        self.packed_store = None
+        self.column_cache = None
         self.manifest = Manifest(base_path, inputs=inputs, types=types,
                                  metadata=metadata, max_len=max_catalog_len,
                                  read_only=read_only)
@@ -35,7 +445,25 @@ class Tub(object):
         """
         Can handle various data types including images.
         """
+        index = self.manifest.current_index
+        contents, images = self.prepare_record(record, index)
+        for key, name, image in images:
+            contents[key] = self.write_image(name, image, index)
+        self.manifest.write_record(contents)
+
+    def prepare_record(self, record, index, timestamp_ms=None):
+        """
+        Converts a record into the json contents stored in the catalog. Images
+        are not written here, instead a list of (key, file name, image array)
+        is returned alongside the contents, see write_image().
+
+        :param record:          dictionary of input name and value
+        :param index:           index the record will be written at
+        :param timestamp_ms:    time stamp of the record, defaults to now
+        :return:                tuple of contents and list of images
+        """
         contents = dict()
+        images = list()
         for key, value in record.items():
             if value is None:
                 continue
@@ -58,33 +486,118 @@ class Tub(object):
                     contents[key] = list(value)
                 elif input_type == 'image_array':
                     # Handle image array
-                    image = Image.fromarray(np.uint8(value))
-                    name = Tub._image_file_name(self.manifest.current_index, key)
-                    image_path = os.path.join(self.images_base_path, name)
-                    image.save(image_path)
+                    name = Tub._image_file_name(index, key)
+                    images.append((key, name, value))
                     contents[key] = name
 
         # Private properties
-        contents['_timestamp_ms'] = int(round(time.time() * 1000))
-        contents['_index'] = self.manifest.current_index
+        if timestamp_ms is None:
+            timestamp_ms = int(round(time.time() * 1000))
+        contents['_timestamp_ms'] = timestamp_ms
+        contents['_index'] = index
         contents['_session_id'] = self.manifest.session_id
+        return contents, images
 
-        self.manifest.write_record(contents)
+    def write_image(self, name, image_array, index):
+        """
+        Encodes and stores an image.
+
+        :param name:        file name of the image, see _image_file_name()
+        :param image_array: image
+        :param index:       index of the record the image belongs to
+        :return:            image reference to store in the record
+        """
+        return self.store_image(name, Tub.encode_image(image_array), index)
+
+    def store_image(self, name, data, index):
+        """
+        Stores an encoded image either as file or in the PackedImages store
+        of the catalog the record belongs to.
+
+        :return:            image reference to store in the record
+        """
+        if not self.packed_images:
+            with open(os.path.join(self.images_base_path, name), 'wb') as file:
+                file.write(data)
+            return name
+        store_name = \
+            f'catalog_{index // self.manifest.max_len}{PackedImages.EXTENSION}'
+        if self.packed_store is None or self.packed_store.name != store_name:
+            if self.packed_store is not None:
+                self.packed_store.close()
+            self.packed_store = PackedImages(
+                os.path.join(self.images_base_path, store_name))
+        slot = self.packed_store.append(data)
+        return PackedImages.reference(store_name, slot)
+
+    def read_image(self, name):
+        """
+        :param name:    image reference stored in the record
+        :return:        encoded image bytes
+        """
+        return read_image_bytes(self.base_path, name)
+
+    def image_file(self, name):
+        """
+        :param name:    image reference stored in the record
+        :return:        image path or file object to pass to PIL.Image.open()
+        """
+        return image_file(self.base_path, name)
+
+    @staticmethod
+    def encode_image(image_array):
+        image = Image.fromarray(np.uint8(image_array))
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG')
+        return buffer.getvalue()
+
+    def columns(self, keys=None, include_deleted=False):
+        """
+        Loads record values column-wise from the ColumnCache of the tub, which
+        is created or updated if the catalogs changed.
+
+        :param keys:            keys to return, defaults to all non image
+                                inputs, the image references and the private
+                                record keys
+        :param include_deleted: also return the deleted records
+        :return:                dictionary of key and numpy array, arrays of
+                                keys with missing values are masked
+        """
+        return self._column_cache().get(keys, include_deleted)
+
+    def load_records(self):
+        """
+        Returns the same records as iterating over the tub, but loads them
+        from the ColumnCache.
+        """
+        return self._column_cache().records()
+
+    def _column_cache(self):
+        if self.column_cache is None:
+            self.column_cache = ColumnCache(self.manifest)
+        return self.column_cache.load()
 
     def delete_records(self, record_indexes):
         self.manifest.delete_records(record_indexes)
 
     def delete_last_n_records(self, n):
-        # build ordered list of non-deleted indexes
-        all_alive_indexes = sorted(set(range(self.manifest.current_index))
-                                   - self.manifest.deleted_indexes)
-        to_delete_indexes = all_alive_indexes[-n:]
-        self.manifest.delete_records(to_delete_indexes)
+        with self.manifest.lock:
+            to_delete_indexes = self.manifest.deleted_indexes.last_alive(
+                n, self.manifest.current_index)
+            self.manifest.delete_records(to_delete_indexes)
 
     def restore_records(self, record_indexes):
         self.manifest.restore_records(record_indexes)
 
+    def sync(self):
+        if self.packed_store is not None:
+            self.packed_store.sync()
+        self.manifest.sync()
+
     def close(self):
+        if self.packed_store is not None:
+            self.packed_store.close()
+            self.packed_store = None
         self.manifest.close()
 
     def __iter__(self):
@@ -93,6 +606,36 @@ class Tub(object):
     def __len__(self):
         return self.manifest.__len__()
 
+    def __getitem__(self, item):
+        """
+        Random access by position, i.e. tub[i] is the i-th record the
+        iterator returns and deleted records are skipped. Slices return a
+        list of records.
+        """
+        alive = self.manifest.alive_indexes()
+        if isinstance(item, slice):
+            return self.manifest.read_records(alive[item].tolist())
+        return self.manifest.read_records([int(alive[item])])[0]
+
+    def get_many(self, positions):
+        """
+        :param positions:   positions of records like in __getitem__()
+        :return:            list of records, read in batches per catalog
+        """
+        alive = self.manifest.alive_indexes()
+        return self.manifest.read_records(
+            alive[np.asarray(positions, dtype=np.int64)].tolist())
+
+    def iter_from(self, position):
+        """
+        :param position:    position of the first record like in __getitem__()
+        :return:            iterator over the records from there on
+        """
+        alive = self.manifest.alive_indexes()
+        start_index = int(alive[position]) if position < len(alive) \
+            else self.manifest.current_index
+        return ManifestIterator(self.manifest, start_index=start_index)
+
     @classmethod
     def images(cls):
         return 'images'
@@ -105,13 +648,331 @@ class Tub(object):
         return name
 
 
+def convert_tub_images(base_path, packed=True):
+    """
+    Converts the images of a tub in place between one file per image and one
+    PackedImages store per catalog. Catalogs are rewritten one at a time and
+    the old images are only removed at the end, so an interrupted conversion
+    leaves a readable tub and can simply be run again.
+
+    :param base_path:   tub path
+    :param packed:      True to pack the image files, False to unpack stores
+    :return:            number of converted images
+    """
+    tub = Tub(base_path, read_only=True, packed_images=packed)
+    manifest = tub.manifest
+    image_keys = [key for key, input_type in zip(manifest.inputs,
+                                                 manifest.types)
+                  if input_type == 'image_array']
+    converted = list()
+    for catalog_name in manifest.catalog_paths:
+        catalog_path = os.path.join(manifest.base_path, catalog_name)
+        catalog = Catalog(catalog_path, read_only=True)
+        start_index = catalog.manifest.start_index()
+        lines = catalog.seekable.read_from(1)
+        catalog.close()
+        changed = False
+        for offset, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except Exception:
+                logger.warning(f'Keeping unreadable record {line} as it is')
+                continue
+            index = record.get('_index', start_index + offset)
+            for key in image_keys:
+                name = record.get(key)
+                if name is None \
+                        or bool(PackedImages.parse_reference(name)) == packed:
+                    continue
+                record[key] = tub.store_image(Tub._image_file_name(index, key),
+                                              read_image_bytes(base_path, name),
+                                              index)
+                converted.append(name)
+                changed = True
+            lines[offset] = json.dumps(record, allow_nan=False,
+                                       sort_keys=True)
+        if not changed:
+            continue
+        if tub.packed_store is not None:
+            tub.packed_store.sync()
+        _rewrite_catalog(catalog_path, lines)
+        logger.info(f'Converted images of {catalog_name}')
+    tub.close()
+
+    PackedImages.close_readers()
+    stores = set()
+    for name in converted:
+        packed_image = PackedImages.parse_reference(name)
+        if packed_image:
+            stores.add(packed_image[0])
+        else:
+            os.remove(os.path.join(tub.images_base_path, name))
+    for store_name in stores:
+        store_path = os.path.join(tub.images_base_path, store_name)
+        os.remove(store_path)
+        os.remove(os.path.splitext(store_path)[0]
+                  + PackedImages.INDEX_EXTENSION)
+    return len(converted)
+
+
+def _rewrite_catalog(catalog_path, lines):
+    temp_path = catalog_path + '.tmp'
+    with open(temp_path, 'w', newline='\n') as file:
+        for line in lines:
+            file.write(line + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, catalog_path)
+    # Drop the line offsets of the old contents and let the catalog rebuild
+    # its index
+    metadata = CatalogMetadata(catalog_path)
+    if metadata.line_lengths():
+        metadata.drop_line_lengths()
+    if metadata.index_path.exists():
+        os.remove(metadata.index_path)
+    metadata.close()
+    Catalog(catalog_path).close()
+
+
+def compact_tub(base_path, dry_run=False):
+    """
+    Rewrites a tub without its deleted records and removes their images.
+    Records are renumbered, so the record index keeps matching the position
+    in the catalogs, and the images of the kept records are repacked into
+    one PackedImages store per catalog, so no image is named after an old
+    index which later records could reuse. Records which followed dropped
+    records get '_gap': True, so sequences still break there, see
+    Collator.is_continuous(). Catalogs are streamed one at a time into a
+    temporary tub, see _replace_catalogs() for how it replaces the tub.
+
+    :param base_path:   tub path
+    :param dry_run:     only report what would be removed
+    :return:            dictionary with the number of records and bytes
+                        before and after
+    """
+    if not dry_run:
+        # Fold the deletions log into the manifest, the new manifest starts
+        # without deletions and must not replay the old ones
+        Manifest(base_path).close()
+    tub = Tub(base_path, read_only=True)
+    manifest = tub.manifest
+    deleted = manifest.deleted_indexes
+    # Opening the manifest added a session, keep the stored ones
+    manifest_metadata = json.loads(
+        manifest.manifest_path.read_text().splitlines()[3])
+    image_keys = [key for key, input_type in zip(manifest.inputs,
+                                                 manifest.types)
+                  if input_type == 'image_array']
+    report = dict(records=manifest.current_index, kept_records=0,
+                  catalog_bytes=0, kept_catalog_bytes=0, image_bytes=0,
+                  kept_image_bytes=0)
+    temp_path = os.path.join(base_path, '.compact')
+    first_number = _next_catalog_number(base_path)
+    output = None
+    store = None
+    if not dry_run:
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        output = Tub(temp_path, manifest.inputs, manifest.types,
+                     list(manifest.metadata.items()),
+                     max_catalog_len=manifest.max_len)
+    gap = False
+    for catalog_name in manifest.catalog_paths:
+        catalog = Catalog(os.path.join(manifest.base_path, catalog_name),
+                          read_only=True)
+        start_index = catalog.manifest.start_index()
+        lines = catalog.seekable.read_from(1)
+        catalog.close()
+        kept = list()
+        for offset, line in enumerate(lines):
+            report['catalog_bytes'] += len(line) + 1
+            try:
+                record = json.loads(line)
+            except Exception:
+                logger.warning(f'Dropping unreadable record {line}')
+                gap = True
+                continue
+            is_deleted = start_index + offset in deleted
+            for key in image_keys:
+                name = record.get(key)
+                if name is None:
+                    continue
+                size = _image_size(base_path, name)
+                report['image_bytes'] += size
+                if is_deleted:
+                    continue
+                report['kept_image_bytes'] += size
+                if output is not None:
+                    # Stores are named after the catalogs they will become
+                    number = first_number \
+                        + report['kept_records'] // manifest.max_len
+                    store_name = f'catalog_{number}{PackedImages.EXTENSION}'
+                    if store is None or store.name != store_name:
+                        if store is not None:
+                            store.close()
+                        store = PackedImages(
+                            os.path.join(output.images_base_path, store_name))
+                    slot = store.append(read_image_bytes(base_path, name))
+                    record[key] = PackedImages.reference(store_name, slot)
+            if is_deleted:
+                gap = True
+                continue
+            record['_index'] = report['kept_records']
+            if gap:
+                record['_gap'] = True
+                gap = False
+            report['kept_records'] += 1
+            report['kept_catalog_bytes'] += \
+                len(json.dumps(record, allow_nan=False, sort_keys=True)) + 1
+            kept.append(record)
+        if output is not None:
+            output.manifest.write_records(kept)
+    tub.close()
+    if dry_run:
+        return report
+
+    if store is not None:
+        store.close()
+    output.manifest.replace_manifest_metadata(manifest_metadata)
+    output.close()
+    PackedImages.close_readers()
+    _replace_catalogs(base_path, manifest, temp_path, first_number,
+                      image_keys)
+    shutil.rmtree(temp_path)
+    return report
+
+
+def _image_size(base_path, name):
+    images_path = os.path.join(base_path, Tub.images())
+    packed = PackedImages.parse_reference(name)
+    if packed:
+        store_name, slot = packed
+        return PackedImages.reader(os.path.join(images_path, store_name)) \
+            .image_size(slot)
+    path = os.path.join(images_path, name)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _next_catalog_number(base_path):
+    """ The first catalog number which no catalog or store of the tub uses,
+        including ones left behind by an interrupted compaction. """
+    numbers = [-1]
+    for directory in (base_path, os.path.join(base_path, Tub.images())):
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            match = re.match(r'catalog_(\d+)\.', name)
+            if match:
+                numbers.append(int(match.group(1)))
+    return max(numbers) + 1
+
+
+def _replace_catalogs(base_path, manifest, temp_path, first_number,
+                      image_keys):
+    """
+    Replaces the catalogs and images of the tub with the ones of the
+    compacted tub in temp_path. The new catalogs and stores are moved in
+    under catalog numbers from first_number on, which no file of the tub
+    uses. Atomically replacing manifest.json then switches the tub to them
+    and only after that the old files are removed, reading the old
+    catalogs once more for their images. An interrupted compaction leaves
+    either the old or the new tub, plus unreferenced files.
+    """
+    images_path = os.path.join(base_path, Tub.images())
+    temp_manifest_path = os.path.join(temp_path, 'manifest.json')
+    manifest_lines = Path(temp_manifest_path).read_text().splitlines()
+    catalog_metadata = json.loads(manifest_lines[4])
+    new_catalogs = list()
+    for number, catalog_name in enumerate(catalog_metadata['paths'],
+                                          first_number):
+        new_name = f'catalog_{number}.catalog'
+        old_path = os.path.join(temp_path, catalog_name)
+        new_path = os.path.join(base_path, new_name)
+        for source, target in (
+                (old_path, new_path),
+                (CatalogMetadata.path_of(old_path),
+                 CatalogMetadata.path_of(new_path)),
+                (CatalogMetadata.index_path_of(old_path),
+                 CatalogMetadata.index_path_of(new_path))):
+            if os.path.exists(source):
+                os.replace(source, target)
+        new_catalogs.append(new_name)
+    temp_images_path = os.path.join(temp_path, Tub.images())
+    for name in os.listdir(temp_images_path):
+        os.replace(os.path.join(temp_images_path, name),
+                   os.path.join(images_path, name))
+    _fsync_directory(images_path)
+    _fsync_directory(base_path)
+
+    # The switch over
+    catalog_metadata['paths'] = new_catalogs
+    manifest_lines[4] = json.dumps(catalog_metadata)
+    new_manifest_path = os.path.join(base_path, 'manifest.json.tmp')
+    with open(new_manifest_path, 'w', newline='\n') as file:
+        file.write('\n'.join(manifest_lines) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(new_manifest_path, os.path.join(base_path, 'manifest.json'))
+    _fsync_directory(base_path)
+
+    # Old catalogs, images and derived files, one catalog at a time
+    old_files = [os.path.join(base_path, ColumnCache.FILE_NAME)]
+    stores = set()
+    for catalog_name in manifest.catalog_paths:
+        catalog_path = os.path.join(base_path, catalog_name)
+        catalog = Catalog(catalog_path, read_only=True)
+        lines = catalog.seekable.read_from(1)
+        catalog.close()
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except Exception:
+                continue
+            for key in image_keys:
+                name = record.get(key)
+                if name is None:
+                    continue
+                packed = PackedImages.parse_reference(name)
+                if packed:
+                    stores.add(packed[0])
+                else:
+                    image_path = os.path.join(images_path, name)
+                    if os.path.exists(image_path):
+                        os.remove(image_path)
+        old_files += [catalog_path,
+                      str(CatalogMetadata.path_of(catalog_path)),
+                      str(CatalogMetadata.index_path_of(catalog_path))]
+    for store_name in stores:
+        store_path = os.path.join(images_path, store_name)
+        old_files += [store_path, os.path.splitext(store_path)[0]
+                      + PackedImages.INDEX_EXTENSION]
+    for path in old_files:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _fsync_directory(path):
+    """ Makes renames within the directory durable, where supported. """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
 class TubWriter(object):
     """
     A Donkey part, which can write records to the datastore.
     """
     def __init__(self, base_path, inputs=[], types=[], metadata=[],
-                 max_catalog_len=1000):
-        self.tub = Tub(base_path, inputs, types, metadata, max_catalog_len)
+                 max_catalog_len=1000, packed_images=False):
+        self.tub = Tub(base_path, inputs, types, metadata, max_catalog_len,
+                       packed_images=packed_images)
 
     def run(self, *args):
         assert len(self.tub.inputs) == len(args), \
@@ -120,6 +981,9 @@ class TubWriter(object):
         self.tub.write_record(record)
         return self.tub.manifest.current_index
 
+    def delete_last_n_records(self, n):
+        self.tub.delete_last_n_records(n)
+
     def __iter__(self):
         return self.tub.__iter__()
 
@@ -130,6 +994,161 @@ class TubWriter(object):
         self.close()
 
 
+class AsyncTubWriter(TubWriter):
+    """
+    A Donkey part, which writes records to the datastore in the background.
+    run() only puts the record onto a bounded queue. A writer thread takes
+    all queued records, encodes their images in a small thread pool and
+    appends them to the catalog as one group, so the drive loop does not
+    wait for JPEG encoding or disk writes.
+    """
+    OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, base_path, inputs=[], types=[], metadata=[],
+                 max_catalog_len=1000, packed_images=False, queue_size=100,
+                 overflow='block', encoder_threads=2, max_batch=50,
+                 fsync_interval=None):
+        """
+        :param queue_size:      maximum number of records waiting to be
+                                written
+        :param overflow:        what run() does if the queue is full, one of
+                                'block' (wait for the writer), 'drop_oldest'
+                                or 'drop_newest'
+        :param encoder_threads: number of threads encoding images
+        :param max_batch:       maximum number of records committed at once
+        :param fsync_interval:  None to only flush the catalog after each
+                                commit, 0 to also fsync after each commit or
+                                seconds between two fsyncs
+        """
+        assert overflow in self.OVERFLOW_POLICIES, \
+            f'Overflow policy must be one of {self.OVERFLOW_POLICIES}'
+        super().__init__(base_path, inputs, types, metadata, max_catalog_len,
+                         packed_images)
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.max_batch = max_batch
+        self.fsync_interval = fsync_interval
+        self.dropped = 0
+        # whether the writer thread is committing a batch
+        self.writing = False
+        self.last_sync = time.time()
+        self.condition = threading.Condition()
+        self.running = True
+        self.encoder = ThreadPoolExecutor(max_workers=encoder_threads)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def run(self, *args):
+        """
+        :return:    tuple of the number of written records, the number of
+                    records waiting in the queue and the number of dropped
+                    records
+        """
+        assert len(self.tub.inputs) == len(args), \
+            f'Expected {len(self.tub.inputs)} inputs but received {len(args)}'
+        record = dict(zip(self.tub.inputs, args))
+        timestamp_ms = int(round(time.time() * 1000))
+        with self.condition:
+            while len(self.queue) >= self.queue_size and self.running:
+                if self.overflow == 'block':
+                    self.condition.wait()
+                elif self.overflow == 'drop_oldest':
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    break
+            else:
+                self.queue.append((record, timestamp_ms))
+            self.condition.notify_all()
+            queue_depth = len(self.queue)
+        return self.tub.manifest.current_index, queue_depth, self.dropped
+
+    def _write_loop(self):
+        while True:
+            with self.condition:
+                while not self.queue and self.running:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+                batch = [self.queue.popleft() for _ in
+                         range(min(self.max_batch, len(self.queue)))]
+                self.writing = True
+                self.condition.notify_all()
+            try:
+                self._commit(batch)
+            except Exception as e:
+                logger.error(f'Failed writing {len(batch)} records: {e}')
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def delete_last_n_records(self, n):
+        """
+        Deletes the last n records, including the ones which are still
+        queued. Those are dropped and the batch which is being written is
+        committed first, otherwise older records would be deleted instead.
+        """
+        with self.condition:
+            queued = min(n, len(self.queue))
+            for _ in range(queued):
+                self.queue.pop()
+            while self.writing:
+                self.condition.wait()
+            if n > queued:
+                self.tub.delete_last_n_records(n - queued)
+            self.condition.notify_all()
+
+    def _commit(self, batch):
+        manifest = self.tub.manifest
+        records = list()
+        images = list()
+        for offset, (record, timestamp_ms) in enumerate(batch):
+            index = manifest.current_index + offset
+            contents, record_images = \
+                self.tub.prepare_record(record, index, timestamp_ms)
+            records.append(contents)
+            images += [(index, contents, key, name,
+                        self.encoder.submit(Tub.encode_image, image))
+                       for key, name, image in record_images]
+        failed = set()
+        # Images are stored in record order, packed stores are append-only
+        for index, contents, key, name, future in images:
+            try:
+                contents[key] = self.tub.store_image(name, future.result(),
+                                                     index)
+            except Exception as e:
+                logger.error(f'Failed writing image of record {index}: {e}')
+                failed.add(index)
+        manifest.write_records(records)
+        # Records keep their place to maintain the index continuity, but
+        # the ones without image are hidden from the readers.
+        if failed:
+            manifest.delete_records(failed)
+        self._sync()
+
+    def _sync(self):
+        if self.fsync_interval is None:
+            return
+        now = time.time()
+        if now - self.last_sync >= self.fsync_interval:
+            self.tub.sync()
+            self.last_sync = now
+
+    def close(self):
+        """ Writes all queued records, then closes the tub. """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        self.encoder.shutdown()
+        if self.fsync_interval is not None:
+            self.tub.sync()
+        super().close()
+
+
 class TubWiper:
     """
     Donkey part which deletes a bunch of records from the end of tub.
@@ -2,6 +2,7 @@ import cv2
 import numpy as np
 import logging
 import imgaug.augmenters as iaa
+from typing import Optional, Sequence, Tuple
 from donkeycar.config import Config
 
 
@@ -24,6 +25,31 @@ class Augmentations(object):
                                 keep_size=keep_size)
         return augmentation
 
+    @classmethod
+    def trapezoidal_region(cls, lower_left, lower_right, upper_left,
+                           upper_right, min_y, max_y,
+                           shape: Tuple[int, ...]) -> np.ndarray:
+        """
+        Returns the trapezoidal region of interest as an uint8 array of the
+        image shape which is 1 inside and 0 outside of the region.
+        """
+        mask = np.zeros(shape, dtype=np.uint8)
+        # # # # # # # # # # # # #
+        #       ul     ur          min_y
+        #
+        #
+        #
+        #    ll             lr     max_y
+        points = [
+            [upper_left, min_y],
+            [upper_right, min_y],
+            [lower_right, max_y],
+            [lower_left, max_y]
+        ]
+        cv2.fillConvexPoly(mask, np.array(points, dtype=np.int32),
+                           [1] * (shape[2] if len(shape) > 2 else 1))
+        return mask
+
     @classmethod
     def trapezoidal_mask(cls, lower_left, lower_right, upper_left, upper_right,
                          min_y, max_y):
@@ -32,31 +58,19 @@ class Augmentations(object):
         Especially useful in filtering out uninteresting features from an
         input image.
         """
+        masks = dict()
+
         def _transform_images(images, random_state, parents, hooks):
-            # Transform a batch of images
+            # Transform a batch of images, the mask is computed once per shape
             transformed = []
-            mask = None
             for image in images:
+                mask = masks.get(image.shape)
                 if mask is None:
-                    mask = np.zeros(image.shape, dtype=np.int32)
-                    # # # # # # # # # # # # #
-                    #       ul     ur          min_y
-                    #
-                    #
-                    #
-                    #    ll             lr     max_y
-                    points = [
-                        [upper_left, min_y],
-                        [upper_right, min_y],
-                        [lower_right, max_y],
-                        [lower_left, max_y]
-                    ]
-                    cv2.fillConvexPoly(mask, np.array(points, dtype=np.int32),
-                                       [255, 255, 255])
-                    mask = np.asarray(mask, dtype='bool')
-
-                masked = np.multiply(image, mask)
-                transformed.append(masked)
+                    mask = cls.trapezoidal_region(
+                        lower_left, lower_right, upper_left, upper_right,
+                        min_y, max_y, image.shape)
+                    masks[image.shape] = mask
+                transformed.append(np.multiply(image, mask))
 
             return transformed
 
@@ -70,11 +84,118 @@ class Augmentations(object):
         return augmentation
 
 
+class BatchAugmentations(object):
+    """
+    Fast backend of ImageAugmentation which applies the augmentations with
+    cv2 and NumPy to whole uint8 batches of shape (B, H, W, C). The masks
+    are precomputed per image shape, MULTIPLY uses lookup tables and BLUR
+    the same cv2 kernels as imgaug.
+    """
+    SUPPORTED = ('CROP', 'TRAPEZE', 'MULTIPLY', 'BLUR')
+
+    def __init__(self, aug_list: Sequence[str], config: Config,
+                 seed: Optional[int] = None) -> None:
+        """
+        :param aug_list:    augmentation names like in AUGMENTATIONS
+        :param config:      donkey config
+        :param seed:        seed of the random augmentations
+        """
+        for aug_type in aug_list:
+            if aug_type not in self.SUPPORTED:
+                raise ValueError(f'Augmentation {aug_type} not supported, '
+                                 f'use one of {self.SUPPORTED}')
+        self.aug_list = list(aug_list)
+        self.config = config
+        self.rng = np.random.default_rng(seed)
+        self.masks = dict()
+        self.values = np.arange(256, dtype=np.float32)
+
+    def run(self, images: np.ndarray) -> np.ndarray:
+        """
+        :param images:  uint8 batch of shape (B, H, W, C) or (B, H, W) for
+                        grayscale images, it is not modified
+        :return:        augmented uint8 batch of the same shape
+        """
+        images = np.array(images, dtype=np.uint8)
+        # the augmentations work on images with a channel axis
+        grey = images.ndim == 3
+        if grey:
+            images = images[..., np.newaxis]
+        for aug_type in self.aug_list:
+            getattr(self, '_' + aug_type.lower())(images)
+        return images[..., 0] if grey else images
+
+    def _crop(self, images: np.ndarray) -> None:
+        """ Crops and resizes back to the image size like iaa.Crop, which
+            uses area interpolation for enlarging. """
+        cfg = self.config
+        _, h, w, _ = images.shape
+        top, bottom = cfg.ROI_CROP_TOP, h - cfg.ROI_CROP_BOTTOM
+        left, right = cfg.ROI_CROP_LEFT, w - cfg.ROI_CROP_RIGHT
+        for image in images:
+            cropped = cv2.resize(image[top:bottom, left:right], (w, h),
+                                 interpolation=cv2.INTER_AREA)
+            image[:] = cropped.reshape(image.shape)
+
+    def _trapeze(self, images: np.ndarray) -> None:
+        shape = images.shape[1:]
+        mask = self.masks.get(shape)
+        if mask is None:
+            cfg = self.config
+            mask = Augmentations.trapezoidal_region(
+                cfg.ROI_TRAPEZE_LL, cfg.ROI_TRAPEZE_LR, cfg.ROI_TRAPEZE_UL,
+                cfg.ROI_TRAPEZE_UR, cfg.ROI_TRAPEZE_MIN_Y,
+                cfg.ROI_TRAPEZE_MAX_Y, shape)
+            self.masks[shape] = mask
+        np.multiply(images, mask, out=images)
+
+    def _multiply(self, images: np.ndarray) -> None:
+        low, high = getattr(self.config, 'AUG_MULTIPLY_RANGE', (0.5, 1.5))
+        factors = self.rng.uniform(low, high, len(images)).astype(np.float32)
+        for image, factor in zip(images, factors):
+            lut = np.clip(self.values * factor, 0, 255).astype(np.uint8)
+            image[:] = cv2.LUT(image, lut).reshape(image.shape)
+
+    def _blur(self, images: np.ndarray) -> None:
+        low, high = getattr(self.config, 'AUG_BLUR_RANGE', (0.0, 3.0))
+        sigmas = self.rng.uniform(low, high, len(images))
+        for image, sigma in zip(images, sigmas):
+            # same kernel size as imgaug
+            if sigma <= 1e-3:
+                continue
+            ksize = int(max(3.3 * sigma if sigma < 3.0 else
+                            2.9 * sigma if sigma < 5.0 else 2.6 * sigma, 5))
+            ksize += 1 - ksize % 2
+            blurred = cv2.GaussianBlur(image, (ksize, ksize), sigmaX=sigma,
+                                       sigmaY=sigma,
+                                       borderType=cv2.BORDER_REFLECT_101)
+            image[:] = blurred.reshape(image.shape)
+
+
 class ImageAugmentation:
-    def __init__(self, cfg, key):
+    def __init__(self, cfg, key, backend: Optional[str] = None,
+                 seed: Optional[int] = None):
+        """
+        :param cfg:     donkey config
+        :param key:     config key of the augmentation list
+        :param backend: 'cv2' or 'imgaug', defaults to AUG_BACKEND
+        :param seed:    seed of the random augmentations, defaults to
+                        AUG_SEED
+        """
         aug_list = getattr(cfg, key, [])
-        augmentations = [ImageAugmentation.create(a, cfg) for a in aug_list]
-        self.augmentations = iaa.Sequential(augmentations)
+        self.backend = backend or getattr(cfg, 'AUG_BACKEND', 'cv2')
+        if seed is None:
+            seed = getattr(cfg, 'AUG_SEED', None)
+        if self.backend == 'cv2':
+            self.augmentations = BatchAugmentations(aug_list, cfg, seed)
+        elif self.backend == 'imgaug':
+            augmentations = [ImageAugmentation.create(a, cfg)
+                             for a in aug_list]
+            self.augmentations = iaa.Sequential(augmentations)
+            if seed is not None:
+                self.augmentations.seed_(seed)
+        else:
+            raise ValueError(f'Unknown augmentation backend {self.backend}')
 
     @classmethod
     def create(cls, aug_type: str, config: Config) -> iaa.meta.Augmenter:
@@ -115,7 +236,19 @@ class ImageAugmentation:
             logger.info(f'Creating augmentation {aug_type} {interval}')
             return iaa.GaussianBlur(sigma=interval)
 
+    def run_batch(self, images: np.ndarray) -> np.ndarray:
+        """
+        Augments a batch of images.
+        :param images:  uint8 array of shape (B, H, W, C) or (B, H, W)
+        :return:        augmented uint8 array of the same shape
+        """
+        if self.backend == 'cv2':
+            return self.augmentations.run(images)
+        return np.array(self.augmentations.augment_images(images))
+
     # Parts interface
     def run(self, img_arr):
+        if self.backend == 'cv2':
+            return self.augmentations.run(img_arr[np.newaxis])[0]
         aug_img_arr = self.augmentations.augment_image(img_arr)
         return aug_img_arr
@@ -0,0 +1,423 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class SpillFile(object):
+    """
+    Second cache tier which appends decoded image arrays to an anonymous
+    file in a local directory and reads them back through a memory map, so
+    later epochs skip the jpeg decoding. The file is removed when closed.
+    """
+
+    def __init__(self, directory: Optional[str] = None) -> None:
+        """
+        :param directory:   directory of the spill file, defaults to the
+                            system temp directory
+        """
+        self.file = tempfile.TemporaryFile(dir=directory, suffix='.spill')
+        self.entries: Dict[Hashable, Tuple[int, Tuple[int, ...], np.dtype]] \
+            = dict()
+        self.size = 0
+        self.map: Optional[np.memmap] = None
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def put(self, key: Hashable, arr: np.ndarray) -> None:
+        if key in self.entries:
+            return
+        arr = np.ascontiguousarray(arr)
+        self.file.seek(self.size)
+        self.file.write(arr.tobytes())
+        self.entries[key] = (self.size, arr.shape, arr.dtype)
+        self.size += arr.nbytes
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        offset, shape, dtype = entry
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if self.map is None or offset + nbytes > len(self.map):
+            # the file has grown since it was mapped
+            self.file.flush()
+            self.map = np.memmap(self.file, dtype=np.uint8, mode='r',
+                                 shape=(self.size,))
+        # copy, so callers can modify the array and the map can be replaced
+        return np.frombuffer(self.map[offset:offset + nbytes], dtype=dtype) \
+            .reshape(shape).copy()
+
+    def close(self) -> None:
+        self.map = None
+        self.entries.clear()
+        self.file.close()
+
+
+class ImageCache(object):
+    """
+    Least recently used cache of decoded images which is shared by all
+    records of a dataset and bounded by a memory budget. Evicted images are
+    optionally kept in a SpillFile.
+    """
+
+    def __init__(self, max_bytes: int,
+                 spill_dir: Optional[str] = None) -> None:
+        """
+        :param max_bytes:   memory budget of the decoded images, 0 disables
+                            the in memory tier
+        :param spill_dir:   directory for spilling evicted images to disk,
+                            no spilling if None
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill: Optional[SpillFile] = None
+        self.entries: 'OrderedDict[Hashable, np.ndarray]' = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # number of copies in other processes, e.g. DataLoader workers, the
+        # budget is divided between
+        self.copies = 1
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> 'ImageCache':
+        """
+        Creates the cache from CACHE_IMAGES_MB and CACHE_IMAGES_SPILL_DIR.
+        :param config:  donkey config
+        :return:        the image cache
+        """
+        max_mb = getattr(config, 'CACHE_IMAGES_MB', 1024)
+        spill_dir = getattr(config, 'CACHE_IMAGES_SPILL_DIR', None)
+        return cls(int(max_mb * 1024 * 1024), spill_dir)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getstate__(self) -> Dict:
+        """ Copies in other processes, e.g. DataLoader workers, start with
+            an empty cache and their share of the budget. """
+        return dict(max_bytes=self.max_bytes // max(self.copies, 1),
+                    spill_dir=self.spill_dir)
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__init__(state['max_bytes'], state['spill_dir'])
+
+    def get(self, key: Hashable, loader: Callable[[], Optional[np.ndarray]]) \
+            -> Optional[np.ndarray]:
+        """
+        Returns the cached image or loads and caches it.
+        :param key:     cache key of the image
+        :param loader:  function which loads the image if it is not cached
+        :return:        the image array
+        """
+        with self.lock:
+            arr = self.entries.get(key)
+            if arr is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return arr
+            if self.spill is not None:
+                arr = self.spill.get(key)
+            if arr is not None:
+                self.spill_hits += 1
+                self._put(key, arr)
+                return arr
+            self.misses += 1
+        # decode outside of the lock, so threads can decode in parallel
+        arr = loader()
+        if arr is not None:
+            with self.lock:
+                self._put(key, arr)
+        return arr
+
+    def _put(self, key: Hashable, arr: np.ndarray) -> None:
+        if key in self.entries:
+            return
+        self.entries[key] = arr
+        self.size += arr.nbytes
+        while self.size > self.max_bytes and self.entries:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+            self.evictions += 1
+            if self.spill_dir is not None:
+                if self.spill is None:
+                    self.spill = SpillFile(self.spill_dir)
+                self.spill.put(evicted_key, evicted)
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the counters, sizes are in bytes. """
+        with self.lock:
+            return dict(hits=self.hits, spill_hits=self.spill_hits,
+                        misses=self.misses, evictions=self.evictions,
+                        images=len(self.entries), size=self.size,
+                        spilled_images=len(self.spill) if self.spill else 0,
+                        spilled_size=self.spill.size if self.spill else 0)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+
+    def __repr__(self) -> str:
+        stats = self.stats()
+        lookups = stats['hits'] + stats['spill_hits'] + stats['misses']
+        hit_rate = (stats['hits'] + stats['spill_hits']) / max(lookups, 1)
+        return f'ImageCache(images={stats["images"]}, ' \
+               f'size={stats["size"] / 1024 ** 2:.1f}MB, ' \
+               f'hit_rate={hit_rate:.1%}, ' \
+               f'spilled_images={stats["spilled_images"]})'
+
+
+class ImageSnapshot(object):
+    """
+    Memory mapped snapshot of the decoded and transformed images of a
+    dataset. The snapshot is stored in a directory named by a hash of the
+    tubs, the records and the config entries which change the images, so
+    repeated trainings on the same data only run the random augmentations.
+    It also keeps the labels of the models trained on it. The snapshot is
+    used as the image cache of the records.
+    """
+    IMAGES = 'images.npy'
+    KEYS = 'keys.json'
+    # config entries which change the decoded and transformed images
+    CONFIG_KEYS = ('IMAGE_W', 'IMAGE_H', 'IMAGE_DEPTH', 'TRANSFORMATIONS')
+    CONFIG_PREFIX = 'ROI_'
+    # number of images decoded in parallel
+    CHUNK_SIZE = 256
+
+    def __init__(self, path: str, transformation=None) -> None:
+        """
+        :param path:            snapshot directory
+        :param transformation:  transformation applied to images which are
+                                not in the snapshot
+        """
+        self.path = path
+        self.transformation = transformation
+        self.images = np.load(os.path.join(path, self.IMAGES), mmap_mode='r')
+        with open(os.path.join(path, self.KEYS)) as f:
+            self.rows = {tuple(key): row
+                         for row, key in enumerate(json.load(f))}
+        self.labels: Dict[str, List[np.ndarray]] = dict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def record_key(record) -> Tuple[str, str]:
+        return record.base_path, record.underlying['cam/image_array']
+
+    @staticmethod
+    def flatten(records) -> List:
+        """ Returns the records of a list of records or sequences. """
+        return [r for rec in records
+                for r in (rec if isinstance(rec, list) else [rec])]
+
+    @classmethod
+    def hash_of(cls, config, records) -> str:
+        """
+        Hashes the image config, the manifests of the tubs and the images
+        of the records.
+        :param config:  donkey config
+        :param records: list of TubRecord
+        :return:        hex digest
+        """
+        sha = hashlib.sha1()
+        image_config = {key: getattr(config, key) for key in dir(config)
+                        if key in cls.CONFIG_KEYS
+                        or key.startswith(cls.CONFIG_PREFIX)}
+        sha.update(json.dumps(image_config, sort_keys=True,
+                              default=str).encode())
+        keys = [cls.record_key(r) for r in records]
+        for base_path in sorted(set(key[0] for key in keys)):
+            manifest_path = os.path.join(base_path, 'manifest.json')
+            sha.update(base_path.encode())
+            with open(manifest_path, 'rb') as f:
+                sha.update(f.read())
+        sha.update(json.dumps(keys).encode())
+        return sha.hexdigest()
+
+    @classmethod
+    def open_or_create(cls, path: str, config, records, transformation) \
+            -> 'ImageSnapshot':
+        """
+        Opens the snapshot of the records or creates it.
+        :param path:            directory of the snapshots
+        :param config:          donkey config
+        :param records:         list of TubRecord or of sequences of them
+        :param transformation:  ImageAugmentation of the TRANSFORMATIONS
+        :return:                the snapshot
+        """
+        records = cls.flatten(records)
+        snapshot_path = os.path.join(path, cls.hash_of(config, records))
+        if os.path.exists(os.path.join(snapshot_path, cls.KEYS)):
+            logger.info(f'Using image snapshot {snapshot_path}')
+        else:
+            cls.create(snapshot_path, records, transformation)
+        return cls(snapshot_path, transformation)
+
+    @classmethod
+    def create(cls, snapshot_path: str, records, transformation) -> None:
+        """
+        Decodes and transforms the images of the records into the snapshot.
+        :param snapshot_path:   snapshot directory
+        :param records:         list of TubRecord
+        :param transformation:  ImageAugmentation of the TRANSFORMATIONS
+        """
+        logger.info(f'Creating image snapshot {snapshot_path} of '
+                    f'{len(records)} records')
+        unique = OrderedDict((cls.record_key(r), r) for r in records)
+        temp_path = snapshot_path + '.tmp'
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+        keys = list()
+        images = None
+        # decoding releases the gil, the transformations run in this thread
+        items = list(unique.items())
+        with ThreadPoolExecutor() as executor:
+            for start in range(0, len(items), cls.CHUNK_SIZE):
+                chunk = items[start:start + cls.CHUNK_SIZE]
+                decoded = executor.map(
+                    lambda item: item[1].image(cached=False), chunk)
+                for (key, _), img_arr in zip(chunk, decoded):
+                    if img_arr is None:
+                        continue
+                    if transformation is not None:
+                        img_arr = transformation.run(img_arr)
+                    if images is None:
+                        images = np.lib.format.open_memmap(
+                            os.path.join(temp_path, cls.IMAGES), mode='w+',
+                            dtype=img_arr.dtype,
+                            shape=(len(unique),) + img_arr.shape)
+                    images[len(keys)] = img_arr
+                    keys.append(key)
+        if images is None:
+            raise ValueError('No images to snapshot')
+        images.flush()
+        del images
+        if len(keys) < len(unique):
+            # drop the rows of unreadable images
+            images = np.load(os.path.join(temp_path, cls.IMAGES),
+                             mmap_mode='r')[:len(keys)]
+            np.save(os.path.join(temp_path, 'images_.npy'), images)
+            del images
+            os.replace(os.path.join(temp_path, 'images_.npy'),
+                       os.path.join(temp_path, cls.IMAGES))
+        with open(os.path.join(temp_path, cls.KEYS), 'w') as f:
+            json.dump(keys, f)
+        if os.path.exists(snapshot_path):
+            shutil.rmtree(snapshot_path)
+        os.replace(temp_path, snapshot_path)
+
+    def attach(self, records) -> None:
+        """ Makes the snapshot the image cache of the records. Record tables
+            have one image cache for all rows. """
+        if hasattr(records, 'image_cache'):
+            records.image_cache = self
+            return
+        for record in self.flatten(records):
+            record.image_cache = self
+
+    def get(self, key: Hashable, loader: Callable[[], Optional[np.ndarray]]) \
+            -> Optional[np.ndarray]:
+        """
+        Returns the transformed image, images which are not in the snapshot
+        are loaded and transformed.
+        :param key:     record key of the image
+        :param loader:  function which loads the image
+        :return:        the image array
+        """
+        row = self.rows.get(key)
+        if row is not None:
+            self.hits += 1
+            # copy, so callers can modify the image
+            return np.array(self.images[row])
+        self.misses += 1
+        img_arr = loader()
+        if img_arr is not None and self.transformation is not None:
+            img_arr = self.transformation.run(img_arr)
+        return img_arr
+
+    def load_labels(self, model, config, records) -> bool:
+        """
+        Loads the labels of the model, these are the outputs of
+        model.y_transform() with one array per output in the row order of
+        the snapshot. The labels are stored next to the images per model
+        type and config. Models which train on sequences or whose outputs
+        can't be stacked have no labels.
+        :param model:   KerasPilot
+        :param config:  donkey config
+        :param records: list of TubRecord or of sequences of them
+        :return:        if the labels are available
+        """
+        if any(isinstance(r, list) for r in records):
+            return False
+        sha = hashlib.sha1(str(model).encode())
+        sha.update(json.dumps({key: getattr(config, key)
+                               for key in dir(config) if key.isupper()
+                               and not callable(getattr(config, key))},
+                              sort_keys=True, default=str).encode())
+        labels_path = os.path.join(self.path,
+                                   f'labels_{sha.hexdigest()}.npz')
+        if os.path.exists(labels_path):
+            with np.load(labels_path) as labels:
+                self.labels[str(model)] = \
+                    [labels[f'arr_{i}'] for i in range(len(labels.files))]
+            return True
+        by_key = {self.record_key(r): r for r in records}
+        rows = sorted(self.rows.items(), key=lambda item: item[1])
+        try:
+            ys = [model.y_transform(by_key[key]) for key, _ in rows]
+            columns = zip(*ys) if isinstance(ys[0], tuple) else [ys]
+            labels = [np.stack(column).astype(np.float64)
+                      for column in columns]
+        except (KeyError, ValueError, TypeError, IndexError) as e:
+            logger.warning(f'Not storing labels of {model}: {e}')
+            return False
+        with open(labels_path + '.tmp', 'wb') as f:
+            np.savez(f, *labels)
+        os.replace(labels_path + '.tmp', labels_path)
+        self.labels[str(model)] = labels
+        return True
+
+    def label(self, model, record):
+        """
+        Returns the label of the record like model.y_transform(record).
+        :param model:   KerasPilot whose labels were loaded
+        :param record:  TubRecord
+        :return:        the label
+        """
+        labels = self.labels[str(model)]
+        row = self.rows[self.record_key(record)]
+        if len(labels) == 1:
+            return labels[0][row]
+        return tuple(column[row] for column in labels)
+
+    def stats(self) -> Dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses,
+                    images=len(self.rows))
+
+    def clear(self) -> None:
+        """ Nothing to free, the images stay on disk for the next run. """
+        pass
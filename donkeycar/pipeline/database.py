@@ -25,7 +25,9 @@ class PilotDatabase:
         else:
             return []
 
-    def generate_model_name(self) -> Tuple[str, int]:
+    def generate_model_name(self, offset: int = 0) -> Tuple[str, int]:
+        """ The offset skips names, for models which are trained together
+            and added to the database afterwards. """
         if self.entries:
             df = self.to_df()
             # otherwise this will be a numpy int
@@ -33,6 +35,7 @@ class PilotDatabase:
             this_num = last_num + 1
         else:
             this_num = 0
+        this_num += offset
         date = time.strftime('%y-%m-%d')
         name = f'pilot_{date}_{this_num}.h5'
         return os.path.join(self.cfg.MODELS_PATH, name), this_num
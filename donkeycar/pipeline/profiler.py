@@ -0,0 +1,144 @@
+import io
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Union
+
+import numpy as np
+from PIL import Image
+
+from donkeycar.config import Config
+from donkeycar.parts.tub_v2 import read_image_bytes
+from donkeycar.pipeline.types import TubRecord
+
+
+logger = logging.getLogger(__name__)
+
+
+class StageProfiler(object):
+    """
+    Collects the durations of the stages of the training pipeline and the
+    number of processed records. Stages nest, a stage is only charged the
+    time which is not spent in the stages within it, so the stage times of
+    a thread add up to its total time. Recording is thread safe, so the
+    stages of the generator thread of tf.data are collected as well.
+    """
+    STAGES = ('read', 'decode', 'resize', 'load', 'transform', 'augment',
+              'normalize', 'label', 'batch', 'model step')
+
+    def __init__(self) -> None:
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.records = 0
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def reset(self) -> None:
+        """ Drops all samples, e.g. after a warm up. """
+        with self.lock:
+            self.durations.clear()
+            self.records = 0
+            self.start_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """ Times the enclosed block as the given stage. """
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = list()
+        # time of the nested stages
+        stack.append(0.)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += duration
+            self.add(name, duration - nested)
+
+    def add(self, name: str, *durations: float) -> None:
+        """ Adds durations in seconds to the given stage. """
+        with self.lock:
+            self.durations[name].extend(durations)
+
+    def count(self, records: int = 1) -> None:
+        """ Counts processed records. """
+        with self.lock:
+            self.records += records
+
+    def report(self) -> Dict[str, Union[float, Dict[str, Dict[str, float]]]]:
+        """
+        :return: records, elapsed seconds, records/s and per stage the
+                 number of calls, total seconds and mean, p50 and p99 in ms
+        """
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_time
+            stages = dict()
+            names = [s for s in self.STAGES if s in self.durations] \
+                + sorted(s for s in self.durations if s not in self.STAGES)
+            for name in names:
+                ms = np.array(self.durations[name]) * 1000.
+                if not len(ms):
+                    continue
+                stages[name] = dict(
+                    calls=int(len(ms)), total_s=float(ms.sum() / 1000.),
+                    mean_ms=float(ms.mean()),
+                    p50_ms=float(np.percentile(ms, 50)),
+                    p99_ms=float(np.percentile(ms, 99)))
+            return dict(records=self.records, elapsed_s=elapsed,
+                        records_per_s=self.records / elapsed if elapsed
+                        else 0., stages=stages)
+
+
+def format_report(report: Dict) -> str:
+    """ Formats a report of a StageProfiler as a table. """
+    lines = [f'{report["records"]} records in {report["elapsed_s"]:.2f}s, '
+             f'{report["records_per_s"]:.1f} records/s',
+             f'{"stage":<12}{"calls":>8}{"total s":>10}{"mean ms":>10}'
+             f'{"p50 ms":>10}{"p99 ms":>10}']
+    for name, s in report['stages'].items():
+        lines.append(f'{name:<12}{s["calls"]:>8}{s["total_s"]:>10.2f}'
+                     f'{s["mean_ms"]:>10.3f}{s["p50_ms"]:>10.3f}'
+                     f'{s["p99_ms"]:>10.3f}')
+    return '\n'.join(lines)
+
+
+@contextmanager
+def profile(profiler: Optional[StageProfiler], name: str) -> Iterator[None]:
+    """ Times the block with the profiler if there is one. """
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name):
+            yield
+
+
+def profile_image_loading(profiler: StageProfiler, config: Config,
+                          records: List[TubRecord]) -> None:
+    """
+    Loads the images of the records like load_image() does, but separately
+    times reading the file, decoding the jpeg and resizing. The image cache
+    is bypassed.
+
+    :param profiler:    profiler of the stages
+    :param config:      donkey config
+    :param records:     records to load
+    """
+    for record in records:
+        with profiler.stage('read'):
+            data = read_image_bytes(record.base_path,
+                                    record.underlying['cam/image_array'])
+        with profiler.stage('decode'):
+            img = Image.open(io.BytesIO(data))
+            img.load()
+        with profiler.stage('resize'):
+            if img.height != config.IMAGE_H or img.width != config.IMAGE_W:
+                img = img.resize((config.IMAGE_W, config.IMAGE_H))
+            if config.IMAGE_DEPTH == 1:
+                img = img.convert('L')
+            np.asarray(img)
+        profiler.count()
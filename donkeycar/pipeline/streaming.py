@@ -0,0 +1,193 @@
+import copy
+import logging
+import queue
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
+
+import numpy as np
+
+from donkeycar.pipeline.sequence import SizedIterator, TubSequence
+from donkeycar.pipeline.types import RecordTable, SequenceTable, TubRecord
+
+
+logger = logging.getLogger(__name__)
+
+
+def storage_order(records) -> np.ndarray:
+    """
+    Positions of the records sorted like they are stored, i.e. by tub and
+    record index. Sequences are sorted by their first record.
+
+    :param records: list of TubRecord or sequences of them, or a table
+    :return:        int array of the positions
+    """
+    if isinstance(records, (RecordTable, SequenceTable)):
+        table, rows = (records.table, records.windows[:, 0]) \
+            if isinstance(records, SequenceTable) \
+            else (records, np.arange(len(records)))
+        indexes = table.column('_index', -1)[rows]
+        return np.lexsort((indexes, table.tub[rows]))
+    firsts = [r[0] if isinstance(r, list) else r for r in records]
+    return np.array(sorted(range(len(firsts)), key=lambda i: (
+        firsts[i].base_path, firsts[i].underlying.get('_index', -1))),
+                    dtype=np.int64)
+
+
+class LoadedImages(object):
+    """
+    Image cache of a streamed record or sequence, the images are loaded by
+    the readahead thread.
+    """
+    def __init__(self) -> None:
+        self.images: Dict[Hashable, Any] = dict()
+
+    def get(self, key: Hashable, loader: Callable[[], Optional[np.ndarray]]) \
+            -> Optional[np.ndarray]:
+        image = self.images.get(key)
+        return loader() if image is None else image
+
+
+def read_blocks(stream: 'ShuffleBufferStream', seed: int,
+                blocks: queue.Queue, stopped: threading.Event) -> None:
+    """
+    Loads the blocks of the stream in shuffled order into the queue and
+    finishes with None. It doesn't reference the iterator, so an abandoned
+    iterator is collected and stops the thread.
+    """
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    starts = np.arange(0, len(stream.order), stream.block_size)
+    try:
+        for start in np.random.default_rng(seed).permutation(starts):
+            block = stream.order[start:start + stream.block_size]
+            if not put([stream.load(stream.records[i]) for i in block]):
+                return
+    except Exception as e:
+        logger.error(f'Reading blocks failed: {e}')
+        put(e)
+        return
+    put(None)
+
+
+class StreamIterator(SizedIterator[Union[TubRecord, List[TubRecord]]]):
+    """
+    One epoch of a ShuffleBufferStream. A readahead thread reads the blocks
+    in shuffled order and loads their images, the records are drawn at
+    random from a bounded buffer. The thread starts with the first record.
+    """
+    def __init__(self, stream: 'ShuffleBufferStream',
+                 seeds: np.random.SeedSequence) -> None:
+        self.stream = stream
+        self.block_seed, record_seed = seeds.generate_state(2)
+        self.buffer_size = stream.buffer_size
+        self.rng = np.random.default_rng(record_seed)
+        self.blocks = queue.Queue(maxsize=max(1, stream.readahead))
+        self.stopped = threading.Event()
+        self.buffer = list()
+        self.remaining = len(stream)
+        self.started = False
+        self.finished = False
+
+    def _fill(self) -> None:
+        if not self.started:
+            self.started = True
+            threading.Thread(target=read_blocks, daemon=True,
+                             args=(self.stream, self.block_seed, self.blocks,
+                                   self.stopped)).start()
+        while not self.finished and len(self.buffer) < self.buffer_size:
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if block is None:
+                self.finished = True
+            else:
+                self.buffer.extend(block)
+
+    def __len__(self) -> int:
+        return self.remaining
+
+    def __next__(self) -> Union[TubRecord, List[TubRecord]]:
+        self._fill()
+        if not self.buffer:
+            raise StopIteration('No more records')
+        # swap a random record to the end, so taking it is O(1)
+        i = int(self.rng.integers(len(self.buffer)))
+        self.buffer[i], self.buffer[-1] = self.buffer[-1], self.buffer[i]
+        self.remaining -= 1
+        return self.buffer.pop()
+
+    next = __next__
+
+    def close(self) -> None:
+        """ Stops the readahead thread. """
+        self.stopped.set()
+
+    def __del__(self) -> None:
+        self.close()
+
+
+class ShuffleBufferStream(TubSequence):
+    """
+    Streams records in blocks of neighbouring records, so reading the
+    catalogs and image files is close to sequential. The block order is
+    shuffled every epoch and the records are shuffled within a bounded
+    buffer, while a readahead thread loads the images of the next blocks.
+    """
+    def __init__(self, records, block_size: int = 256,
+                 buffer_size: int = 2048, readahead: int = 2,
+                 seed: Optional[int] = None) -> None:
+        """
+        :param records:     list of TubRecord or sequences of them, or a
+                            table
+        :param block_size:  number of neighbouring records read together
+        :param buffer_size: number of records to draw the next one from
+        :param readahead:   number of loaded blocks waiting for the buffer
+        :param seed:        seed of the block and record order
+        """
+        super().__init__(records)
+        self.block_size = max(1, block_size)
+        self.buffer_size = max(1, buffer_size)
+        self.readahead = readahead
+        self.order = storage_order(records)
+        self.seeds = np.random.SeedSequence(seed)
+
+    @classmethod
+    def from_config(cls, records, config) -> 'ShuffleBufferStream':
+        return cls(records,
+                   block_size=getattr(config, 'STREAM_BLOCK_SIZE', 256),
+                   buffer_size=getattr(config, 'STREAM_BUFFER_SIZE', 2048),
+                   readahead=getattr(config, 'STREAM_READAHEAD', 2),
+                   seed=getattr(config, 'STREAM_SEED', None))
+
+    @staticmethod
+    def load(record: Union[TubRecord, List[TubRecord]]) \
+            -> Union[TubRecord, List[TubRecord]]:
+        """
+        Returns a copy of the record whose image cache holds the image. The
+        image is read from the tub, neither the record nor a shared image
+        cache keep it.
+        """
+        records = record if isinstance(record, list) else [record]
+        images = LoadedImages()
+        proxies = list()
+        for r in records:
+            key = (r.base_path, r.underlying['cam/image_array'])
+            if key not in images.images:
+                # each block is read once per epoch, caching its images
+                # would only evict the ones of other records
+                images.images[key] = r.image(cached=False)
+            proxy = copy.copy(r)
+            proxy.image_cache = images
+            proxies.append(proxy)
+        return proxies if isinstance(record, list) else proxies[0]
+
+    def __iter__(self) -> StreamIterator:
+        """ Starts the next epoch. """
+        return StreamIterator(self, self.seeds.spawn(1)[0])
@@ -0,0 +1,340 @@
+import copy
+import logging
+import math
+import os
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import tensorflow as tf
+
+from donkeycar.config import Config
+from donkeycar.parts.tub_v2 import PackedImages, Tub, read_image_bytes
+from donkeycar.pipeline.augmentations import Augmentations
+from donkeycar.pipeline.cache import ImageSnapshot
+from donkeycar.pipeline.profiler import StageProfiler
+from donkeycar.pipeline.types import TubRecord
+from donkeycar.utils import ONE_BYTE_SCALE
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageRef(object):
+    """ Stands in for the image of a record when extracting the inputs. """
+    def __init__(self, key: Tuple[str, str]) -> None:
+        self.key = key
+
+
+class ImageRefs(object):
+    """ Image cache which returns references instead of decoded images. """
+    def get(self, key, loader) -> ImageRef:
+        return ImageRef(key)
+
+
+def gaussian_blur(images: tf.Tensor, sigmas: tf.Tensor, radius: int) \
+        -> tf.Tensor:
+    """
+    Blurs each image of a batch with its own sigma. The batch is folded into
+    the channels, so a single separable depthwise convolution blurs all
+    images. Borders are reflected like in cv2.
+
+    :param images:  float batch of shape (B, H, W, C)
+    :param sigmas:  sigma per image of shape (B,)
+    :param radius:  kernel radius
+    :return:        blurred batch
+    """
+    shape = tf.shape(images)
+    b, h, w, c = shape[0], shape[1], shape[2], shape[3]
+    x = tf.range(-radius, radius + 1, dtype=tf.float32)
+    sigmas = tf.maximum(tf.cast(sigmas, tf.float32), 1e-3)[:, None]
+    kernels = tf.exp(-tf.square(x)[None, :] / (2. * tf.square(sigmas)))
+    kernels /= tf.reduce_sum(kernels, axis=1, keepdims=True)
+    # one kernel per channel of each image, channels are image major
+    kernels = tf.repeat(kernels, c, axis=0)
+    folded = tf.reshape(tf.transpose(images, [1, 2, 0, 3]), [1, h, w, b * c])
+    folded = tf.pad(folded, [[0, 0], [radius, radius], [radius, radius],
+                             [0, 0]], mode='REFLECT')
+    kernel_h = tf.transpose(kernels)[:, None, :, None]
+    kernel_w = tf.transpose(kernels)[None, :, :, None]
+    strides = [1, 1, 1, 1]
+    folded = tf.nn.depthwise_conv2d(folded, kernel_h, strides, 'VALID')
+    folded = tf.nn.depthwise_conv2d(folded, kernel_w, strides, 'VALID')
+    return tf.transpose(tf.reshape(folded, [h, w, b, c]), [2, 0, 1, 3])
+
+
+class TfDataPipeline(object):
+    """
+    Builds a tf.data pipeline from the image paths of the records and the
+    arrays of the other model inputs and the labels. Images are read and
+    decoded by tf ops in parallel, the TRANSFORMATIONS are applied per
+    image and the AUGMENTATIONS per batch. The elements are the same
+    dictionaries as produced by x_translate() and y_translate() of the
+    model in the generator pipeline. With a profiler the stages are
+    bracketed by timestamp ops and their durations are added to the
+    profiler.
+    """
+
+    def __init__(self, model, config: Config,
+                 records: List[Union[TubRecord, List[TubRecord]]],
+                 is_train: bool,
+                 snapshot: Optional[ImageSnapshot] = None,
+                 profiler: Optional[StageProfiler] = None) -> None:
+        """
+        :param model:       KerasPilot
+        :param config:      donkey config
+        :param records:     list of TubRecord or sequences of them
+        :param is_train:    if the augmentations are applied
+        :param snapshot:    snapshot of the transformed images if present
+        :param profiler:    profiler of the stages if present
+        """
+        self.model = model
+        self.config = config
+        self.records = records
+        self.is_train = is_train
+        self.snapshot = snapshot
+        self.profiler = profiler
+        self.batch_size = config.BATCH_SIZE
+        self.image_shape = (config.IMAGE_H, config.IMAGE_W,
+                            config.IMAGE_DEPTH)
+
+    def _arrays(self) -> Optional[Tuple[str, List[Tuple[str, str]],
+                                        Dict[str, np.ndarray],
+                                        Dict[str, np.ndarray]]]:
+        """
+        Runs the model's transforms over records whose images are replaced
+        by references and stacks all inputs but the image and all labels.
+        :return: image input name, image keys, input and label arrays or
+                 None if the model has no single image input per record
+        """
+        refs = ImageRefs()
+        image_name = None
+        image_keys = list()
+        xs, ys = list(), list()
+        for record in self.records:
+            proxies = [copy.copy(r) for r in
+                       (record if isinstance(record, list) else [record])]
+            for proxy in proxies:
+                proxy.image_cache = refs
+            proxy = proxies if isinstance(record, list) else proxies[0]
+            x = self.model.x_translate(self.model.x_transform(proxy))
+            image_inputs = [k for k, v in x.items() if isinstance(v, ImageRef)]
+            if len(image_inputs) != 1 or image_name not in (None,
+                                                            image_inputs[0]):
+                return None
+            image_name = image_inputs[0]
+            image_keys.append(x.pop(image_name).key)
+            xs.append(x)
+            if self.snapshot is not None \
+                    and str(self.model) in self.snapshot.labels:
+                y = self.snapshot.label(self.model, record)
+            else:
+                y = self.model.y_transform(record)
+            ys.append(self.model.y_translate(y))
+        try:
+            dtype = self.model.dtype
+            x_arrays = {k: np.array([x[k] for x in xs], dtype=dtype)
+                        for k in xs[0]}
+            y_arrays = {k: np.array([y[k] for y in ys], dtype=dtype)
+                        for k in ys[0]}
+        except (ValueError, TypeError):
+            return None
+        return image_name, image_keys, x_arrays, y_arrays
+
+    def _image_sources(self, image_keys: List[Tuple[str, str]]) \
+            -> Dict[str, np.ndarray]:
+        """ Image file paths, packed references or snapshot rows. """
+        if self.snapshot is not None:
+            rows = [self.snapshot.rows.get(key, -1) for key in image_keys]
+            if min(rows) >= 0:
+                return dict(row=np.array(rows, dtype=np.int64))
+        paths, bases, names = list(), list(), list()
+        for base_path, name in image_keys:
+            packed = PackedImages.parse_reference(name) is not None
+            paths.append('' if packed
+                         else os.path.join(base_path, Tub.images(), name))
+            bases.append(base_path)
+            names.append(name)
+        return dict(path=np.array(paths), base=np.array(bases),
+                    name=np.array(names))
+
+    def _read_snapshot(self, row: tf.Tensor) -> tf.Tensor:
+        images = self.snapshot.images
+        image = tf.numpy_function(lambda r: np.array(images[r]), [row],
+                                  tf.as_dtype(images.dtype))
+        image.set_shape(images.shape[1:])
+        return image
+
+    @staticmethod
+    def _read_bytes(source: Dict[str, tf.Tensor]) -> tf.Tensor:
+        return tf.cond(
+            tf.strings.length(source['path']) > 0,
+            lambda: tf.io.read_file(source['path']),
+            lambda: tf.numpy_function(
+                lambda base, name: read_image_bytes(base.decode(),
+                                                    name.decode()),
+                [source['base'], source['name']], tf.string))
+
+    @staticmethod
+    def _decode(data: tf.Tensor) -> tf.Tensor:
+        return tf.io.decode_jpeg(data, channels=3,
+                                 dct_method='INTEGER_ACCURATE')
+
+    def _read_image(self, source: Dict[str, tf.Tensor]) -> tf.Tensor:
+        """ Reads, decodes and resizes an image like load_image(). """
+        return self._resize(self._decode(self._read_bytes(source)))
+
+    def _resize(self, image: tf.Tensor) -> tf.Tensor:
+        h, w, depth = self.image_shape
+        image = tf.cond(
+            tf.reduce_all(tf.shape(image)[:2] == [h, w]),
+            lambda: image,
+            lambda: self._to_uint8(tf.image.resize(image, (h, w),
+                                                   method='bicubic')))
+        if depth == 1:
+            image = tf.image.rgb_to_grayscale(image)
+        image.set_shape(self.image_shape)
+        return image
+
+    @staticmethod
+    def _to_uint8(image: tf.Tensor) -> tf.Tensor:
+        return tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+
+    def _transform(self, image: tf.Tensor) -> tf.Tensor:
+        """ Applies the TRANSFORMATIONS like ImageAugmentation. """
+        h, w, depth = self.image_shape
+        for transformation in getattr(self.config, 'TRANSFORMATIONS', []):
+            if transformation == 'CROP':
+                top, bottom = self.config.ROI_CROP_TOP, \
+                    self.config.ROI_CROP_BOTTOM
+                left, right = self.config.ROI_CROP_LEFT, \
+                    self.config.ROI_CROP_RIGHT
+                # the crop keeps the image size, imgaug enlarges with area
+                # interpolation
+                image = tf.image.crop_to_bounding_box(
+                    image, top, left, h - top - bottom, w - left - right)
+                image = self._to_uint8(tf.image.resize(image, (h, w),
+                                                       method='area'))
+            elif transformation == 'TRAPEZE':
+                cfg = self.config
+                mask = Augmentations.trapezoidal_region(
+                    cfg.ROI_TRAPEZE_LL, cfg.ROI_TRAPEZE_LR,
+                    cfg.ROI_TRAPEZE_UL, cfg.ROI_TRAPEZE_UR,
+                    cfg.ROI_TRAPEZE_MIN_Y, cfg.ROI_TRAPEZE_MAX_Y,
+                    self.image_shape)
+                image = image * tf.constant(mask)
+            else:
+                raise ValueError(f'Transformation {transformation} is not '
+                                 f'supported in the native pipeline')
+        return image
+
+    @staticmethod
+    def _timed(function, *args) -> Tuple[tf.Tensor, tf.Tensor]:
+        """ Runs the function between two timestamps.
+            :return: its result and the duration in seconds """
+        start = tf.timestamp()
+        with tf.control_dependencies([start]):
+            result = function(*args)
+        with tf.control_dependencies(tf.nest.flatten(result)):
+            end = tf.timestamp()
+        return result, end - start
+
+    def _add_timings(self, x, y, timings: Dict[str, tf.Tensor]):
+        """ Passes the batch on after adding the timings to the profiler.
+        """
+        names = sorted(timings)
+
+        def add(*durations):
+            for name, duration in zip(names, durations):
+                self.profiler.add(name, *np.atleast_1d(duration).tolist())
+            return np.int64(len(names))
+
+        added = tf.numpy_function(add, [timings[n] for n in names], tf.int64)
+        with tf.control_dependencies([added]):
+            y = {k: tf.identity(v) for k, v in y.items()}
+        return x, y
+
+    def _augment(self, images: tf.Tensor) -> tf.Tensor:
+        """ Applies the AUGMENTATIONS to a float batch. """
+        batch = tf.shape(images)[0]
+        for augmentation in getattr(self.config, 'AUGMENTATIONS', []):
+            if augmentation == 'MULTIPLY':
+                low, high = getattr(self.config, 'AUG_MULTIPLY_RANGE',
+                                    (0.5, 1.5))
+                factors = tf.random.uniform([batch, 1, 1, 1], low, high)
+                images = tf.clip_by_value(images * factors, 0., 255.)
+            elif augmentation == 'BLUR':
+                low, high = getattr(self.config, 'AUG_BLUR_RANGE', (0.0, 3.0))
+                sigmas = tf.random.uniform([batch], low, high)
+                radius = max(1, math.ceil(3 * high))
+                images = gaussian_blur(images, sigmas, radius)
+            else:
+                raise ValueError(f'Augmentation {augmentation} is not '
+                                 f'supported in the native pipeline')
+        return images
+
+    def create(self) -> Optional[tf.data.Dataset]:
+        """
+        Assembles the pipeline.
+        :return: batched dataset or None if the model is not supported
+        """
+        arrays = self._arrays()
+        if arrays is None:
+            logger.warning(f'{self.model} has no single image input per '
+                           f'record, it is not supported by the native '
+                           f'pipeline')
+            return None
+        image_name, image_keys, x_arrays, y_arrays = arrays
+        sources = self._image_sources(image_keys)
+        from_snapshot = 'row' in sources
+        dataset = tf.data.Dataset.from_tensor_slices(
+            (sources, x_arrays, y_arrays))
+
+        profiling = self.profiler is not None
+
+        def load(source, x, y):
+            if from_snapshot:
+                stages = [('read', self._read_snapshot)]
+                image = source['row']
+            else:
+                stages = [('read', self._read_bytes), ('decode', self._decode),
+                          ('resize', self._resize),
+                          ('transform', self._transform)]
+                image = source
+            timings = dict()
+            for name, function in stages:
+                if profiling:
+                    image, timings[name] = self._timed(function, image)
+                else:
+                    image = function(image)
+            return (image, x, y, timings) if profiling else (image, x, y)
+
+        image_dtype = tf.as_dtype(self.model.image_dtype)
+
+        def augment(images, x, y, timings=None):
+            images = tf.cast(images, tf.float32)
+            if self.is_train:
+                if profiling:
+                    images, timings['augment'] = self._timed(
+                        self._augment, images)
+                else:
+                    images = self._augment(images)
+                images = tf.clip_by_value(images, 0., 255.)
+
+            def normalize(images):
+                if image_dtype == tf.uint8:
+                    return self._to_uint8(images)
+                return tf.cast(images, image_dtype) * ONE_BYTE_SCALE
+
+            x = dict(x)
+            if profiling:
+                x[image_name], timings['normalize'] = self._timed(normalize,
+                                                                  images)
+                return self._add_timings(x, y, timings)
+            x[image_name] = normalize(images)
+            return x, y
+
+        tune = tf.data.experimental.AUTOTUNE
+        return dataset.repeat() \
+            .map(load, num_parallel_calls=tune) \
+            .batch(self.batch_size) \
+            .map(augment, num_parallel_calls=tune)
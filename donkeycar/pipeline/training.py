@@ -1,17 +1,27 @@
+import copy
 import math
 import os
+from collections import defaultdict
+from functools import partial
 from time import time
-from typing import List, Dict, Union, Tuple
+from typing import Any, List, Dict, Optional, Union, Tuple
 
+from tensorflow.python.keras.callbacks import CallbackList, EarlyStopping, \
+    History, ModelCheckpoint
 from tensorflow.python.keras.models import load_model
 
 from donkeycar.config import Config
 from donkeycar.parts.keras import KerasPilot
 from donkeycar.parts.interpreter import keras_model_to_tflite, \
-    saved_model_to_tensor_rt
+    keras_model_to_onnx, saved_model_to_tensor_rt
+from donkeycar.pipeline.cache import ImageSnapshot
 from donkeycar.pipeline.database import PilotDatabase
+from donkeycar.pipeline.profiler import StageProfiler, profile, \
+    profile_image_loading
 from donkeycar.pipeline.sequence import TubRecord, TubSequence, TfmIterator
-from donkeycar.pipeline.types import TubDataset
+from donkeycar.pipeline.streaming import LoadedImages, ShuffleBufferStream
+from donkeycar.pipeline.tf_data import TfDataPipeline
+from donkeycar.pipeline.types import TubDataset, split_groups
 from donkeycar.pipeline.augmentations import ImageAugmentation
 from donkeycar.utils import get_model_by_type, normalize_image, train_test_split
 import tensorflow as tf
@@ -28,12 +38,23 @@ class BatchSequence(object):
                  model: KerasPilot,
                  config: Config,
                  records: List[TubRecord],
-                 is_train: bool) -> None:
+                 is_train: bool,
+                 snapshot: Optional[ImageSnapshot] = None,
+                 profiler: Optional[StageProfiler] = None) -> None:
         self.model = model
         self.config = config
-        self.sequence = TubSequence(records)
+        self.records = records
+        if getattr(config, 'TRAIN_DATA_PIPELINE', 'generator') == 'stream':
+            # near sequential reads, shuffled within a buffer
+            self.sequence = ShuffleBufferStream.from_config(records, config)
+        else:
+            self.sequence = TubSequence(records)
         self.batch_size = self.config.BATCH_SIZE
         self.is_train = is_train
+        # images from the snapshot are already transformed
+        self.snapshot = snapshot
+        # times the stages of the pipeline if present
+        self.profiler = profiler
         self.augmentation = ImageAugmentation(config, 'AUGMENTATIONS')
         self.transformation = ImageAugmentation(config, 'TRANSFORMATIONS')
         self.pipeline = self._create_pipeline()
@@ -44,10 +65,14 @@ class BatchSequence(object):
     def image_processor(self, img_arr):
         """ Transformes the images and augments if in training. Then
             normalizes it. """
-        img_arr = self.transformation.run(img_arr)
+        if self.snapshot is None:
+            with profile(self.profiler, 'transform'):
+                img_arr = self.transformation.run(img_arr)
         if self.is_train:
-            img_arr = self.augmentation.run(img_arr)
-        norm_img = normalize_image(img_arr)
+            with profile(self.profiler, 'augment'):
+                img_arr = self.augmentation.run(img_arr)
+        with profile(self.profiler, 'normalize'):
+            norm_img = normalize_image(img_arr, self.model.image_dtype)
         return norm_img
 
     def _create_pipeline(self) -> TfmIterator:
@@ -56,16 +81,23 @@ class BatchSequence(object):
         # 1. Initialise TubRecord -> x, y transformations
         def get_x(record: TubRecord) -> Dict[str, Union[float, np.ndarray]]:
             """ Extracting x from record for training"""
-            out_tuple = self.model.x_transform_and_process(
-                record, self.image_processor)
+            # the image processing is timed separately
+            with profile(self.profiler, 'load'):
+                out_tuple = self.model.x_transform_and_process(
+                    record, self.image_processor)
             # convert tuple to dictionary which is understood by tf.data
             out_dict = self.model.x_translate(out_tuple)
             return out_dict
 
         def get_y(record: TubRecord) -> Dict[str, Union[float, np.ndarray]]:
             """ Extracting y from record for training """
-            y0 = self.model.y_transform(record)
-            y1 = self.model.y_translate(y0)
+            with profile(self.profiler, 'label'):
+                if self.snapshot is not None \
+                        and str(self.model) in self.snapshot.labels:
+                    y0 = self.snapshot.label(self.model, record)
+                else:
+                    y0 = self.model.y_transform(record)
+                y1 = self.model.y_translate(y0)
             return y1
 
         # 2. Build pipeline using the transformations
@@ -75,6 +107,14 @@ class BatchSequence(object):
 
     def create_tf_data(self) -> tf.data.Dataset:
         """ Assembles the tf data pipeline """
+        if getattr(self.config, 'TRAIN_DATA_PIPELINE', 'generator') \
+                == 'native':
+            dataset = TfDataPipeline(self.model, self.config, self.records,
+                                     self.is_train, self.snapshot,
+                                     self.profiler).create()
+            if dataset is not None:
+                return dataset
+            print('Falling back to the generator pipeline')
         dataset = tf.data.Dataset.from_generator(
             generator=lambda: self.pipeline,
             output_types=self.model.output_types(),
@@ -82,15 +122,224 @@ class BatchSequence(object):
         return dataset.repeat().batch(self.batch_size)
 
 
-def get_model_train_details(database: PilotDatabase, model: str = None) \
-        -> Tuple[str, int]:
+class MultiBatchSequence(object):
+    """
+    Feeds several models from one pass over the records. The images of a
+    record are loaded, transformed and augmented once and shared by all
+    models, only the normalisation and the translation into the inputs and
+    labels happen per model. With sequences each model gets the tail of the
+    window which matches its own sequence size.
+    """
+    def __init__(self,
+                 models: Dict[str, KerasPilot],
+                 config: Config,
+                 records: List[Union[TubRecord, List[TubRecord]]],
+                 is_train: bool,
+                 snapshot: Optional[ImageSnapshot] = None) -> None:
+        """
+        :param models:      models by their name in the batches
+        :param config:      donkey config
+        :param records:     list of TubRecord or windows of the largest
+                            sequence size of the models
+        :param is_train:    if the augmentations are applied
+        :param snapshot:    snapshot of the transformed images if present
+        """
+        self.models = models
+        self.config = config
+        self.records = records
+        if getattr(config, 'TRAIN_DATA_PIPELINE', 'generator') == 'stream':
+            self.sequence = ShuffleBufferStream.from_config(records, config)
+        else:
+            self.sequence = TubSequence(records)
+        self.batch_size = self.config.BATCH_SIZE
+        self.is_train = is_train
+        self.snapshot = snapshot
+        self.augmentation = ImageAugmentation(config, 'AUGMENTATIONS')
+        self.transformation = ImageAugmentation(config, 'TRANSFORMATIONS')
+        self.pipeline = self._create_pipeline()
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.pipeline) / self.batch_size)
+
+    def image_processor(self, img_arr):
+        """ Transforms the images and augments if in training, the models
+            normalize them. """
+        if self.snapshot is None:
+            img_arr = self.transformation.run(img_arr)
+        if self.is_train:
+            img_arr = self.augmentation.run(img_arr)
+        return img_arr
+
+    @staticmethod
+    def model_records(model: KerasPilot,
+                      record: Union[TubRecord, List[TubRecord]]) \
+            -> Union[TubRecord, List[TubRecord]]:
+        """ The part of a window which the model takes. """
+        if not isinstance(record, list):
+            return record
+        size = model.seq_size()
+        return record[-size:] if size else record[-1]
+
+    def _create_pipeline(self) -> TfmIterator:
+        def get_x(record: Union[TubRecord, List[TubRecord]]) \
+                -> Dict[str, Dict[str, Union[float, np.ndarray]]]:
+            """ Processes the images once and extracts x of all models """
+            images = LoadedImages()
+            proxies = list()
+            for r in record if isinstance(record, list) else [record]:
+                key = (r.base_path, r.underlying['cam/image_array'])
+                if key not in images.images:
+                    images.images[key] = self.image_processor(r.image())
+                proxy = copy.copy(r)
+                proxy.image_cache = images
+                proxies.append(proxy)
+            proxy = proxies if isinstance(record, list) else proxies[0]
+            return {name: model.x_translate(model.x_transform_and_process(
+                        self.model_records(model, proxy),
+                        partial(normalize_image, dtype=model.image_dtype)))
+                    for name, model in self.models.items()}
+
+        def get_y(record: Union[TubRecord, List[TubRecord]]) \
+                -> Dict[str, Dict[str, Union[float, np.ndarray]]]:
+            """ Extracting y of all models """
+            return {name: model.y_translate(model.y_transform(
+                        self.model_records(model, record)))
+                    for name, model in self.models.items()}
+
+        return self.sequence.build_pipeline(x_transform=get_x,
+                                            y_transform=get_y)
+
+    def create_tf_data(self) -> tf.data.Dataset:
+        """ Assembles the tf data pipeline, the inputs and labels of each
+            model are keyed by its name """
+        types = {name: model.output_types()
+                 for name, model in self.models.items()}
+        shapes = {name: model.output_shapes()
+                  for name, model in self.models.items()}
+        dataset = tf.data.Dataset.from_generator(
+            generator=lambda: self.pipeline,
+            output_types=tuple({name: t[i] for name, t in types.items()}
+                               for i in range(2)),
+            output_shapes=tuple({name: s[i] for name, s in shapes.items()}
+                                for i in range(2)))
+        return dataset.repeat().batch(self.batch_size)
+
+
+def fit_models(models: Dict[str, KerasPilot],
+               model_paths: Dict[str, str],
+               train_data: tf.data.Dataset,
+               train_steps: int,
+               validation_data: tf.data.Dataset,
+               validation_steps: int,
+               epochs: int,
+               verbose: int = 1,
+               min_delta: float = .0005,
+               patience: int = 5) -> Dict[str, History]:
+    """
+    Trains several models on the batches of a MultiBatchSequence, every
+    batch is read once for all models. Each model has its own early
+    stopping and saves its best version like KerasPilot.train().
+
+    :return: history of each model
+    """
+    runs = dict()
+    for name, kl in models.items():
+        model = kl.interpreter.model
+        kl.compile()
+        history = History()
+        callbacks = CallbackList(
+            [EarlyStopping(monitor='val_loss', patience=patience,
+                           min_delta=min_delta),
+             ModelCheckpoint(monitor='val_loss', filepath=model_paths[name],
+                             save_best_only=True, verbose=verbose),
+             history], model=model)
+        model.stop_training = False
+        callbacks.on_train_begin()
+        runs[name] = model, callbacks, history
+
+    train_iterator = iter(train_data)
+    validation_iterator = iter(validation_data)
+    for epoch in range(epochs):
+        active = {name: run for name, run in runs.items()
+                  if not run[0].stop_training}
+        if not active:
+            break
+        logs = {name: dict() for name in active}
+        for model, callbacks, _ in active.values():
+            model.reset_metrics()
+            callbacks.on_epoch_begin(epoch)
+        for _ in range(train_steps):
+            x, y = next(train_iterator)
+            for name, (model, _, _) in active.items():
+                logs[name] = model.train_on_batch(
+                    x[name], y[name], reset_metrics=False, return_dict=True)
+        for model, _, _ in active.values():
+            model.reset_metrics()
+        val_logs = {name: dict() for name in active}
+        for _ in range(validation_steps):
+            x, y = next(validation_iterator)
+            for name, (model, _, _) in active.items():
+                val_logs[name] = model.test_on_batch(
+                    x[name], y[name], reset_metrics=False, return_dict=True)
+        for name, (model, callbacks, _) in active.items():
+            logs[name].update({f'val_{k}': v
+                               for k, v in val_logs[name].items()})
+            callbacks.on_epoch_end(epoch, logs[name])
+            if verbose:
+                print(f'{name} epoch {epoch + 1}/{epochs} - ' + ' - '.join(
+                    f'{k}: {v:.4f}' for k, v in logs[name].items()))
+    for _, callbacks, _ in runs.values():
+        callbacks.on_train_end()
+    return {name: history for name, (_, _, history) in runs.items()}
+
+
+def get_model_train_details(database: PilotDatabase, model: str = None,
+                            offset: int = 0) -> Tuple[str, int]:
     if not model:
-        model_name, model_num = database.generate_model_name()
+        model_name, model_num = database.generate_model_name(offset)
     else:
         model_name, model_num = os.path.abspath(model), 0
     return model_name, model_num
 
 
+def save_model_files(cfg: Config, model_path: str) -> None:
+    """ Converts the trained model into the formats of the config """
+    base_path = os.path.splitext(model_path)[0]
+    if getattr(cfg, 'CREATE_TF_LITE', True):
+        tf_lite_model_path = f'{base_path}.tflite'
+        keras_model_to_tflite(model_path, tf_lite_model_path)
+
+    if getattr(cfg, 'CREATE_TENSOR_RT', False):
+        # load h5 (ie. keras) model
+        model_rt = load_model(model_path)
+        # save in tensorflow savedmodel format (i.e. directory)
+        model_rt.save(f'{base_path}.savedmodel')
+        # pass savedmodel to the rt converter
+        saved_model_to_tensor_rt(f'{base_path}.savedmodel', f'{base_path}.trt')
+
+    if getattr(cfg, 'CREATE_ONNX_MODEL', False):
+        keras_model_to_onnx(model_path, f'{base_path}.onnx',
+                            getattr(cfg, 'ONNX_OPSET', 13))
+
+
+def add_database_entry(database: PilotDatabase, cfg: Config, model_path: str,
+                       model_num: int, kl: KerasPilot, tub_paths: str,
+                       history: tf.keras.callbacks.History,
+                       transfer: str = None, comment: str = None) -> None:
+    database_entry = {
+        'Number': model_num,
+        'Name': os.path.basename(os.path.splitext(model_path)[0]),
+        'Type': str(kl),
+        'Tubs': tub_paths,
+        'Time': time(),
+        'History': history.history,
+        'Transfer': os.path.basename(transfer) if transfer else None,
+        'Comment': comment,
+        'Config': str(cfg)
+    }
+    database.add_entry(database_entry)
+
+
 def train(cfg: Config, tub_paths: str, model: str = None,
           model_type: str = None, transfer: str = None, comment: str = None) \
         -> tf.keras.callbacks.History:
@@ -103,7 +352,6 @@ def train(cfg: Config, tub_paths: str, model: str = None,
     model_path, model_num = \
         get_model_train_details(database, model)
 
-    base_path = os.path.splitext(model_path)[0]
     kl = get_model_by_type(model_type, cfg)
     if transfer:
         kl.load(transfer)
@@ -114,15 +362,33 @@ def train(cfg: Config, tub_paths: str, model: str = None,
     all_tub_paths = [os.path.expanduser(tub) for tub in tubs]
     dataset = TubDataset(config=cfg, tub_paths=all_tub_paths,
                          seq_size=kl.seq_size())
+    records = dataset.get_records()
+    image_cache = dataset.image_cache
+    snapshot = None
+    snapshot_dir = getattr(cfg, 'CACHE_SNAPSHOT_DIR', None)
+    if snapshot_dir:
+        # decode and transform all images once, only augment per epoch
+        transformation = ImageAugmentation(cfg, 'TRANSFORMATIONS')
+        snapshot = ImageSnapshot.open_or_create(
+            os.path.expanduser(snapshot_dir), cfg, records, transformation)
+        snapshot.attach(records)
+        snapshot.load_labels(kl, cfg, records)
+        image_cache = snapshot
+    groups = split_groups(records, getattr(cfg, 'TRAIN_SPLIT_BY', 'record'),
+                          getattr(cfg, 'TRAIN_SPLIT_BLOCK_SIZE', 100))
     training_records, validation_records \
-        = train_test_split(dataset.get_records(), shuffle=True,
-                           test_size=(1. - cfg.TRAIN_TEST_SPLIT))
+        = train_test_split(records, shuffle=True,
+                           test_size=(1. - cfg.TRAIN_TEST_SPLIT),
+                           seed=getattr(cfg, 'TRAIN_SPLIT_SEED', None),
+                           groups=groups)
     print(f'Records # Training {len(training_records)}')
     print(f'Records # Validation {len(validation_records)}')
 
     # We need augmentation in validation when using crop / trapeze
-    training_pipe = BatchSequence(kl, cfg, training_records, is_train=True)
-    validation_pipe = BatchSequence(kl, cfg, validation_records, is_train=False)
+    training_pipe = BatchSequence(kl, cfg, training_records, is_train=True,
+                                  snapshot=snapshot)
+    validation_pipe = BatchSequence(kl, cfg, validation_records,
+                                    is_train=False, snapshot=snapshot)
     tune = tf.data.experimental.AUTOTUNE
     dataset_train = training_pipe.create_tf_data().prefetch(tune)
     dataset_validate = validation_pipe.create_tf_data().prefetch(tune)
@@ -143,31 +409,162 @@ def train(cfg: Config, tub_paths: str, model: str = None,
                        min_delta=cfg.MIN_DELTA,
                        patience=cfg.EARLY_STOP_PATIENCE,
                        show_plot=cfg.SHOW_PLOT)
+    print(f'Image cache statistics: {image_cache.stats()}')
+    image_cache.clear()
 
-    if getattr(cfg, 'CREATE_TF_LITE', True):
-        tf_lite_model_path = f'{base_path}.tflite'
-        keras_model_to_tflite(model_path, tf_lite_model_path)
+    save_model_files(cfg, model_path)
+    add_database_entry(database, cfg, model_path, model_num, kl, tub_paths,
+                       history, transfer, comment)
+    database.write()
 
-    if getattr(cfg, 'CREATE_TENSOR_RT', False):
-        # load h5 (ie. keras) model
-        model_rt = load_model(model_path)
-        # save in tensorflow savedmodel format (i.e. directory)
-        model_rt.save(f'{base_path}.savedmodel')
-        # pass savedmodel to the rt converter
-        saved_model_to_tensor_rt(f'{base_path}.savedmodel', f'{base_path}.trt')
+    return history
 
-    database_entry = {
-        'Number': model_num,
-        'Name': os.path.basename(base_path),
-        'Type': str(kl),
-        'Tubs': tub_paths,
-        'Time': time(),
-        'History': history.history,
-        'Transfer': os.path.basename(transfer) if transfer else None,
-        'Comment': comment,
-        'Config': str(cfg)
-    }
-    database.add_entry(database_entry)
+
+def train_models(cfg: Config, tub_paths: str, model_types: List[str],
+                 model: str = None, comment: str = None) \
+        -> Dict[str, tf.keras.callbacks.History]:
+    """
+    Trains several model types in one pass over the data, e.g. to compare
+    them on the same tubs. Models with different sequence sizes get a pass
+    per sequence size, so every model is trained on the same records as in
+    its own training. Each model gets its own database entry, with a given
+    model path the model type is appended to its name.
+    """
+    database = PilotDatabase(cfg)
+    models = dict()
+    model_paths = dict()
+    model_nums = dict()
+    for i, model_type in enumerate(model_types):
+        name = f'{i}_{model_type}'
+        if model:
+            base_path, ext = os.path.splitext(os.path.abspath(model))
+            model_paths[name] = f'{base_path}_{model_type}{ext or ".h5"}'
+            model_nums[name] = 0
+        else:
+            model_paths[name], model_nums[name] = \
+                get_model_train_details(database, offset=i)
+        models[name] = get_model_by_type(model_type, cfg)
+
+    tubs = tub_paths.split(',')
+    all_tub_paths = [os.path.expanduser(tub) for tub in tubs]
+    # Models of the same sequence size share a pass over their records, so
+    # each model gets the same records and split as when trained alone.
+    # Single frame models would lose the first records of every run if
+    # they used the windows of sequence models.
+    groups_by_seq_size = defaultdict(dict)
+    for name, kl in models.items():
+        groups_by_seq_size[kl.seq_size()][name] = kl
+    histories = dict()
+    for seq_size, group in groups_by_seq_size.items():
+        if len(groups_by_seq_size) > 1:
+            print(f'Training {", ".join(group)} on sequences of size '
+                  f'{seq_size}')
+        dataset = TubDataset(config=cfg, tub_paths=all_tub_paths,
+                             seq_size=seq_size)
+        records = dataset.get_records()
+        image_cache = dataset.image_cache
+        snapshot = None
+        snapshot_dir = getattr(cfg, 'CACHE_SNAPSHOT_DIR', None)
+        if snapshot_dir:
+            transformation = ImageAugmentation(cfg, 'TRANSFORMATIONS')
+            snapshot = ImageSnapshot.open_or_create(
+                os.path.expanduser(snapshot_dir), cfg, records,
+                transformation)
+            snapshot.attach(records)
+            image_cache = snapshot
+        groups = split_groups(records,
+                              getattr(cfg, 'TRAIN_SPLIT_BY', 'record'),
+                              getattr(cfg, 'TRAIN_SPLIT_BLOCK_SIZE', 100))
+        training_records, validation_records \
+            = train_test_split(records, shuffle=True,
+                               test_size=(1. - cfg.TRAIN_TEST_SPLIT),
+                               seed=getattr(cfg, 'TRAIN_SPLIT_SEED', None),
+                               groups=groups)
+        print(f'Records # Training {len(training_records)}')
+        print(f'Records # Validation {len(validation_records)}')
+
+        training_pipe = MultiBatchSequence(group, cfg, training_records,
+                                           is_train=True, snapshot=snapshot)
+        validation_pipe = MultiBatchSequence(group, cfg, validation_records,
+                                             is_train=False,
+                                             snapshot=snapshot)
+        tune = tf.data.experimental.AUTOTUNE
+        train_size = len(training_pipe)
+        val_size = len(validation_pipe)
+        assert val_size > 0, "Not enough validation data, decrease the " \
+                             "batch size or add more data."
+
+        histories.update(fit_models(
+            group, {name: model_paths[name] for name in group},
+            training_pipe.create_tf_data().prefetch(tune), train_size,
+            validation_pipe.create_tf_data().prefetch(tune), val_size,
+            epochs=cfg.MAX_EPOCHS,
+            verbose=cfg.VERBOSE_TRAIN,
+            min_delta=cfg.MIN_DELTA,
+            patience=cfg.EARLY_STOP_PATIENCE))
+        print(f'Image cache statistics: {image_cache.stats()}')
+        image_cache.clear()
+    histories = {name: histories[name] for name in models}
+
+    for name, kl in models.items():
+        save_model_files(cfg, model_paths[name])
+        add_database_entry(database, cfg, model_paths[name],
+                           model_nums[name], kl, tub_paths, histories[name],
+                           comment=comment)
     database.write()
 
-    return history
+    return histories
+
+
+def benchmark(cfg: Config, tub_paths: str, model_type: str = None,
+              batches: int = 50, warmup: int = 2, model_step: bool = True) \
+        -> Dict[str, Any]:
+    """
+    Runs the training pipeline of the config for a number of batches and
+    times its stages. The first batches warm up the pipeline and are not
+    counted. The image loading is timed separately on the records of the
+    counted batches, split into reading, decoding and resizing.
+
+    :param cfg:         donkey config, TRAIN_DATA_PIPELINE selects the
+                        pipeline
+    :param tub_paths:   comma separated tub paths
+    :param model_type:  model type, defaults to cfg.DEFAULT_MODEL_TYPE
+    :param batches:     number of timed batches
+    :param warmup:      number of batches before the timing starts
+    :param model_step:  if every batch is trained on
+    :return:            reports of the pipeline and the image loading
+    """
+    if model_type is None:
+        model_type = cfg.DEFAULT_MODEL_TYPE
+    kl = get_model_by_type(model_type, cfg)
+    all_tub_paths = [os.path.expanduser(tub) for tub in tub_paths.split(',')]
+    dataset = TubDataset(config=cfg, tub_paths=all_tub_paths,
+                         seq_size=kl.seq_size())
+    records = dataset.get_records()
+    profiler = StageProfiler()
+    pipe = BatchSequence(kl, cfg, records, is_train=True, profiler=profiler)
+    iterator = iter(pipe.create_tf_data().prefetch(
+        tf.data.experimental.AUTOTUNE))
+    if model_step:
+        kl.compile()
+    for i in range(warmup + batches):
+        if i == warmup:
+            profiler.reset()
+        with profiler.stage('batch'):
+            x, y = next(iterator)
+        if model_step:
+            with profiler.stage('model step'):
+                kl.interpreter.model.train_on_batch(x, y)
+        profiler.count(len(next(iter(y.values()))))
+    pipeline_report = profiler.report()
+    pipeline_report['pipeline'] = getattr(cfg, 'TRAIN_DATA_PIPELINE',
+                                          'generator')
+    pipeline_report['model_type'] = model_type
+
+    loading = StageProfiler()
+    size = min(len(records), batches * cfg.BATCH_SIZE)
+    sample = [records[i] for i in range(size)]
+    profile_image_loading(loading, cfg, [r[-1] if isinstance(r, list) else r
+                                         for r in sample])
+    dataset.image_cache.clear()
+    return dict(pipeline=pipeline_report, image_loading=loading.report())
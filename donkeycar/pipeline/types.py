@@ -1,10 +1,13 @@
-import copy
 import os
-from typing import Any, List, Optional, TypeVar, Iterator, Iterable
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Hashable, List, Optional, TypeVar, \
+    Iterator, Iterable, Sequence, Union
 import logging
 import numpy as np
+from PIL import Image
 from donkeycar.config import Config
-from donkeycar.parts.tub_v2 import Tub
+from donkeycar.parts.tub_v2 import Tub, image_file
+from donkeycar.pipeline.cache import ImageCache
 from donkeycar.utils import load_image, load_pil_image
 from typing_extensions import TypedDict
 
@@ -34,11 +37,15 @@ TubRecordDict = TypedDict(
 
 
 class TubRecord(object):
+    __slots__ = ('config', 'base_path', 'underlying', 'image_cache', '_image')
+
     def __init__(self, config: Config, base_path: str,
-                 underlying: TubRecordDict) -> None:
+                 underlying: TubRecordDict,
+                 image_cache: Optional[ImageCache] = None) -> None:
         self.config = config
         self.base_path = base_path
         self.underlying = underlying
+        self.image_cache = image_cache
         self._image: Optional[Any] = None
 
     def image(self, cached=True, as_nparray=True) -> np.ndarray:
@@ -46,15 +53,27 @@ class TubRecord(object):
 
         Args:
             cached (bool, optional): whether to cache the image. Defaults to True.
+                                     With an image cache the image is kept in
+                                     the shared cache, otherwise in the record.
             as_nparray (bool, optional): whether to convert the image to a np array of uint8.
                                          Defaults to True. If false, returns result of Image.open()
 
         Returns:
             np.ndarray: [description]
         """
+        if cached and self.image_cache is not None:
+            key = (self.base_path, self.underlying['cam/image_array'])
+            img_arr = self.image_cache.get(key, self._load_image)
+            if as_nparray or img_arr is None:
+                return img_arr
+            # grey scale images are stored with a depth channel
+            return Image.fromarray(img_arr.squeeze(axis=2)
+                                   if img_arr.shape[2] == 1 else img_arr)
+
         if self._image is None:
             image_path = self.underlying['cam/image_array']
-            full_path = os.path.join(self.base_path, 'images', image_path)
+            # Either the image file or the bytes of a packed image
+            full_path = image_file(self.base_path, image_path)
 
             if as_nparray:
                 _image = load_image(full_path, cfg=self.config)
@@ -68,10 +87,244 @@ class TubRecord(object):
             _image = self._image
         return _image
 
+    def _load_image(self) -> Optional[np.ndarray]:
+        full_path = image_file(self.base_path,
+                               self.underlying['cam/image_array'])
+        return load_image(full_path, cfg=self.config)
+
     def __repr__(self) -> str:
         return repr(self.underlying)
 
 
+class RecordRow(Mapping):
+    """
+    Read only view of a row of a RecordTable, it stands in for the
+    underlying dictionary of a TubRecord. Missing values are missing keys.
+    """
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table: 'RecordTable', row: int) -> None:
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, key: str) -> Any:
+        return self.table.value(key, self.row)
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key in self.table.columns
+                if self.table.has(key, self.row))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class TableRecord(TubRecord):
+    """
+    A row of a RecordTable which acts as TubRecord. Rows are created on
+    access and only reference the table, images are loaded lazily through
+    the image cache of the table.
+    """
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table: 'RecordTable', row: int) -> None:
+        self.table = table
+        self.row = row
+        self.image_cache = table.image_cache
+
+    @property
+    def config(self) -> Config:
+        return self.table.config
+
+    @property
+    def base_path(self) -> str:
+        return self.table.base_paths[self.table.tub[self.row]]
+
+    @property
+    def underlying(self) -> RecordRow:
+        return RecordRow(self.table, self.row)
+
+    def image(self, cached=True, as_nparray=True) -> np.ndarray:
+        """ Like TubRecord.image(), but without an image cache the image is
+            loaded on every call. """
+        if cached and self.image_cache is not None:
+            return super().image(cached, as_nparray)
+        full_path = image_file(self.base_path,
+                               self.underlying['cam/image_array'])
+        if as_nparray:
+            return load_image(full_path, cfg=self.config)
+        return load_pil_image(full_path, cfg=self.config)
+
+    def _load_image(self) -> Optional[np.ndarray]:
+        full_path = image_file(self.base_path,
+                               self.underlying['cam/image_array'])
+        return load_image(full_path, cfg=self.config)
+
+    def __repr__(self) -> str:
+        return repr(self.underlying)
+
+
+class RecordTable(object):
+    """
+    Compact table of the records of tubs. Every record key is a typed NumPy
+    column built from the ColumnCache of the tubs, rows without a value are
+    flagged in a mask. Indexing returns TableRecord views, index arrays and
+    slices return sub tables, so datasets with millions of records never
+    hold a python object per record.
+    """
+
+    def __init__(self, config: Config, base_paths: List[str],
+                 tub: np.ndarray, columns: Dict[str, np.ndarray],
+                 masks: Dict[str, np.ndarray],
+                 image_cache: Optional[ImageCache] = None) -> None:
+        """
+        :param config:      donkey config
+        :param base_paths:  base paths of the tubs
+        :param tub:         position of the tub in base_paths for each row
+        :param columns:     record key and column
+        :param masks:       record key and mask of the missing values
+        :param image_cache: image cache shared by all rows
+        """
+        self.config = config
+        self.base_paths = base_paths
+        self.tub = tub
+        self.columns = columns
+        self.masks = masks
+        self.image_cache = image_cache
+
+    @classmethod
+    def from_tubs(cls, config: Config, tubs: List[Tub],
+                  image_cache: Optional[ImageCache] = None) \
+            -> 'RecordTable':
+        """ Loads the columns of the tubs into one table. """
+        parts = [tub.columns() for tub in tubs]
+        sizes = [len(part['_index']) for part in parts]
+        keys = list(dict.fromkeys(key for part in parts for key in part))
+        columns, masks = dict(), dict()
+        for key in keys:
+            template = next(part[key] for part in parts if key in part)
+            data, missing = list(), list()
+            for part, size in zip(parts, sizes):
+                if key in part:
+                    column = part[key]
+                    mask = np.ma.getmaskarray(column)
+                    data.append(np.ma.getdata(column))
+                    missing.append(mask.reshape(size, -1).all(axis=1)
+                                   if mask.ndim > 1 else mask)
+                else:
+                    data.append(np.zeros((size,) + template.shape[1:],
+                                         dtype=template.dtype))
+                    missing.append(np.ones(size, dtype=bool))
+            try:
+                columns[key] = np.concatenate(data)
+            except ValueError:
+                # shapes differ between the tubs, keep python values
+                column = np.empty(sum(sizes), dtype=object)
+                for i, value in enumerate(v for d in data for v in d.tolist()):
+                    column[i] = value
+                columns[key] = column
+            mask = np.concatenate(missing)
+            if mask.any():
+                masks[key] = mask
+        tub = np.repeat(np.arange(len(tubs), dtype=np.int32), sizes)
+        return cls(config, [tub.base_path for tub in tubs], tub, columns,
+                   masks, image_cache)
+
+    def column(self, key: str, fill: Any) -> np.ndarray:
+        """ Column of the record key with fill for missing values. """
+        if key not in self.columns:
+            return np.full(len(self), fill)
+        column = self.columns[key]
+        if key in self.masks:
+            column = column.copy()
+            column[self.masks[key]] = fill
+        return column
+
+    def has(self, key: str, row: int) -> bool:
+        return key in self.columns \
+            and not (key in self.masks and self.masks[key][row])
+
+    def value(self, key: str, row: int) -> Any:
+        """ Value of the record key in the row as python type. """
+        if not self.has(key, row):
+            raise KeyError(key)
+        value = self.columns[key][row]
+        if isinstance(value, (np.ndarray, np.generic)):
+            return value.tolist()
+        return value
+
+    def take(self, indices: np.ndarray) -> 'RecordTable':
+        """
+        :param indices: row positions or boolean mask of the rows
+        :return:        table of these rows
+        """
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        return RecordTable(self.config, self.base_paths, self.tub[indices],
+                           {k: c[indices] for k, c in self.columns.items()},
+                           {k: m[indices] for k, m in self.masks.items()},
+                           self.image_cache)
+
+    def filter(self, predicate: Callable[[TableRecord], bool]) \
+            -> 'RecordTable':
+        """ Table of the rows for which the predicate is true. """
+        keep = np.fromiter((bool(predicate(record)) for record in self),
+                           dtype=bool, count=len(self))
+        return self.take(keep)
+
+    def __len__(self) -> int:
+        return len(self.tub)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return TableRecord(self, range(len(self))[item])
+        if isinstance(item, slice):
+            return self.take(np.arange(len(self))[item])
+        return self.take(item)
+
+    def __iter__(self) -> Iterator[TableRecord]:
+        for row in range(len(self)):
+            yield TableRecord(self, row)
+
+
+class SequenceTable(object):
+    """
+    Sequences of rows of a RecordTable given by an index array of windows,
+    see sequence_windows(). Indexing returns a sequence as list of
+    TableRecord views.
+    """
+
+    def __init__(self, table: RecordTable, windows: np.ndarray) -> None:
+        self.table = table
+        self.windows = windows
+
+    @property
+    def image_cache(self) -> Optional[ImageCache]:
+        return self.table.image_cache
+
+    @image_cache.setter
+    def image_cache(self, image_cache: Optional[ImageCache]) -> None:
+        self.table.image_cache = image_cache
+
+    def take(self, indices: np.ndarray) -> 'SequenceTable':
+        return SequenceTable(self.table, self.windows[indices])
+
+    def __len__(self) -> int:
+        return len(self.windows)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return [self.table[i] for i in self.windows[item]]
+        return self.take(item)
+
+    def __iter__(self) -> Iterator[List[TableRecord]]:
+        for i in range(len(self)):
+            yield self[i]
+
+
 class TubDataset(object):
     """
     Loads the dataset and creates a TubRecord list (or list of lists).
@@ -84,23 +337,140 @@ class TubDataset(object):
         self.tubs: List[Tub] = [Tub(tub_path, read_only=True)
                                 for tub_path in self.tub_paths]
         self.records: List[TubRecord] = list()
+        # with sequences the records are windows into the frames
+        self.frames: List[TubRecord] = list()
+        self.windows: Optional[np.ndarray] = None
         self.train_filter = getattr(config, 'TRAIN_FILTER', None)
         self.seq_size = seq_size
+        # decoded images are shared by all records within a memory budget
+        self.image_cache = ImageCache.from_config(config)
 
     def get_records(self):
+        """
+        :return: list of TubRecord or sequences of them. With
+                 TRAIN_RECORD_TABLE a RecordTable or SequenceTable which
+                 index like these lists.
+        """
+        if getattr(self.config, 'TRAIN_RECORD_TABLE', False):
+            return self.get_table()
         if not self.records:
             logger.info(f'Loading tubs from paths {self.tub_paths}')
             for tub in self.tubs:
-                for underlying in tub:
-                    record = TubRecord(self.config, tub.base_path, underlying)
+                for underlying in tub.load_records():
+                    record = TubRecord(self.config, tub.base_path,
+                                       underlying, self.image_cache)
                     if not self.train_filter or self.train_filter(record):
                         self.records.append(record)
             if self.seq_size > 0:
+                # all windows share the frame records and their images
                 seq = Collator(self.seq_size, self.records)
-                self.records = list(seq)
+                self.frames = self.records
+                self.windows = seq.windows()
+                self.records = [[self.frames[i] for i in window]
+                                for window in self.windows]
+        return self.records
+
+    def get_table(self) -> Union['RecordTable', 'SequenceTable']:
+        """
+        Loads the records into a RecordTable, for sequences the windows
+        into the table are returned as SequenceTable.
+        """
+        if not len(self.records):
+            logger.info(f'Loading tubs from paths {self.tub_paths} into a '
+                        f'record table')
+            table = RecordTable.from_tubs(self.config, self.tubs,
+                                          self.image_cache)
+            if self.train_filter:
+                table = table.filter(self.train_filter)
+            self.records = table
+            if self.seq_size > 0:
+                self.frames = table
+                self.windows = sequence_windows(table, self.seq_size)
+                self.records = SequenceTable(table, self.windows)
         return self.records
 
 
+def split_groups(records: Union[List[Union[TubRecord, List[TubRecord]]],
+                                RecordTable, SequenceTable],
+                 split_by: str = 'record',
+                 block_size: int = 100) -> Optional[Sequence[Hashable]]:
+    """
+    Group keys of the records for train_test_split_indices(). Sequences are
+    grouped by their first record.
+
+    :param records:     list of TubRecord or sequences of them, or a table
+    :param split_by:    record|session|tub|block, records don't need groups,
+                        sessions are identified within their tub and blocks
+                        are runs of block_size neighbouring records
+    :param block_size:  number of records in a block
+    :return:            group keys or None for record splits
+    """
+    if split_by not in ('record', 'session', 'tub', 'block'):
+        raise ValueError(f'Unknown split {split_by}, supported are record, '
+                         f'session, tub and block')
+    if split_by == 'record':
+        return None
+    if split_by == 'block':
+        return [i // block_size for i in range(len(records))]
+    if isinstance(records, (RecordTable, SequenceTable)):
+        # the first rows of the records, straight from the columns
+        table, rows = (records.table, records.windows[:, 0]) \
+            if isinstance(records, SequenceTable) \
+            else (records, np.arange(len(records)))
+        tub = table.tub[rows]
+        if split_by == 'tub':
+            return tub
+        session = table.column('_session_id', '')[rows]
+        return np.char.add(np.char.add(tub.astype(np.str_), '/'),
+                           session.astype(np.str_))
+    firsts = [r[0] if isinstance(r, list) else r for r in records]
+    if split_by == 'session':
+        return [(r.base_path, r.underlying.get('_session_id'))
+                for r in firsts]
+    return [r.base_path for r in firsts]
+
+
+def sequence_windows(records: Union[List[TubRecord], RecordTable],
+                     seq_length: int) -> np.ndarray:
+    """
+    Finds all windows of seq_length continuous records, see
+    Collator.is_continuous(). Records of different tubs are never continuous.
+    The continuity of neighbours is computed once for all records with numpy,
+    a window is valid if it contains no break.
+
+    :param records:     list of records or a RecordTable
+    :param seq_length:  length of the windows
+    :return:            int array of shape (windows, seq_length) with the
+                        positions of the window's records in the list
+    """
+    size = len(records)
+    if seq_length < 1 or size < seq_length:
+        return np.empty((0, max(seq_length, 0)), dtype=np.int64)
+    if isinstance(records, RecordTable):
+        indexes = records.column('_index', -1).astype(np.int64)
+        empty = np.zeros(size, dtype=bool)
+        gap = records.column('_gap', False).astype(bool)
+        tub = records.tub
+    else:
+        indexes = np.fromiter((r.underlying['_index'] for r in records),
+                              dtype=np.int64, count=size)
+        empty = np.fromiter(('__empty__' in r.underlying for r in records),
+                            dtype=bool, count=size)
+        gap = np.fromiter((bool(r.underlying.get('_gap', False))
+                           for r in records), dtype=bool, count=size)
+        tubs = dict()
+        tub = np.fromiter((tubs.setdefault(r.base_path, len(tubs))
+                           for r in records), dtype=np.int64, count=size)
+    continuous = (np.diff(indexes) == 1) & (np.diff(tub) == 0) \
+        & ~empty[:-1] & ~empty[1:] & ~gap[1:]
+    # number of breaks before each record, equal at both ends of a window
+    # without a break
+    breaks = np.concatenate(([0], np.cumsum(~continuous)))
+    starts = np.flatnonzero(breaks[seq_length - 1:]
+                            == breaks[:size - seq_length + 1])
+    return starts[:, np.newaxis] + np.arange(seq_length)
+
+
 class Collator(Iterable[List[TubRecord]]):
     """" Builds a sequence of continuous records for RNN and similar models. """
     def __init__(self, seq_length: int, records: List[TubRecord]):
@@ -114,30 +484,26 @@ class Collator(Iterable[List[TubRecord]]):
     @staticmethod
     def is_continuous(rec_1: TubRecord, rec_2: TubRecord) -> bool:
         """
-        Checks if second record is next to first record
+        Checks if second record is next to first record. Records which
+        followed records dropped by a tub compaction are marked with '_gap'.
         :param rec_1:   first record
         :param rec_2:   second record
         :return:        if first record is followed by second record
         """
         it_is = rec_1.underlying['_index'] == rec_2.underlying['_index'] - 1 \
                 and '__empty__' not in rec_1.underlying \
-                and '__empty__' not in rec_2.underlying
+                and '__empty__' not in rec_2.underlying \
+                and not rec_2.underlying.get('_gap', False)
         return it_is
 
+    def windows(self) -> np.ndarray:
+        """ Positions of the records of all sequences, see
+            sequence_windows(). """
+        return sequence_windows(self.records, self.seq_length)
+
     def __iter__(self) -> Iterator[List[TubRecord]]:
         """ Iterable interface. Returns a generator as Iterator. """
-        it = iter(self.records)
-        for this_record in it:
-            seq = [this_record]
-            seq_it = copy.copy(it)
-            for next_record in seq_it:
-                if self.is_continuous(this_record, next_record) and \
-                        len(seq) < self.seq_length:
-                    seq.append(next_record)
-                    this_record = next_record
-                else:
-                    break
-            if len(seq) == self.seq_length:
-                yield seq
+        for window in self.windows():
+            yield [self.records[i] for i in window]
 
 
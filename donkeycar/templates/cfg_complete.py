@@ -122,11 +122,14 @@ DEFAULT_AI_FRAMEWORK = 'tensorflow'
 # time. This chooses between different neural network designs. You can
 # override this setting by passing the command line parameter --type to the
 # python manage.py train and drive commands.
-# tensorflow models: (linear|categorical|tflite_linear|tensorrt_linear)
+# tensorflow models: (linear|categorical|tflite_linear|tensorrt_linear|onnx_linear)
 # pytorch models: (resnet18)
 DEFAULT_MODEL_TYPE = 'linear'
 BATCH_SIZE = 128                #how many records to use when doing one pass of gradient decent. Use a smaller number if your gpu is running out of memory.
 TRAIN_TEST_SPLIT = 0.8          #what percent of records to use for training. the remaining used for validation.
+TRAIN_SPLIT_BY = 'record'       # record|session|tub|block, session, tub and block keep neighbouring frames together so they don't leak into validation
+TRAIN_SPLIT_BLOCK_SIZE = 100    # number of neighbouring records in a block for TRAIN_SPLIT_BY = 'block'
+TRAIN_SPLIT_SEED = None         # seed of the train/validation split, None is random
 MAX_EPOCHS = 100                #how many times to visit all records of your data
 SHOW_PLOT = True                #would you like to see a pop up display of final loss?
 VERBOSE_TRAIN = True            #would you like to see a progress bar with text during training?
@@ -140,6 +143,32 @@ LEARNING_RATE_DECAY = 0.0       #only used when OPTIMIZER specified
 SEND_BEST_MODEL_TO_PI = False   #change to true to automatically send best model during training
 CREATE_TF_LITE = True           # automatically create tflite model in training
 CREATE_TENSOR_RT = False        # automatically create tensorrt model in training
+CREATE_ONNX_MODEL = False       # automatically create onnx model in training, requires tf2onnx for keras models and onnx for pytorch models
+ONNX_OPSET = 13                 # onnx opset version of the exported models
+CACHE_IMAGES_MB = 1024          # memory budget of decoded training images, least recently used images are dropped first. pytorch DataLoader workers divide it between them. 0 disables the cache
+CACHE_IMAGES_SPILL_DIR = None   # directory to spill dropped images to a local file instead, so later epochs skip jpeg decoding
+CACHE_SNAPSHOT_DIR = None       # directory for snapshots of the decoded and transformed training images, trainings on the same data and image settings then only run the augmentations. None disables snapshots
+TRAIN_DATA_PIPELINE = 'generator' # generator|native|stream, native reads and augments the images with parallel tf.data ops instead of a python generator, stream reads blocks of neighbouring records in shuffled order for tubs on slow disks
+STREAM_BLOCK_SIZE = 256         # stream: number of neighbouring records read in one go
+STREAM_BUFFER_SIZE = 2048       # stream: records are drawn at random from a buffer of this size
+STREAM_READAHEAD = 2            # stream: number of blocks read ahead in a background thread
+STREAM_SEED = None              # stream: seed of the block and record order, None is random
+TRAIN_RECORD_TABLE = False      # keep the training records in a compact table of NumPy columns instead of one python object per record, for datasets with millions of records
+TORCH_NUM_WORKERS = 0           # pytorch: number of DataLoader worker processes, 0 loads in the training process which also works on Macs and Windows
+TORCH_PIN_MEMORY = None         # pytorch: collate batches into page locked memory for faster copies to the gpu, None pins when cuda is available
+TORCH_TENSOR_CACHE_MB = 0       # pytorch: shared memory budget of the transformed image tensors, which are then computed once for all workers and epochs. training and validation data share it. docker limits /dev/shm to 64MB by default
+MODEL_DTYPE = 'float32'         # float32|float16|float64, type of the inputs and labels fed to the model in training and driving
+MODEL_IMAGE_DTYPE = None        # type of the image input, None uses MODEL_DTYPE. uint8 feeds the raw images, only use it for models which normalize internally
+KERAS_COMPILED_INFERENCE = True # run keras pilots through a tf.function traced for single frames when driving, instead of calling the model eagerly
+KERAS_XLA_INFERENCE = False     # also compile that function with XLA, the first frame takes longer
+TFLITE_NUM_THREADS = None       # cpu threads of the tflite interpreter, None uses all cores
+TFLITE_XNNPACK = True           # run float tflite models through the XNNPACK delegate
+TFLITE_DELEGATE = None          # library of an external tflite delegate, e.g. 'libedgetpu.so.1' for the Coral TPU
+TFLITE_DELEGATE_OPTIONS = None  # dict of options passed to that delegate
+ONNX_GRAPH_OPTIMIZATION = 'all' # onnx_ models: graph optimization level of onnxruntime (disable|basic|extended|all)
+ONNX_INTRA_OP_THREADS = None    # onnx_ models: threads used within an operator, None uses all cores
+ONNX_INTER_OP_THREADS = None    # onnx_ models: threads running independent operators in parallel, None runs them sequentially
+ONNX_PROVIDERS = None           # onnx_ models: list of onnxruntime execution providers in order of preference, None uses the cpu
 
 PRUNE_CNN = False               #This will remove weights from your model. The primary goal is to increase performance.
 PRUNE_PERCENT_TARGET = 75       # The desired percentage of pruning.
@@ -154,6 +183,8 @@ TRANSFORMATIONS = []
 # AUGMENTATIONS
 AUG_MULTIPLY_RANGE = (0.5, 1.5)
 AUG_BLUR_RANGE = (0.0, 3.0)
+AUG_BACKEND = 'cv2'             # cv2|imgaug, cv2 applies the augmentations and transformations to whole batches with cv2 and NumPy
+AUG_SEED = None                 # seed of the random augmentations for reproducible trainings
 # Region of interest cropping, requires 'CROP' in TRANSFORMATIONS to be set
 # If these crops values are too large, they will cause the stride values to
 # become negative and the model with not be valid.
@@ -263,6 +294,13 @@ HAVE_PERFMON = False
 #RECORD OPTIONS
 RECORD_DURING_AI = False        #normally we do not record during ai mode. Set this to true to get image and steering records for your Ai. Be careful not to use them to train.
 AUTO_CREATE_NEW_TUB = False     #create a new tub (tub_YY_MM_DD) directory when recording or append records to data directory directly
+TUB_PACKED_IMAGES = False       #append the jpg images of each catalog to one packed file instead of writing one file per image
+TUB_WRITER_ASYNC = False        #write records in a background thread, so image encoding and disk writes don't slow down the drive loop
+TUB_WRITER_QUEUE_SIZE = 100     #how many records can wait for the background writer
+TUB_WRITER_OVERFLOW = 'block'   #what to do if the queue is full (block|drop_oldest|drop_newest)
+TUB_WRITER_ENCODER_THREADS = 2  #how many threads encode the jpg images
+TUB_WRITER_MAX_BATCH = 50       #maximum number of records appended to the catalog at once
+TUB_WRITER_FSYNC_INTERVAL = None #None only flushes the catalog, 0 forces it to disk after each batch, >0 seconds between forcing it to disk
 
 #LED
 HAVE_RGB_LED = False            #do you have an RGB LED like https://www.amazon.com/dp/B07BNRZWNF
@@ -22,7 +22,7 @@ from docopt import docopt
 
 import donkeycar as dk
 from donkeycar.parts.transform import TriggeredCallback, DelayedTrigger
-from donkeycar.parts.tub_v2 import TubWriter
+from donkeycar.parts.tub_v2 import TubWriter, AsyncTubWriter
 from donkeycar.parts.datastore import TubHandler
 from donkeycar.parts.controller import LocalWebController, WebFpv, JoystickController
 from donkeycar.parts.throttle_filter import ThrottleFilter
@@ -418,7 +418,8 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None,
         model_reload_cb = None
 
         if '.h5' in model_path or '.trt' in model_path or '.tflite' in \
-                model_path or '.savedmodel' in model_path:
+                model_path or '.savedmodel' in model_path or '.onnx' in \
+                model_path:
             # load the whole model with weigths, etc
             load_model(kl, model_path)
 
@@ -692,8 +693,22 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None,
     # do we want to store new records into own dir or append to existing
     tub_path = TubHandler(path=cfg.DATA_PATH).create_tub_path() if \
         cfg.AUTO_CREATE_NEW_TUB else cfg.DATA_PATH
-    tub_writer = TubWriter(tub_path, inputs=inputs, types=types, metadata=meta)
-    V.add(tub_writer, inputs=inputs, outputs=["tub/num_records"], run_condition='recording')
+    if getattr(cfg, 'TUB_WRITER_ASYNC', False):
+        tub_writer = AsyncTubWriter(
+            tub_path, inputs=inputs, types=types, metadata=meta,
+            packed_images=getattr(cfg, 'TUB_PACKED_IMAGES', False),
+            queue_size=cfg.TUB_WRITER_QUEUE_SIZE,
+            overflow=cfg.TUB_WRITER_OVERFLOW,
+            encoder_threads=cfg.TUB_WRITER_ENCODER_THREADS,
+            max_batch=cfg.TUB_WRITER_MAX_BATCH,
+            fsync_interval=cfg.TUB_WRITER_FSYNC_INTERVAL)
+        V.add(tub_writer, inputs=inputs,
+              outputs=["tub/num_records", "tub/queue_depth", "tub/dropped"],
+              run_condition='recording')
+    else:
+        tub_writer = TubWriter(tub_path, inputs=inputs, types=types, metadata=meta,
+                               packed_images=getattr(cfg, 'TUB_PACKED_IMAGES', False))
+        V.add(tub_writer, inputs=inputs, outputs=["tub/num_records"], run_condition='recording')
 
     # Telemetry (we add the same metrics added to the TubHandler
     if cfg.HAVE_MQTT_TELEMETRY:
@@ -715,7 +730,7 @@ def drive(cfg, model_path=None, use_joystick=False, model_type=None,
     elif (cfg.CONTROLLER_TYPE != "pigpio_rc") and (cfg.CONTROLLER_TYPE != "MM1"):
         if isinstance(ctr, JoystickController):
             print("You can now move your joystick to drive your car.")
-            ctr.set_tub(tub_writer.tub)
+            ctr.set_tub(tub_writer)
             ctr.print_controls()
 
     # run the vehicle
@@ -1,3 +1,4 @@
+import json
 import os
 import shutil
 import tempfile
@@ -5,7 +6,8 @@ import time
 import unittest
 from pathlib import Path
 
-from donkeycar.parts.datastore_v2 import Catalog, CatalogMetadata, Seekable
+from donkeycar.parts.datastore_v2 import Catalog, CatalogMetadata, \
+    LineIndex, Seekable
 
 
 class TestCatalog(unittest.TestCase):
@@ -33,6 +35,90 @@ class TestCatalog(unittest.TestCase):
 
         self.assertEqual(count, 10)
 
+    def test_catalog_index(self):
+        catalog = Catalog(self._catalog_path)
+        for i in range(0, 10):
+            catalog.write_record(self._newRecord())
+        catalog.close()
+
+        # Offsets live in the append-only index, not in the catalog manifest
+        index_path = catalog.manifest.index_path
+        self.assertEqual(os.path.getsize(index_path), 10 * LineIndex.ENTRY.size)
+        catalog_2 = Catalog(self._catalog_path, read_only=True)
+        self.assertEqual(catalog_2.manifest.line_lengths(), [])
+        self.assertEqual(catalog_2.seekable.lines(), 10)
+        catalog_2.seekable.seek_line_start(10)
+        self.assertTrue(catalog_2.seekable.readline().startswith('{"at"'))
+        catalog_2.close()
+
+    def test_migrate_line_lengths(self):
+        # Write a catalog in the format which stores line lengths in the
+        # catalog manifest
+        lines = [json.dumps(self._newRecord()) for _ in range(5)]
+        with open(self._catalog_path, 'w') as f:
+            f.writelines(f'{line}\n' for line in lines)
+        metadata = CatalogMetadata(self._catalog_path)
+        metadata.contents['line_lengths'] = [len(line) + 1 for line in lines]
+        metadata._update()
+        metadata.close()
+
+        catalog = Catalog(self._catalog_path)
+        self.assertTrue(catalog.manifest.index_path.exists())
+        self.assertEqual(catalog.manifest.line_lengths(), [])
+        self.assertEqual(catalog.seekable.lines(), 5)
+        catalog.write_record(self._newRecord())
+        catalog.close()
+
+        catalog_2 = Catalog(self._catalog_path, read_only=True)
+        self.assertEqual(catalog_2.seekable.lines(), 6)
+        catalog_2.seekable.seek_line_start(3)
+        self.assertEqual(catalog_2.seekable.readline(), lines[2])
+        catalog_2.close()
+
+    def test_stale_index_is_rebuilt(self):
+        catalog = Catalog(self._catalog_path)
+        for i in range(0, 3):
+            catalog.write_record(self._newRecord())
+        catalog.close()
+        # Simulate a record which made it into the catalog but not the index
+        with open(self._catalog_path, 'a') as f:
+            f.write(json.dumps(self._newRecord()) + '\n')
+
+        catalog_2 = Catalog(self._catalog_path)
+        self.assertEqual(catalog_2.seekable.lines(), 4)
+        catalog_2.close()
+        self.assertEqual(os.path.getsize(catalog_2.manifest.index_path),
+                         4 * LineIndex.ENTRY.size)
+
+    def test_stale_index_of_writer_is_replaced(self):
+        catalog = Catalog(self._catalog_path)
+        for i in range(0, 3):
+            catalog.write_record(self._newRecord())
+        # A record which the writer has flushed but not yet indexed
+        line = json.dumps(self._newRecord())
+        catalog.seekable.file.write(line + '\n')
+        catalog.seekable.file.flush()
+
+        catalog_2 = Catalog(self._catalog_path)
+        self.assertEqual(catalog_2.seekable.lines(), 4)
+        catalog_2.close()
+        # The writer indexes its record in the replaced index file
+        catalog.seekable.total_length += len(line) + 1
+        catalog.index.extend([catalog.seekable.total_length])
+        catalog.write_record(self._newRecord())
+        catalog.close()
+
+        catalog_3 = Catalog(self._catalog_path, read_only=True)
+        self.assertEqual(catalog_3.seekable.lines(), 5)
+        catalog_3.close()
+        catalog_4 = Catalog(self._catalog_path)
+        self.assertEqual(catalog_4.seekable.lines(), 5)
+        catalog_4.seekable.seek_line_start(4)
+        self.assertEqual(catalog_4.seekable.readline(), line)
+        catalog_4.close()
+        self.assertEqual(os.path.getsize(catalog_4.manifest.index_path),
+                         5 * LineIndex.ENTRY.size)
+
     def tearDown(self):
         shutil.rmtree(self._path)
 
@@ -1,11 +1,13 @@
 import os
 import shutil
 import tempfile
+import json
+import random
 import time
 import unittest
 from pathlib import Path
 
-from donkeycar.parts.datastore_v2 import Manifest
+from donkeycar.parts.datastore_v2 import DeletedIndexes, Manifest
 
 
 class TestDatastore(unittest.TestCase):
@@ -82,6 +84,106 @@ class TestDatastore(unittest.TestCase):
 
         self.assertEqual(10, read_records)
 
+    def test_current_index_without_close(self):
+        manifest = Manifest(self._path, max_len=3)
+        for i in range(7):
+            manifest.write_record(self._newRecord())
+        # Records are written but the manifest is never closed, like after a
+        # power cut on the car.
+        manifest_2 = Manifest(self._path, max_len=3)
+        self.assertEqual(manifest_2.current_index, 7)
+        self.assertEqual(len(manifest_2), 7)
+        manifest_2.write_record(self._newRecord())
+        manifest_2.close()
+
+        manifest_3 = Manifest(self._path, read_only=True)
+        self.assertEqual(len(manifest_3.catalog_paths), 3)
+        self.assertEqual(len(list(manifest_3)), 8)
+        manifest_3.close()
+
+    def test_deletions_log(self):
+        manifest = Manifest(self._path, max_len=4)
+        for i in range(20):
+            manifest.write_record({'i': i})
+        manifest.delete_records(range(2, 12))
+        manifest.restore_records({5, 6})
+        manifest.delete_records(15)
+        # Deletions are only logged, the manifest is not rewritten
+        self.assertGreater(os.path.getsize(manifest.deletions_path), 0)
+        expected = [i for i in range(20) if i not in
+                    set(range(2, 5)) | set(range(7, 12)) | {15}]
+        self.assertEqual([r['i'] for r in manifest], expected)
+
+        # A second reader replays the log without the manifest being closed
+        manifest_2 = Manifest(self._path, read_only=True)
+        self.assertEqual([r['i'] for r in manifest_2], expected)
+        manifest_2.close()
+
+        manifest.close()
+        self.assertEqual(os.path.getsize(manifest.deletions_path), 0)
+        manifest_3 = Manifest(self._path, read_only=True)
+        self.assertEqual(manifest_3.deleted_indexes.runs(),
+                         [[2, 5], [7, 12], [15, 16]])
+        self.assertEqual(len(manifest_3), len(expected))
+        manifest_3.close()
+
+    def test_legacy_deleted_indexes(self):
+        manifest = Manifest(self._path, max_len=4)
+        for i in range(10):
+            manifest.write_record({'i': i})
+        manifest.close()
+        # Manifests used to store a list of all deleted indexes
+        lines = manifest.manifest_path.read_text().splitlines()
+        catalog_metadata = json.loads(lines[4])
+        del catalog_metadata['deleted_runs']
+        catalog_metadata['deleted_indexes'] = [7, 1, 2]
+        lines[4] = json.dumps(catalog_metadata)
+        manifest.manifest_path.write_text('\n'.join(lines) + '\n')
+        manifest_2 = Manifest(self._path, read_only=True)
+        self.assertEqual([r['i'] for r in manifest_2], [0, 3, 4, 5, 6, 8, 9])
+        manifest_2.close()
+
+    def test_deleted_indexes_queries(self):
+        random.seed(42)
+        deleted = DeletedIndexes()
+        reference = set()
+        for _ in range(200):
+            indexes = set(random.sample(range(100), random.randint(1, 8)))
+            if random.random() < 0.6:
+                deleted.update(indexes)
+                reference |= indexes
+            else:
+                deleted.difference_update(indexes)
+                reference -= indexes
+            self.assertEqual(list(deleted), sorted(reference))
+            self.assertEqual(len(deleted), len(reference))
+        alive = [i for i in range(100) if i not in reference]
+        for i in range(100):
+            self.assertEqual(i in deleted, i in reference)
+            self.assertEqual(deleted.next_alive(i),
+                             min([a for a in alive if a >= i], default=100))
+        for n in (0, 1, 5, 30, 200):
+            self.assertEqual(deleted.last_alive(n, 100), alive[-n:] if n else [])
+        self.assertEqual(deleted.last_alive(3, 50),
+                         [a for a in alive if a < 50][-3:])
+
+    def test_iteration_leaves_catalog_index_alone(self):
+        manifest = Manifest(self._path, max_len=2)
+        for i in range(3):
+            manifest.write_record(self._newRecord())
+        # A record which a writer has flushed but not yet indexed
+        catalog_path = os.path.join(self._path, manifest.catalog_paths[-1])
+        with open(catalog_path, 'a') as f:
+            f.write(json.dumps(self._newRecord()) + '\n')
+        index_path = catalog_path + '_index'
+        index_stat = os.stat(index_path)
+
+        self.assertEqual(len(list(manifest)), 4)
+        stat = os.stat(index_path)
+        self.assertEqual((stat.st_ino, stat.st_size),
+                         (index_stat.st_ino, index_stat.st_size))
+        manifest.close()
+
     def tearDown(self):
         shutil.rmtree(self._path)
 
@@ -5,8 +5,8 @@ from pytest import approx
 import pytest
 import os
 
-from donkeycar.parts.interpreter import keras_to_tflite, \
-    saved_model_to_tensor_rt, TfLite, TensorRT
+from donkeycar.parts.interpreter import keras_to_tflite, keras_to_onnx, \
+    saved_model_to_tensor_rt, TfLite, TensorRT, OnnxInterpreter
 from donkeycar.parts.keras import *
 from donkeycar.utils import get_test_img
 
@@ -20,12 +20,21 @@ def tmp_dir() -> str:
     shutil.rmtree(tmp_dir)
 
 
+def has_onnx() -> bool:
+    try:
+        import onnxruntime
+        import tf2onnx
+        return True
+    except ImportError:
+        return False
+
+
 test_data = [KerasLinear, KerasCategorical, KerasInferred, KerasLSTM,
              KerasLocalizer, KerasIMU, Keras3D_CNN, KerasMemory,
              KerasBehavioral]
 
 
-def create_models(keras_pilot, dir):
+def create_models(keras_pilot, dir, tensor_rt=True):
     # build with keras interpreter
     interpreter = KerasInterpreter()
     km = keras_pilot(interpreter=interpreter)
@@ -41,7 +50,7 @@ def create_models(keras_pilot, dir):
     savedmodel_path = os.path.join(dir, 'model.savedmodel')
     interpreter.model.save(savedmodel_path)
 
-    if keras_pilot is not KerasLSTM:
+    if tensor_rt and keras_pilot is not KerasLSTM:
         # convert to tensorrt and load
         tensorrt_path = os.path.join(dir, 'model.trt')
         saved_model_to_tensor_rt(savedmodel_path, tensorrt_path)
@@ -88,5 +97,168 @@ def test_keras_vs_tflite_and_tensorrt(keras_pilot, tmp_dir):
     print(out1, out2, out3)
 
 
+@pytest.mark.parametrize('keras_pilot', test_data)
+def test_inference_batch(keras_pilot, tmp_dir):
+    """ Batched inference matches inferencing the samples one by one """
+    km, kl, _ = create_models(keras_pilot, tmp_dir, tensor_rt=False)
+    x_shapes = km.output_shapes()[0]
+    batch_size = 5
+    inputs = [{k: np.random.rand(*shape).astype(np.float32)
+               for k, shape in x_shapes.items()} for _ in range(batch_size)]
+    batch = {k: np.stack([x[k] for x in inputs]) for k in x_shapes}
+    for pilot in (km, kl):
+        if pilot is None:
+            continue
+        outputs = pilot.inference_batch(batch)
+        assert all(len(out) == batch_size for out in outputs)
+        for i, x in enumerate(inputs):
+            single = pilot.inference_from_dict(dict(x))
+            assert [out[i] for out in outputs] == \
+                approx(list(single), rel=TOLERANCE, abs=TOLERANCE)
+        # single inference still works after a batch
+        assert pilot.inference_from_dict(dict(inputs[0])) == \
+            approx([out[0] for out in outputs], rel=TOLERANCE, abs=TOLERANCE)
+
+
+@pytest.mark.parametrize('keras_pilot', [KerasLinear, KerasInferred])
+def test_tflite_quantized(keras_pilot, tmp_dir):
+    """ Quantized tflite models take the raw images and agree with the
+        float models, and the thread and xnnpack options don't change the
+        results """
+    # the quantization error depends on the weights and the data
+    np.random.seed(42)
+    tf.random.set_seed(42)
+    interpreter = KerasInterpreter()
+    km = keras_pilot(interpreter=interpreter)
+
+    def data_gen():
+        for _ in range(10):
+            yield [np.random.rand(1, *km.input_shape).astype(np.float32)]
+
+    float_path = os.path.join(tmp_dir, 'model.tflite')
+    keras_to_tflite(interpreter.model, float_path)
+    quant_path = os.path.join(tmp_dir, 'model_quant.tflite')
+    keras_to_tflite(interpreter.model, quant_path, data_gen)
+    img = get_test_img(km)
+    out = km.run(img)
+
+    for tflite in (TfLite(num_threads=1, xnnpack=False),
+                   TfLite(num_threads=2)):
+        kl = keras_pilot(interpreter=tflite)
+        kl.load(float_path)
+        assert kl.image_dtype == np.float32
+        assert kl.run(img) == approx(out, rel=TOLERANCE, abs=TOLERANCE)
+
+    kq = keras_pilot(interpreter=TfLite())
+    kq.load(quant_path)
+    assert kq.image_dtype == np.uint8
+    out_quant = kq.run(img)
+    assert out_quant == approx(out, abs=0.01)
+    # float images are quantized on the way
+    kq.image_dtype = np.dtype(np.float32)
+    assert kq.run(img) == approx(out_quant, rel=TOLERANCE, abs=TOLERANCE)
+    assert kq.interpreter.latency_stats()['calls'] == 2
+
 
+@pytest.mark.parametrize('keras_pilot', [KerasLinear, KerasCategorical,
+                                         KerasIMU, KerasMemory, KerasLSTM])
+def test_compiled_inference(keras_pilot):
+    """ The compiled interpreters match the eager one """
+    eager = KerasInterpreter(compiled=False)
+    km = keras_pilot(interpreter=eager)
+    x_shapes = km.output_shapes()[0]
+    x = {k: np.random.rand(*shape).astype(np.float32)
+         for k, shape in x_shapes.items()}
+    out = km.inference_from_dict(dict(x))
+    for xla in (False, True):
+        compiled = KerasInterpreter(compiled=True, xla=xla)
+        kc = keras_pilot(interpreter=compiled)
+        compiled.model = eager.model
+        for _ in range(3):
+            x_in = dict(x)
+            assert kc.inference_from_dict(x_in) == \
+                approx(out, rel=TOLERANCE, abs=TOLERANCE)
+            # the inputs are not modified
+            assert all(x_in[k] is v for k, v in x.items())
+        assert compiled.latency_stats()['calls'] == 3
+    assert eager.latency_stats()['calls'] == 1
+
+
+@pytest.mark.parametrize('keras_pilot', [KerasLinear, KerasIMU])
+def test_dtype_policy(keras_pilot):
+    km = keras_pilot(interpreter=KerasInterpreter())
+    img = get_test_img(km)
+    args = (img, np.random.rand(6).tolist()) if keras_pilot is KerasIMU \
+        else (img, )
+    for x_types_y_types in km.output_types():
+        assert set(x_types_y_types.values()) == {tf.float32}
+    out_float32 = km.run(*args)
+
+    km.set_dtype_policy('float64')
+    assert set(km.output_types()[1].values()) == {tf.float64}
+    assert km.run(*args) == approx(out_float32, rel=TOLERANCE, abs=TOLERANCE)
+
+    # raw images are passed through to models which normalize internally
+    km.set_dtype_policy('float32', 'uint8')
+    x_types, y_types = km.output_types()
+    assert x_types['img_in'] == tf.uint8
+    assert set(y_types.values()) == {tf.float32}
+    assert normalize_image(img, km.image_dtype) is img
+    assert normalize_image(img).dtype == np.float32
+
+
+@pytest.mark.skipif(not has_onnx(), reason='Need onnxruntime and tf2onnx')
+@pytest.mark.parametrize('keras_pilot', [KerasLinear, KerasCategorical,
+                                         KerasIMU, KerasMemory, KerasLSTM])
+def test_onnx(keras_pilot, tmp_dir):
+    """ The onnx export runs in onnxruntime like the keras model """
+    interpreter = KerasInterpreter()
+    km = keras_pilot(interpreter=interpreter)
+    onnx_path = os.path.join(tmp_dir, 'model.onnx')
+    keras_to_onnx(interpreter.model, onnx_path)
+    ko = keras_pilot(interpreter=OnnxInterpreter(intra_op_threads=1))
+    ko.load(onnx_path)
+    assert ko.image_dtype == np.float32
+    x_shapes = km.output_shapes()[0]
+    batch = {k: np.random.rand(4, *shape).astype(np.float32)
+             for k, shape in x_shapes.items()}
+    ko_outs = ko.inference_batch(batch)
+    km_outs = km.inference_batch(batch)
+    assert len(ko_outs) == len(km_outs)
+    for ko_out, km_out in zip(ko_outs, km_outs):
+        np.testing.assert_allclose(ko_out, km_out, rtol=TOLERANCE,
+                                   atol=TOLERANCE)
+    x = {k: v[0] for k, v in batch.items()}
+    assert ko.inference_from_dict(dict(x)) == \
+        approx(km.inference_from_dict(dict(x)), rel=TOLERANCE, abs=TOLERANCE)
+    assert ko.interpreter.latency_stats()['calls'] == 1
+
+
+def test_benchmark_pilot(tmp_dir):
+    """ The benchmark runs the model under the interpreters of its files
+        and reports interpreters which fail to load """
+    from donkeycar.config import Config
+    from donkeycar.parts.pilot_benchmark import benchmark_pilot, \
+        format_report
+
+    cfg = Config()
+    cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH = 120, 160, 3
+    cfg.DEFAULT_MODEL_TYPE = 'linear'
+    interpreter = KerasInterpreter()
+    KerasLinear(interpreter=interpreter)
+    interpreter.model.save(os.path.join(tmp_dir, 'pilot.h5'))
+    keras_to_tflite(interpreter.model, os.path.join(tmp_dir, 'pilot.tflite'))
+    # not a valid onnx model
+    open(os.path.join(tmp_dir, 'pilot.onnx'), 'w').close()
 
+    report = benchmark_pilot(cfg, os.path.join(tmp_dir, 'pilot.tflite'),
+                             frames=10, warmup=2, tflite_threads=[1, 2])
+    results = {r['name']: r for r in report['interpreters']}
+    assert list(results) == ['keras', 'keras compiled', 'tflite 1 threads',
+                             'tflite 2 threads', 'onnx']
+    assert 'error' in results.pop('onnx')
+    for result in results.values():
+        assert result['latency']['calls'] == 10
+        assert result['latency']['p50_ms'] <= result['latency']['max_ms']
+        assert result['fps'] > 0 and result['rss_mb'] > 0
+    assert 'failed' in format_report(report)
@@ -1,12 +1,24 @@
+import os
+import pickle
+import shutil
+import tempfile
 import time
 import unittest
 from typing import List
+from unittest import mock
 
 import numpy as np
+from PIL import Image
 
 from donkeycar.config import Config
+from donkeycar.parts.tub_v2 import Tub
+from donkeycar.pipeline.augmentations import ImageAugmentation
+from donkeycar.pipeline.cache import ImageCache, ImageSnapshot
 from donkeycar.pipeline.sequence import TubSequence
-from donkeycar.pipeline.types import TubRecord
+from donkeycar.pipeline.streaming import ShuffleBufferStream
+from donkeycar.pipeline.types import Collator, RecordTable, SequenceTable, \
+    TubRecord, sequence_windows, split_groups
+from donkeycar.utils import train_test_split
 
 
 def random_records(size: int = 100) -> List[TubRecord]:
@@ -163,6 +175,399 @@ class TestPipeline(unittest.TestCase):
             self.assertAlmostEqual(2 * ex, tx)
             self.assertAlmostEqual(3 * ey, ty)
 
+    def test_split_groups(self):
+        records = list(self.sequence)
+        for i, record in enumerate(records):
+            record.underlying['_session_id'] = f'session_{i // 4}'
+        self.assertIsNone(split_groups(records))
+        self.assertEqual(len(set(split_groups(records, 'session'))), 3)
+        self.assertEqual(set(split_groups(records, 'tub')), {'/base'})
+        self.assertEqual(split_groups(records, 'block', 5), [0] * 5 + [1] * 5)
+        # sequences are grouped by their first record
+        self.assertEqual(split_groups([records[3:5], records[4:6]],
+                                      'session'),
+                         [('/base', 'session_0'), ('/base', 'session_1')])
+        with self.assertRaises(ValueError):
+            split_groups(records, 'frame')
+
+
+class TestRecordTable(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cfg = Config()
+        self.cfg.IMAGE_W, self.cfg.IMAGE_H, self.cfg.IMAGE_DEPTH = 16, 12, 3
+        self.tubs = list()
+        for t in range(2):
+            inputs = ['cam/image_array', 'user/angle', 'user/mode']
+            types = ['image_array', 'float', 'str']
+            if t == 1:
+                inputs.append('behavior/one_hot_state_array')
+                types.append('list')
+            tub = Tub(os.path.join(self.path, f'tub_{t}'), inputs, types)
+            for i in range(8):
+                record = {'cam/image_array': np.full((12, 16, 3), 20 * i,
+                                                     np.uint8),
+                          'user/angle': i / 10}
+                if i != 2:
+                    record['user/mode'] = 'user'
+                if t == 1:
+                    record['behavior/one_hot_state_array'] = [1.0, 0.0]
+                tub.write_record(record)
+            tub.delete_records([4])
+            self.tubs.append(tub)
+        self.records = [TubRecord(self.cfg, tub.base_path, underlying)
+                        for tub in self.tubs for underlying in tub]
+        self.table = RecordTable.from_tubs(self.cfg, self.tubs)
+
+    def tearDown(self):
+        for tub in self.tubs:
+            tub.close()
+        shutil.rmtree(self.path)
+
+    def test_rows(self):
+        self.assertEqual(len(self.table), len(self.records))
+        for row, record in zip(self.table, self.records):
+            self.assertIsInstance(row, TubRecord)
+            self.assertEqual(row.base_path, record.base_path)
+            self.assertEqual(dict(row.underlying), record.underlying)
+            np.testing.assert_array_equal(row.image(), record.image())
+        self.assertNotIn('user/mode', self.table[2].underlying)
+        self.assertEqual(self.table[-1].underlying['user/angle'], 0.7)
+        # records and rows carry no attribute dictionary
+        self.assertFalse(hasattr(self.records[0], '__dict__'))
+        self.assertFalse(hasattr(self.table[0], '__dict__'))
+
+    def test_take_and_filter(self):
+        sub = self.table[np.array([9, 0])]
+        self.assertEqual([r.underlying['_index'] for r in sub], [2, 0])
+        self.assertEqual(sub[0].base_path, self.tubs[1].base_path)
+        filtered = self.table.filter(
+            lambda r: r.underlying['user/angle'] > 0.45)
+        self.assertEqual(len(filtered), 6)
+        train, val = train_test_split(self.table, test_size=0.25, seed=0)
+        self.assertIsInstance(train, RecordTable)
+        self.assertEqual((len(train), len(val)), (10, 4))
+
+    def test_windows_and_groups(self):
+        for seq_len in (1, 3):
+            np.testing.assert_array_equal(
+                sequence_windows(self.table, seq_len),
+                sequence_windows(self.records, seq_len))
+        sequences = SequenceTable(self.table, sequence_windows(self.table, 3))
+        self.assertEqual(
+            [[r.underlying['_index'] for r in seq] for seq in sequences],
+            [[r.underlying['_index'] for r in seq]
+             for seq in Collator(3, self.records)])
+        for split_by in ('session', 'tub', 'block'):
+            for records, table in ((self.records, self.table),
+                                   (list(sequences), sequences)):
+                self.assertEqual(
+                    len(set(split_groups(records, split_by, 4))),
+                    len(set(split_groups(table, split_by, 4))))
+
+
+class TestShuffleBufferStream(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cfg = Config()
+        self.cfg.IMAGE_W, self.cfg.IMAGE_H, self.cfg.IMAGE_DEPTH = 16, 12, 3
+        self.tub = Tub(self.path, ['cam/image_array', 'user/angle'],
+                       ['image_array', 'float'])
+        for i in range(50):
+            self.tub.write_record(
+                {'cam/image_array': np.full((12, 16, 3), i, np.uint8),
+                 'user/angle': i / 50})
+        self.records = [TubRecord(self.cfg, self.path, underlying)
+                        for underlying in self.tub]
+
+    def tearDown(self):
+        self.tub.close()
+        shutil.rmtree(self.path)
+
+    def test_epochs(self):
+        stream = ShuffleBufferStream(self.records[::-1], block_size=8,
+                                     buffer_size=10, seed=3)
+        np.testing.assert_array_equal(stream.order, np.arange(49, -1, -1))
+        epochs = list()
+        for _ in range(2):
+            iterator = iter(stream)
+            self.assertEqual(len(iterator), 50)
+            epochs.append([r.underlying['_index'] for r in iterator])
+        self.assertEqual(sorted(epochs[0]), list(range(50)))
+        self.assertEqual(sorted(epochs[1]), list(range(50)))
+        self.assertNotEqual(epochs[0], epochs[1])
+        same_seed = ShuffleBufferStream(self.records[::-1], block_size=8,
+                                        buffer_size=10, seed=3)
+        self.assertEqual([r.underlying['_index'] for r in same_seed],
+                         epochs[0])
+
+    def test_images_are_read_ahead(self):
+        stream = ShuffleBufferStream(self.records, block_size=4,
+                                     buffer_size=4)
+        with mock.patch.object(TubRecord, '_load_image',
+                               side_effect=AssertionError):
+            for record in stream:
+                index = record.underlying['_index']
+                self.assertEqual(record.image()[0, 0, 0], index)
+        # the records themselves stay untouched
+        self.assertIsNone(self.records[0].image_cache)
+
+    def test_shared_cache_is_not_filled(self):
+        cache = ImageCache(max_bytes=2 ** 20)
+        for record in self.records:
+            record.image_cache = cache
+        stream = ShuffleBufferStream(self.records, block_size=4,
+                                     buffer_size=4)
+        for record in stream:
+            index = record.underlying['_index']
+            self.assertEqual(record.image()[0, 0, 0], index)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(self.records[0]._image)
+
+    def test_sequences(self):
+        sequences = list(Collator(3, self.records))
+        stream = ShuffleBufferStream(sequences, block_size=5, buffer_size=8)
+        streamed = [[r.underlying['_index'] for r in seq] for seq in stream]
+        self.assertEqual(sorted(streamed),
+                         [[i, i + 1, i + 2] for i in range(48)])
+
+    def test_abandoned_epoch_stops_reading(self):
+        stream = ShuffleBufferStream(self.records, block_size=2,
+                                     buffer_size=2, readahead=1)
+        iterator = iter(stream)
+        next(iterator)
+        stopped = iterator.stopped
+        del iterator
+        self.assertTrue(stopped.is_set())
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cfg = Config()
+        self.cfg.IMAGE_W, self.cfg.IMAGE_H, self.cfg.IMAGE_DEPTH = 16, 12, 3
+        tub = Tub(self.path, ['cam/image_array'], ['image_array'])
+        for i in range(5):
+            tub.write_record(
+                {'cam/image_array': np.full((12, 16, 3), 40 * i, np.uint8)})
+        self.underlying = list(tub)
+        tub.close()
+
+    def records(self, cache):
+        return [TubRecord(self.cfg, self.path, underlying, cache)
+                for underlying in self.underlying]
+
+    def test_lru_budget(self):
+        # room for two images
+        cache = ImageCache(2 * 12 * 16 * 3)
+        records = self.records(cache)
+        for record in records[:3]:
+            record.image()
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        # the first image was evicted, the last two are hits
+        records[2].image()
+        records[1].image()
+        records[0].image()
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (2, 4, 2))
+        self.assertIs(records[0].image(), records[0].image())
+        # records don't hold their images themselves
+        self.assertTrue(all(r._image is None for r in records))
+
+    def test_spill(self):
+        cache = ImageCache(12 * 16 * 3, spill_dir=self.path)
+        records = self.records(cache)
+        first = [record.image().copy() for record in records]
+        second = [record.image() for record in records]
+        stats = cache.stats()
+        self.assertEqual(stats['misses'], 5)
+        self.assertEqual(stats['spill_hits'], 5)
+        self.assertEqual(stats['spilled_images'], 5)
+        for image_1, image_2 in zip(first, second):
+            np.testing.assert_array_equal(image_1, image_2)
+        cache.clear()
+        self.assertEqual(cache.stats()['spilled_images'], 0)
+
+    def test_disabled_and_pil(self):
+        cache = ImageCache(0)
+        record = self.records(cache)[1]
+        pil_image = record.image(as_nparray=False)
+        self.assertIsInstance(pil_image, Image.Image)
+        np.testing.assert_array_equal(np.asarray(pil_image), record.image())
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_pickle(self):
+        # copies for worker processes start empty with the same budget
+        cache = ImageCache(2 * 12 * 16 * 3, spill_dir=self.path)
+        self.records(cache)[0].image()
+        copied = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(len(copied), 0)
+        self.assertEqual((copied.max_bytes, copied.spill_dir),
+                         (cache.max_bytes, cache.spill_dir))
+        self.records(copied)[0].image()
+        self.assertEqual(len(copied), 1)
+        # the budget is divided between the copies
+        cache.copies = 4
+        copied = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(copied.max_bytes, cache.max_bytes // 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+class LinearLabels(object):
+    def y_transform(self, record):
+        return record.underlying['user/angle'], record.underlying['user/throttle']
+
+    def __str__(self):
+        return 'LinearLabels'
+
+
+class TestImageSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cfg = Config()
+        self.cfg.IMAGE_W, self.cfg.IMAGE_H, self.cfg.IMAGE_DEPTH = 16, 12, 3
+        self.cfg.TRANSFORMATIONS = ['CROP']
+        self.cfg.ROI_CROP_TOP, self.cfg.ROI_CROP_BOTTOM = 4, 0
+        self.cfg.ROI_CROP_LEFT, self.cfg.ROI_CROP_RIGHT = 0, 0
+        self.tub_path = os.path.join(self.path, 'tub')
+        tub = Tub(self.tub_path, ['cam/image_array', 'user/angle',
+                                  'user/throttle'],
+                  ['image_array', 'float', 'float'])
+        for i in range(6):
+            image = np.zeros((12, 16, 3), np.uint8)
+            image[4:] = 40 * i
+            tub.write_record({'cam/image_array': image,
+                              'user/angle': i / 10, 'user/throttle': i / 5})
+        self.underlying = list(tub)
+        tub.close()
+        self.transformation = ImageAugmentation(self.cfg, 'TRANSFORMATIONS')
+
+    def records(self):
+        return [TubRecord(self.cfg, self.tub_path, underlying)
+                for underlying in self.underlying]
+
+    def snapshot(self, records):
+        return ImageSnapshot.open_or_create(
+            os.path.join(self.path, 'snapshots'), self.cfg, records,
+            self.transformation)
+
+    def test_snapshot(self):
+        records = self.records()
+        snapshot = self.snapshot(records)
+        snapshot.attach(records)
+        self.assertEqual(snapshot.images.shape, (6, 12, 16, 3))
+        for i, (record, plain) in enumerate(zip(records, self.records())):
+            image = record.image()
+            np.testing.assert_array_equal(
+                image, self.transformation.run(plain.image()))
+            # the black rows were cropped
+            self.assertAlmostEqual(image.mean(), 40 * i, delta=2)
+            # callers get their own copy
+            image[:] = 1
+        self.assertEqual(snapshot.stats()['hits'], 6)
+        self.assertAlmostEqual(records[2].image().mean(), 80, delta=2)
+
+        # same data and image config reuse the snapshot
+        with mock.patch.object(ImageSnapshot, 'create') as create:
+            reopened = self.snapshot(self.records()[::-1][::-1])
+            create.assert_not_called()
+        self.assertEqual(reopened.path, snapshot.path)
+        # changed image config or records give a new snapshot
+        self.cfg.ROI_CROP_TOP = 2
+        self.assertNotEqual(self.snapshot(records).path, snapshot.path)
+        self.assertNotEqual(self.snapshot(records[1:]).path, snapshot.path)
+
+    def test_labels(self):
+        records = self.records()
+        snapshot = self.snapshot(records)
+        model = LinearLabels()
+        self.assertTrue(snapshot.load_labels(model, self.cfg, records))
+        for record in records:
+            self.assertEqual(snapshot.label(model, record),
+                             model.y_transform(record))
+        # labels are stored with the snapshot
+        reopened = self.snapshot(records)
+        with mock.patch.object(model, 'y_transform') as y_transform:
+            self.assertTrue(reopened.load_labels(model, self.cfg, records))
+            y_transform.assert_not_called()
+        self.assertAlmostEqual(reopened.label(model, records[3])[1], 0.6)
+        # no labels of sequences
+        self.assertFalse(snapshot.load_labels(model, self.cfg, [records]))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+class TestBatchAugmentations(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg = Config()
+        self.cfg.ROI_CROP_TOP, self.cfg.ROI_CROP_BOTTOM = 45, 5
+        self.cfg.ROI_CROP_LEFT, self.cfg.ROI_CROP_RIGHT = 7, 3
+        self.cfg.ROI_TRAPEZE_LL, self.cfg.ROI_TRAPEZE_LR = 0, 160
+        self.cfg.ROI_TRAPEZE_UL, self.cfg.ROI_TRAPEZE_UR = 20, 140
+        self.cfg.ROI_TRAPEZE_MIN_Y, self.cfg.ROI_TRAPEZE_MAX_Y = 60, 120
+        self.images = np.random.default_rng(0).integers(
+            0, 256, (8, 120, 160, 3), dtype=np.uint8)
+
+    def run_backends(self, augs, images):
+        self.cfg.AUGS = augs
+        return [ImageAugmentation(self.cfg, 'AUGS', backend=backend,
+                                  seed=1).run_batch(images)
+                for backend in ('imgaug', 'cv2')]
+
+    def test_same_as_imgaug(self):
+        self.cfg.AUG_MULTIPLY_RANGE = (1.3, 1.3)
+        self.cfg.AUG_BLUR_RANGE = (1.7, 1.7)
+        for augs in (['CROP'], ['TRAPEZE'], ['CROP', 'TRAPEZE'],
+                     ['MULTIPLY'], ['BLUR']):
+            expected, images = self.run_backends(augs, self.images)
+            self.assertEqual(images.dtype, np.uint8)
+            np.testing.assert_array_equal(images, expected, str(augs))
+
+    def test_grey_same_as_imgaug(self):
+        self.cfg.AUG_MULTIPLY_RANGE = (1.3, 1.3)
+        self.cfg.AUG_BLUR_RANGE = (1.7, 1.7)
+        grey = self.images[..., 0]
+        for augs in (['CROP'], ['TRAPEZE'], ['CROP', 'TRAPEZE'],
+                     ['MULTIPLY'], ['BLUR']):
+            expected, images = self.run_backends(augs, grey)
+            self.assertEqual(images.shape, grey.shape)
+            np.testing.assert_array_equal(images, expected, str(augs))
+
+    def test_seeded(self):
+        self.cfg.AUGS = ['MULTIPLY', 'BLUR']
+        original = self.images.copy()
+        batches = [ImageAugmentation(self.cfg, 'AUGS', seed=seed)
+                   .run_batch(self.images) for seed in (3, 3, 4)]
+        np.testing.assert_array_equal(batches[0], batches[1])
+        self.assertFalse((batches[0] == batches[2]).all())
+        # the input is not modified
+        np.testing.assert_array_equal(self.images, original)
+
+    def test_single_grey_image(self):
+        self.cfg.AUGS = ['CROP', 'TRAPEZE', 'MULTIPLY', 'BLUR']
+        augmentation = ImageAugmentation(self.cfg, 'AUGS', backend='cv2')
+        image = augmentation.run(self.images[0, :, :, :1])
+        self.assertEqual(image.shape, (120, 160, 1))
+        image = augmentation.run(self.images[0, :, :, 0])
+        self.assertEqual(image.shape, (120, 160))
+
+    def test_unknown_augmentation(self):
+        self.cfg.AUGS = ['SHEAR']
+        with self.assertRaises(ValueError):
+            ImageAugmentation(self.cfg, 'AUGS', backend='cv2')
+
 
 if __name__ == '__main__':
     unittest.main()
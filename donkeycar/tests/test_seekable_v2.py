@@ -1,6 +1,7 @@
 import os
 import tempfile
 import unittest
+from unittest import mock
 
 from donkeycar.parts.datastore_v2 import Seekable
 
@@ -71,6 +72,22 @@ class TestSeekeable(unittest.TestCase):
             self.assertEqual(appendable.readline(), 'Line 1')
             self.assertEqual(appendable.readline(), 'Line 2')
 
+    def test_rebuild_index(self):
+        lines = ['{"a": 1}', '', '{"b": 22}', 'no newline at the end']
+        with open(self._path, 'w') as file:
+            file.write('\n'.join(lines))
+        # Force several chunks in the newline scan
+        with mock.patch.object(Seekable, 'SCAN_CHUNK_SIZE', 4):
+            for read_only in (True, False):
+                seekable = Seekable(self._path, read_only=read_only)
+                with seekable:
+                    self.assertEqual(seekable.lines(), len(lines))
+                    self.assertEqual(seekable.line_lengths.tolist(),
+                                     [9, 1, 10, 21])
+                    for number, line in enumerate(lines, 1):
+                        seekable.seek_line_start(number)
+                        self.assertEqual(seekable.readline(), line)
+
     def tearDown(self):
         os.remove(self._path)
 
@@ -1,13 +1,19 @@
 import pytest
 import tarfile
 import os
+import pickle
+import random
 import numpy as np
 from collections import defaultdict, namedtuple
+from unittest import mock
 
 import torch
 import pytorch_lightning as pl
 from donkeycar.parts.pytorch.torch_train import train
-from donkeycar.parts.pytorch.torch_data import TorchTubDataModule
+from donkeycar.parts.pytorch.torch_data import SharedTensorCache, \
+    TorchTubDataModule, TorchTubDataset, seed_worker
+from donkeycar.parts.tub_v2 import Tub
+from donkeycar.pipeline.types import TubRecord
 from donkeycar.parts.pytorch.torch_utils import get_model_by_type
 
 from donkeycar.config import Config
@@ -122,3 +128,94 @@ def test_training_pipeline(config: Config, model_type: str, car_dir: str) \
     val_x, val_y = next(iter(data_module.val_dataloader()))
     output = model(val_x)
     assert(output.shape == (config.BATCH_SIZE, 2))
+
+
+def test_shared_tensor_cache() -> None:
+    """ Tensors are computed once per row and rows beyond the memory budget
+        are computed on every access. """
+    sample = torch.zeros(3, 4)
+    cache = SharedTensorCache(10, sample, 4 * 3 * 4 * sample.element_size())
+    assert cache.capacity == 4
+    assert cache.tensors.is_shared() and cache.filled.is_shared()
+    calls = []
+
+    def transform():
+        calls.append(None)
+        return torch.full((3, 4), float(len(calls)))
+
+    assert torch.equal(cache.get(1, transform), torch.full((3, 4), 1.))
+    assert torch.equal(cache.get(1, transform), torch.full((3, 4), 1.))
+    assert len(calls) == 1
+    cache.get(7, transform)
+    cache.get(7, transform)
+    assert len(calls) == 3
+
+
+def test_seed_worker() -> None:
+    """ Workers get the same random numbers for the same torch seed. """
+    draws = []
+    for seed in (3, 3, 4):
+        torch.manual_seed(seed)
+        seed_worker(0)
+        draws.append((np.random.rand(), random.random()))
+    assert draws[0] == draws[1]
+    assert draws[0] != draws[2]
+
+
+@pytest.mark.parametrize('cache_mb', [0, 1])
+def test_dataset_item(config: Config, car_dir: str, cache_mb: int) -> None:
+    """
+    Items hold the transformed image and the normalized labels, whether
+    the image tensor is cached or not.
+
+    :param config:          donkey config
+    :param car_dir:         car directory (this is a temp dir)
+    :param cache_mb:        budget of the tensor cache
+    :return:                None
+    """
+    config.TORCH_TENSOR_CACHE_MB = cache_mb
+    tub = Tub(os.path.join(car_dir, 'tub'), read_only=True)
+    records = [TubRecord(config, tub.base_path, underlying)
+               for underlying, _ in zip(tub, range(3))]
+    dataset = TorchTubDataset(config, records)
+    assert len(dataset) == 3
+    if cache_mb:
+        # a 3x224x224 float tensor takes 588kB
+        assert dataset.tensor_cache.capacity == 1
+    for index, record in enumerate(records):
+        x, y = dataset[index]
+        assert x.shape == (3, 224, 224)
+        assert torch.equal(x, dataset.x_transform(record))
+        angle = record.underlying['user/angle']
+        throttle = record.underlying['user/throttle']
+        assert torch.allclose(y, (torch.tensor([angle, throttle]) + 1) / 2)
+    # cached items come from the cache
+    if cache_mb:
+        with mock.patch.object(dataset, 'x_transform',
+                               side_effect=AssertionError):
+            dataset[0]
+
+
+def test_data_module_cache_budgets(config: Config, car_dir: str) -> None:
+    """
+    The datasets share the tensor cache budget and the workers share the
+    image cache budget.
+
+    :param config:          donkey config
+    :param car_dir:         car directory (this is a temp dir)
+    :return:                None
+    """
+    config.TORCH_NUM_WORKERS = 2
+    config.TORCH_TENSOR_CACHE_MB = 10
+    config.CACHE_IMAGES_MB = 8
+    data_module = TorchTubDataModule(config, [os.path.join(car_dir, 'tub')])
+    data_module.setup()
+    item_bytes = 3 * 224 * 224 * 4
+    capacities = [data_module.train_dataset.tensor_cache.capacity,
+                  data_module.val_dataset.tensor_cache.capacity]
+    assert sum(capacities) <= 10 * 1024 * 1024 // item_bytes
+    assert capacities[0] > capacities[1] > 0
+    # two persistent workers for each of the two loaders
+    assert data_module.image_cache.copies == 4
+    copied = pickle.loads(pickle.dumps(data_module.image_cache))
+    assert copied.max_bytes == 2 * 1024 * 1024
@@ -5,9 +5,12 @@ import numpy as np
 from collections import defaultdict, namedtuple
 from itertools import product
 from typing import Callable, List
+from unittest import mock
 
 from donkeycar.parts.tub_v2 import Tub
-from donkeycar.pipeline.training import train, BatchSequence
+from donkeycar.pipeline.database import PilotDatabase
+from donkeycar.pipeline.training import train, train_models, benchmark, \
+    fit_models, BatchSequence, MultiBatchSequence
 from donkeycar.config import Config
 from donkeycar.pipeline.types import TubDataset, TubRecord
 from donkeycar.utils import get_model_by_type, normalize_image, train_test_split
@@ -48,6 +51,16 @@ def config(base_config, car_dir) -> Config:
     return cfg
 
 
+@pytest.fixture
+def plain_config(config, monkeypatch) -> Config:
+    """ Config without augmentations, transformations and filter, restored
+        after the test """
+    monkeypatch.setattr(config, 'AUGMENTATIONS', [], raising=False)
+    monkeypatch.setattr(config, 'TRANSFORMATIONS', [], raising=False)
+    monkeypatch.setattr(config, 'TRAIN_FILTER', None, raising=False)
+    return config
+
+
 def add_transformation_to_config(config: Config):
     config.TRANSFORMATIONS = ['CROP']
     config.ROI_CROP_TOP = 45
@@ -210,3 +223,197 @@ def test_training_pipeline(config: Config, model_type: str,
             for k, v in batch.items():
                 assert np.isclose(v, np_dict[k]).all()
 
+
+
+@pytest.mark.parametrize('model_type', model_types)
+def test_native_pipeline(plain_config: Config, model_type: str, monkeypatch) \
+        -> None:
+    """
+    Testing the native tf.data pipeline produces the same batches as the
+    generator pipeline.
+
+    :param plain_config:            config without augmentations,
+                                    transformations and filter
+    :param model_type:              test specification of model type
+    :param monkeypatch:             pytest fixture to restore the config
+    :return:                        None
+    """
+    kl = get_model_by_type(model_type, plain_config)
+    tub_dir = plain_config.DATA_PATH_ALL if model_type in full_tub else \
+        plain_config.DATA_PATH
+    dataset = TubDataset(plain_config, [tub_dir], seq_size=kl.seq_size())
+    records = dataset.get_records()[:2 * plain_config.BATCH_SIZE]
+    batches = dict()
+    for pipeline in ('generator', 'native'):
+        monkeypatch.setattr(plain_config, 'TRAIN_DATA_PIPELINE', pipeline,
+                            raising=False)
+        data = BatchSequence(kl, plain_config, records, True).create_tf_data()
+        batches[pipeline] = list(data.take(2).as_numpy_iterator())
+    for generator_xy, native_xy in zip(batches['generator'],
+                                       batches['native']):
+        for generator_batch, native_batch in zip(generator_xy, native_xy):
+            assert generator_batch.keys() == native_batch.keys()
+            for k, v in generator_batch.items():
+                assert v.dtype == native_batch[k].dtype
+                assert np.allclose(v, native_batch[k], atol=1e-6)
+
+
+@pytest.mark.parametrize('model_type', model_types)
+def test_record_table(plain_config: Config, model_type: str, monkeypatch) \
+        -> None:
+    """
+    Testing the record table produces the same batches as the list of
+    records, also with a filter and for sequences.
+
+    :param plain_config:            config without augmentations,
+                                    transformations and filter
+    :param model_type:              test specification of model type
+    :param monkeypatch:             pytest fixture to restore the config
+    :return:                        None
+    """
+    monkeypatch.setattr(plain_config, 'TRAIN_FILTER', filters[1])
+    kl = get_model_by_type(model_type, plain_config)
+    tub_dir = plain_config.DATA_PATH_ALL if model_type in full_tub else \
+        plain_config.DATA_PATH
+    batches = dict()
+    for use_table in (False, True):
+        monkeypatch.setattr(plain_config, 'TRAIN_RECORD_TABLE', use_table,
+                            raising=False)
+        dataset = TubDataset(plain_config, [tub_dir], seq_size=kl.seq_size())
+        records = dataset.get_records()
+        assert isinstance(records, list) != use_table
+        records = records[:2 * plain_config.BATCH_SIZE]
+        data = BatchSequence(kl, plain_config, records, True).create_tf_data()
+        batches[use_table] = list(data.take(2).as_numpy_iterator())
+    for list_xy, table_xy in zip(batches[False], batches[True]):
+        for list_batch, table_batch in zip(list_xy, table_xy):
+            assert list_batch.keys() == table_batch.keys()
+            for k, v in list_batch.items():
+                assert np.array_equal(v, table_batch[k])
+
+
+@pytest.mark.parametrize('model_type', ['linear', 'rnn'])
+def test_stream_pipeline(plain_config: Config, model_type: str, monkeypatch) \
+        -> None:
+    """
+    Testing an epoch of the streaming pipeline contains the same data as the
+    generator pipeline in a different order.
+
+    :param plain_config:            config without augmentations,
+                                    transformations and filter
+    :param model_type:              test specification of model type
+    :param monkeypatch:             pytest fixture to restore the config
+    :return:                        None
+    """
+    monkeypatch.setattr(plain_config, 'STREAM_BLOCK_SIZE', 16, raising=False)
+    kl = get_model_by_type(model_type, plain_config)
+    dataset = TubDataset(plain_config, [plain_config.DATA_PATH],
+                         seq_size=kl.seq_size())
+    records = dataset.get_records()[:2 * plain_config.BATCH_SIZE]
+    labels = dict()
+    for pipeline in ('generator', 'stream'):
+        monkeypatch.setattr(plain_config, 'TRAIN_DATA_PIPELINE', pipeline,
+                            raising=False)
+        seq = BatchSequence(kl, plain_config, records, True)
+        data = seq.create_tf_data().take(len(seq))
+        labels[pipeline] = np.concatenate(
+            [np.concatenate([v.reshape(len(v), -1) for v in y.values()],
+                            axis=1) for _, y in data.as_numpy_iterator()])
+    assert not np.array_equal(labels['generator'], labels['stream'])
+    assert np.array_equal(np.sort(labels['generator'], axis=0),
+                          np.sort(labels['stream'], axis=0))
+
+
+@pytest.mark.parametrize('pipeline', ['generator', 'native'])
+def test_benchmark(plain_config: Config, pipeline: str, monkeypatch) -> None:
+    """
+    Testing the benchmark times the stages of the pipeline and the image
+    loading.
+
+    :param plain_config:            config without augmentations,
+                                    transformations and filter
+    :param pipeline:                training pipeline
+    :param monkeypatch:             pytest fixture to restore the config
+    :return:                        None
+    """
+    monkeypatch.setattr(plain_config, 'AUGMENTATIONS', ['MULTIPLY'])
+    monkeypatch.setattr(plain_config, 'TRAIN_DATA_PIPELINE', pipeline,
+                        raising=False)
+    report = benchmark(plain_config, plain_config.DATA_PATH, 'linear',
+                       batches=2, warmup=1)
+    stages = report['pipeline']['stages']
+    assert report['pipeline']['records'] == 2 * plain_config.BATCH_SIZE
+    assert stages['batch']['calls'] == stages['model step']['calls'] == 2
+    expected = {'load', 'transform', 'augment', 'normalize', 'label'} \
+        if pipeline == 'generator' \
+        else {'read', 'decode', 'resize', 'transform', 'augment', 'normalize'}
+    assert expected <= stages.keys()
+    for stage in stages.values():
+        assert 0 <= stage['p50_ms'] <= stage['p99_ms']
+    loading = report['image_loading']
+    assert loading['records'] == 2 * plain_config.BATCH_SIZE
+    assert loading['stages'].keys() == {'read', 'decode', 'resize'}
+
+
+def test_multi_batch_sequence(plain_config: Config, monkeypatch) -> None:
+    """
+    Testing the shared pipeline gives each model the same data as its own
+    pipeline.
+
+    :param plain_config:            config without augmentations,
+                                    transformations and filter
+    :param monkeypatch:             pytest fixture to restore the config
+    :return:                        None
+    """
+    models = {'lin': get_model_by_type('linear', plain_config),
+              'mem': get_model_by_type('memory', plain_config)}
+    dataset = TubDataset(plain_config, [plain_config.DATA_PATH],
+                         seq_size=models['mem'].seq_size())
+    records = dataset.get_records()[:2 * plain_config.BATCH_SIZE]
+    shared = MultiBatchSequence(models, plain_config, records, True)
+    own = {'lin': BatchSequence(models['lin'], plain_config,
+                                [r[-1] for r in records], True),
+           'mem': BatchSequence(models['mem'], plain_config, records, True)}
+    shared_batches = list(shared.create_tf_data().take(2)
+                          .as_numpy_iterator())
+    for name, seq in own.items():
+        own_batches = seq.create_tf_data().take(2).as_numpy_iterator()
+        for (x, y), (x_own, y_own) in zip(shared_batches, own_batches):
+            for shared_xy, own_xy in ((x[name], x_own), (y[name], y_own)):
+                assert shared_xy.keys() == own_xy.keys()
+                for k, v in own_xy.items():
+                    assert np.array_equal(shared_xy[k], v)
+
+
+def test_train_models(plain_config: Config, monkeypatch) -> None:
+    """
+    Testing several models train in one pass per sequence size and get
+    their own database entries.
+
+    :param plain_config:            config without augmentations,
+                                    transformations and filter
+    :param monkeypatch:             pytest fixture to restore the config
+    :return:                        None
+    """
+    monkeypatch.setattr(plain_config, 'MAX_EPOCHS', 2)
+    monkeypatch.setattr(plain_config, 'CREATE_TF_LITE', False, raising=False)
+    entries = len(PilotDatabase(plain_config).entries)
+    model_types = ['linear', 'categorical', 'memory']
+    with mock.patch('donkeycar.pipeline.training.fit_models',
+                    wraps=fit_models) as fit:
+        histories = train_models(plain_config, plain_config.DATA_PATH,
+                                 model_types)
+    # the single frame models don't train on the windows of the memory model
+    assert [list(call.args[0]) for call in fit.call_args_list] == \
+        [['0_linear', '1_categorical'], ['2_memory']]
+    assert list(histories) == ['0_linear', '1_categorical', '2_memory']
+    for history in histories.values():
+        assert len(history.history['loss']) == 2
+        assert len(history.history['val_loss']) == 2
+    new_entries = PilotDatabase(plain_config).entries[entries:]
+    assert [e['Type'].split('-')[0] for e in new_entries] == \
+        ['KerasLinear', 'KerasCategorical', 'KerasMemory']
+    assert len({e['Name'] for e in new_entries}) == 3
+    for entry in new_entries:
+        assert os.path.exists(os.path.join(plain_config.MODELS_PATH,
+                                           entry['Name'] + '.h5'))
@@ -1,9 +1,14 @@
+import os
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 
-from donkeycar.parts.tub_v2 import Tub
-from donkeycar.pipeline.types import TubRecord, Collator
+import numpy as np
+
+from donkeycar.parts.tub_v2 import Tub, PackedImages, ColumnCache, \
+    convert_tub_images, compact_tub
+from donkeycar.pipeline.types import TubRecord, Collator, sequence_windows
 from donkeycar.config import Config
 
 
@@ -58,6 +63,29 @@ class TestTub(unittest.TestCase):
                             for rec_1, rec_2 in zip(it1, it2))), \
                     'Non continuous records found'
 
+    def test_sequence_windows(self):
+        cfg = Config()
+        records = [TubRecord(cfg, self.tub.base_path, underlying) for
+                   underlying in self.tub]
+        # records of another tub which continue the indexes are not joined
+        other = [TubRecord(cfg, 'other', {'_index': records[-1].underlying[
+            '_index'] + 1 + i}) for i in range(3)]
+        records += other
+        for seq_len in (1, 2, 3, 4, 5):
+            expected = [
+                list(range(start, start + seq_len))
+                for start in range(len(records) - seq_len + 1)
+                if all(Collator.is_continuous(records[i], records[i + 1])
+                       and records[i].base_path == records[i + 1].base_path
+                       for i in range(start, start + seq_len - 1))]
+            windows = sequence_windows(records, seq_len)
+            self.assertEqual(windows.tolist(), expected)
+            self.assertEqual([[id(r) for r in seq] for seq in
+                              Collator(seq_len, records)],
+                             [[id(records[i]) for i in window]
+                              for window in expected])
+        self.assertEqual(sequence_windows(records[:2], 3).shape, (0, 3))
+
     def test_delete_last_n_records(self):
         start_len = len(self.tub)
         self.tub.delete_last_n_records(2)
@@ -72,5 +100,293 @@ class TestTub(unittest.TestCase):
         shutil.rmtree(cls._path)
 
 
+class TestRandomAccess(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._path = tempfile.mkdtemp()
+        self.tub = Tub(self._path, ['input'], ['int'], max_catalog_len=4)
+        for i in range(15):
+            self.tub.write_record({'input': i})
+        self.tub.delete_records([0, 5, 6, 14])
+        self.expected = list(self.tub)
+
+    def test_getitem(self):
+        self.assertEqual(len(self.expected), 11)
+        for position, record in enumerate(self.expected):
+            self.assertEqual(self.tub[position], record)
+        self.assertEqual(self.tub[-1], self.expected[-1])
+        with self.assertRaises(IndexError):
+            self.tub[11]
+
+    def test_slices(self):
+        self.assertEqual(self.tub[2:9], self.expected[2:9])
+        self.assertEqual(self.tub[::3], self.expected[::3])
+        self.assertEqual(self.tub[20:], [])
+        positions = [7, 1, 3, 3, 10]
+        self.assertEqual(self.tub.get_many(positions),
+                         [self.expected[p] for p in positions])
+
+    def test_iter_from(self):
+        for position in range(12):
+            self.assertEqual(list(self.tub.iter_from(position)),
+                             self.expected[position:])
+
+    def tearDown(self) -> None:
+        self.tub.close()
+        shutil.rmtree(self._path)
+
+
+class TestPackedImages(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._path = tempfile.mkdtemp()
+        self.cfg = Config()
+        self.cfg.IMAGE_W, self.cfg.IMAGE_H, self.cfg.IMAGE_DEPTH = 16, 12, 3
+        self.tub = Tub(self._path, ['cam/image_array', 'input'],
+                       ['image_array', 'int'], max_catalog_len=4,
+                       packed_images=True)
+        self.images = [np.full((12, 16, 3), 20 * i, dtype=np.uint8)
+                       for i in range(10)]
+        for i, image in enumerate(self.images):
+            self.tub.write_record({'cam/image_array': image, 'input': i})
+        self.tub.close()
+
+    def read_images(self):
+        tub = Tub(self._path, read_only=True)
+        images = [TubRecord(self.cfg, tub.base_path, record).image()
+                  for record in tub]
+        tub.close()
+        return images
+
+    def assert_images(self, images):
+        self.assertEqual(len(images), len(self.images))
+        for image, expected in zip(images, self.images):
+            # jpeg compression is lossy
+            np.testing.assert_allclose(image, expected, atol=3)
+
+    def test_packed_layout(self):
+        files = os.listdir(self.tub.images_base_path)
+        # one blob and one index per catalog instead of one file per image
+        self.assertEqual(sorted(files),
+                         [f'catalog_{i}{ext}' for i in range(3) for ext in
+                          (PackedImages.EXTENSION,
+                           PackedImages.INDEX_EXTENSION)])
+        record = next(iter(Tub(self._path, read_only=True)))
+        self.assertEqual(record['cam/image_array'], 'catalog_0.images:0')
+        self.assert_images(self.read_images())
+
+    def test_convert_layouts(self):
+        self.assertEqual(convert_tub_images(self._path, packed=False), 10)
+        files = os.listdir(self.tub.images_base_path)
+        self.assertEqual(len(files), 10)
+        self.assertTrue(all(f.endswith('.jpg') for f in files))
+        self.assert_images(self.read_images())
+        # Converting again does not change anything
+        self.assertEqual(convert_tub_images(self._path, packed=False), 0)
+
+        self.assertEqual(convert_tub_images(self._path, packed=True), 10)
+        self.assertEqual(len(os.listdir(self.tub.images_base_path)), 6)
+        self.assert_images(self.read_images())
+        # The tub can still be appended to after the conversion
+        tub = Tub(self._path, packed_images=True)
+        tub.write_record({'cam/image_array': self.images[0], 'input': 10})
+        tub.close()
+        self.assertEqual(len(Tub(self._path, read_only=True)), 11)
+
+    def test_recover_unindexed_image(self):
+        store_path = os.path.join(self.tub.images_base_path,
+                                  'catalog_2.images')
+        size = os.path.getsize(store_path)
+        with open(store_path, 'ab') as blob:
+            blob.write(b'partial image')
+        store = PackedImages(store_path)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(os.path.getsize(store_path), size)
+        store.close()
+
+    def tearDown(self) -> None:
+        PackedImages.close_readers()
+        shutil.rmtree(self._path)
+
+
+class TestColumnCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._path = tempfile.mkdtemp()
+        self.tub = Tub(self._path,
+                       ['user/angle', 'user/mode', 'count', 'vec', 'ragged'],
+                       ['float', 'str', 'int', 'vector', 'list'],
+                       max_catalog_len=5)
+        for i in range(12):
+            self.tub.write_record({'user/angle': i / 10, 'user/mode': 'user',
+                                   'count': i if i % 4 else None,
+                                   'vec': [i, -i], 'ragged': [0] * (i % 3)})
+        self.tub.delete_records([2, 7])
+
+    def test_columns(self):
+        columns = self.tub.columns()
+        self.assertEqual(len(columns['_index']), 10)
+        self.assertEqual(columns['user/angle'].dtype, np.float64)
+        self.assertEqual(columns['vec'].shape, (10, 2))
+        self.assertTrue(np.ma.isMaskedArray(columns['count']))
+        self.assertEqual(columns['count'].count(), 7)
+        # irregular values round trip as json
+        self.assertEqual(columns['ragged'][4], [0, 0])
+        self.assertTrue(os.path.exists(
+            os.path.join(self._path, ColumnCache.FILE_NAME)))
+
+    def test_records_match_iterator(self):
+        self.assertEqual(self.tub.load_records(), list(self.tub))
+        # records written after the cache was created show up as well
+        self.tub.write_record({'user/angle': 2.0, 'user/mode': 'pilot',
+                               'count': 12, 'vec': [1, 2], 'ragged': []})
+        tub = Tub(self._path, read_only=True)
+        records = tub.load_records()
+        self.assertEqual(records, list(tub))
+        self.assertEqual(len(records), 11)
+
+    def test_only_changed_catalogs_are_read(self):
+        self.tub.columns()
+        cache = ColumnCache(self.tub.manifest)
+        cache._read()
+        self.assertEqual(cache.catalog_rows, [5, 5, 2])
+        self.tub.write_record({'user/angle': 2.0})
+        read = list()
+        read_catalog = cache._read_catalog
+        cache._read_catalog = lambda name: read.append(name) or \
+            read_catalog(name)
+        cache.load()
+        self.assertEqual(read, ['catalog_2.catalog'])
+        self.assertEqual(cache.catalog_rows, [5, 5, 3])
+
+    def tearDown(self) -> None:
+        self.tub.close()
+        shutil.rmtree(self._path)
+
+
+class TestCompactTub(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._path = tempfile.mkdtemp()
+        self.cfg = Config()
+        self.cfg.IMAGE_W, self.cfg.IMAGE_H, self.cfg.IMAGE_DEPTH = 16, 12, 3
+
+    def write_tub(self, packed_images):
+        tub = Tub(self._path, ['cam/image_array', 'input'],
+                  ['image_array', 'int'], max_catalog_len=4,
+                  packed_images=packed_images)
+        for i in range(10):
+            image = np.full((12, 16, 3), 20 * i, dtype=np.uint8)
+            tub.write_record({'cam/image_array': image, 'input': i})
+        tub.delete_records([0, 4, 5, 9])
+        tub.close()
+        return tub
+
+    def check_compaction(self, packed_images):
+        tub = self.write_tub(packed_images)
+        sessions = tub.manifest.manifest_metadata['sessions']
+        report = compact_tub(self._path, dry_run=True)
+        self.assertEqual(report['records'], 10)
+        self.assertEqual(report['kept_records'], 6)
+        self.assertLess(report['kept_image_bytes'], report['image_bytes'])
+        self.assertEqual(len(Tub(self._path, read_only=True)), 6)
+
+        compact_tub(self._path)
+        tub = Tub(self._path, read_only=True)
+        records = list(tub)
+        self.assertEqual(len(tub.manifest.deleted_indexes), 0)
+        self.assertEqual(tub.manifest.current_index, 6)
+        self.assertEqual([r['input'] for r in records], [1, 2, 3, 6, 7, 8])
+        self.assertEqual([r['_index'] for r in records], list(range(6)))
+        self.assertEqual([r.get('_gap', False) for r in records],
+                         [True, False, False, True, False, False])
+        self.assertEqual(tub.load_records(), records)
+        self.assertEqual(tub.manifest.manifest_metadata['sessions']['last_id'],
+                         sessions['last_id'] + 1)
+        for record in records:
+            image = TubRecord(self.cfg, self._path, record).image()
+            self.assertAlmostEqual(image.mean(), 20 * record['input'],
+                                   delta=3)
+        # Sequences must not span the dropped records
+        tub_records = [TubRecord(self.cfg, self._path, r) for r in records]
+        self.assertEqual(
+            [[r.underlying['input'] for r in seq]
+             for seq in Collator(2, tub_records)], [[1, 2], [2, 3], [6, 7],
+                                                   [7, 8]])
+        tub.close()
+        # one store and its index per catalog
+        self.assertEqual(len(os.listdir(os.path.join(self._path, 'images'))),
+                         4)
+        self.assertFalse(os.path.exists(os.path.join(self._path, '.compact')))
+
+    def check_images(self, tub):
+        for record in tub:
+            image = TubRecord(self.cfg, self._path, record).image()
+            self.assertAlmostEqual(image.mean(), 20 * record['input'],
+                                   delta=3)
+
+    def test_compact_image_files(self):
+        self.check_compaction(packed_images=False)
+
+    def test_compact_packed_images(self):
+        self.check_compaction(packed_images=True)
+
+    def test_write_after_compaction(self):
+        for packed_images in (False, True):
+            self.write_tub(packed_images)
+            compact_tub(self._path)
+            tub = Tub(self._path, ['cam/image_array', 'input'],
+                      ['image_array', 'int'], max_catalog_len=4,
+                      packed_images=packed_images)
+            for i in range(10, 13):
+                image = np.full((12, 16, 3), 20 * i, dtype=np.uint8)
+                tub.write_record({'cam/image_array': image, 'input': i})
+            tub.close()
+            tub = Tub(self._path, read_only=True)
+            self.assertEqual([r['input'] for r in tub],
+                             [1, 2, 3, 6, 7, 8, 10, 11, 12])
+            self.assertEqual([r['_index'] for r in tub], list(range(9)))
+            # the new images don't overwrite the ones of the kept records
+            self.check_images(tub)
+            tub.close()
+            # compacting again keeps the records
+            compact_tub(self._path)
+            tub = Tub(self._path, read_only=True)
+            self.assertEqual(len(tub), 9)
+            self.check_images(tub)
+            tub.close()
+            PackedImages.close_readers()
+            shutil.rmtree(self._path)
+            os.mkdir(self._path)
+
+    def test_interrupted_compaction(self):
+        self.write_tub(packed_images=False)
+        replace = os.replace
+
+        def failing_replace(source, target):
+            if os.path.basename(target) == 'manifest.json':
+                raise OSError('Interrupted')
+            replace(source, target)
+
+        with mock.patch('os.replace', failing_replace):
+            with self.assertRaises(OSError):
+                compact_tub(self._path)
+        # the old tub is still complete
+        tub = Tub(self._path, read_only=True)
+        self.assertEqual([r['input'] for r in tub], [1, 2, 3, 6, 7, 8])
+        self.check_images(tub)
+        tub.close()
+        # and can be compacted again
+        compact_tub(self._path)
+        tub = Tub(self._path, read_only=True)
+        self.assertEqual([r['_index'] for r in tub], list(range(6)))
+        self.check_images(tub)
+        tub.close()
+
+    def tearDown(self) -> None:
+        PackedImages.close_readers()
+        shutil.rmtree(self._path)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from tornado import testing
+
+from donkeycar.management.tub import WebServer
+from donkeycar.parts.tub_v2 import Tub
+
+
+class TubImageTest(testing.AsyncHTTPTestCase):
+    """ Serving the images of a tub through the tub manager """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.path, 'data')
+        tub = Tub(os.path.join(self.data_path, 'tub1'), inputs=['img'],
+                  types=['image_array'])
+        tub.write_record({'img': np.zeros((12, 16, 3), dtype=np.uint8)})
+        self.image = next(iter(tub))['img']
+        tub.close()
+        with open(os.path.join(self.path, 'secret.txt'), 'w') as file:
+            file.write('secret')
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.path)
+
+    def get_app(self):
+        return WebServer(self.data_path)
+
+    def test_image(self):
+        response = self.fetch(f'/tub_data/tub1/images/{self.image}')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'image/jpeg')
+
+    def test_missing_image(self):
+        response = self.fetch('/tub_data/tub1/images/missing.jpg')
+        self.assertEqual(response.code, 404)
+
+    def test_traversal(self):
+        for url in ('/tub_data/tub1/images/..%2F..%2Fsecret.txt',
+                    '/tub_data/tub1/images/..%2F..%2F..%2Fsecret.txt',
+                    '/tub_data/tub1/images/..%5C..%5Csecret.txt',
+                    '/tub_data/..%2F..%2F/images/secret.txt',
+                    '/tub_data/../images/secret.txt',
+                    '/tub_data/tub1/images/..%2F..%2Fsecret.txt%3A0'):
+            response = self.fetch(url)
+            self.assertEqual(response.code, 404, url)
+            self.assertNotIn(b'secret', response.body)
@@ -1,9 +1,12 @@
+import os
 import shutil
 import tempfile
 import unittest
 from random import randint
 
-from donkeycar.parts.tub_v2 import Tub, TubWriter
+import numpy as np
+
+from donkeycar.parts.tub_v2 import Tub, TubWriter, AsyncTubWriter
 
 
 class TestTub(unittest.TestCase):
@@ -35,6 +38,60 @@ class TestTub(unittest.TestCase):
                 id += 1
                 write_counts.pop(0)
 
+    def test_async_tubwriter(self):
+        tub_writer = AsyncTubWriter(self._path, inputs=['input', 'img'],
+                                    types=['int', 'image_array'],
+                                    max_catalog_len=7, max_batch=5)
+        img = np.zeros((12, 16, 3), dtype=np.uint8)
+        write_count = 23
+        for i in range(write_count):
+            _, queue_depth, dropped = tub_writer.run(i, img)
+            self.assertEqual(dropped, 0)
+        tub_writer.close()
+
+        tub = Tub(self._path, read_only=True)
+        records = list(tub)
+        self.assertEqual(len(records), write_count)
+        for i, record in enumerate(records):
+            self.assertEqual(record['_index'], i)
+            self.assertEqual(record['input'], i)
+            image_path = os.path.join(tub.images_base_path, record['img'])
+            self.assertTrue(os.path.exists(image_path))
+
+    def test_async_tubwriter_overflow(self):
+        for overflow, first in (('drop_newest', 0), ('drop_oldest', 7)):
+            path = os.path.join(self._path, overflow)
+            tub_writer = AsyncTubWriter(path, inputs=['input'],
+                                        types=['int'], queue_size=3,
+                                        overflow=overflow)
+            # Hold the queue lock, so the writer thread can't drain the queue
+            with tub_writer.condition:
+                for i in range(10):
+                    _, queue_depth, dropped = tub_writer.run(i)
+                self.assertEqual(queue_depth, 3)
+                self.assertEqual(dropped, 7)
+            tub_writer.close()
+            inputs = [record['input'] for record in tub_writer.tub]
+            self.assertEqual(inputs, list(range(first, first + 3)))
+
+    def test_async_tubwriter_delete_last_n_records(self):
+        tub_writer = AsyncTubWriter(self._path, inputs=['input'],
+                                    types=['int'])
+        for i in range(5):
+            tub_writer.run(i)
+        # wait until the records are committed
+        with tub_writer.condition:
+            while tub_writer.queue or tub_writer.writing:
+                tub_writer.condition.wait()
+            # the next records stay queued
+            for i in range(5, 8):
+                tub_writer.run(i)
+            self.assertEqual(len(tub_writer.queue), 3)
+            tub_writer.delete_last_n_records(4)
+        tub_writer.close()
+        inputs = [record['input'] for record in tub_writer.tub]
+        self.assertEqual(inputs, [0, 1, 2, 3])
+
     def tearDown(self):
         shutil.rmtree(self._path)
 
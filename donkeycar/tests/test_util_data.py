@@ -158,3 +158,32 @@ def test_train_test_split():
     print(val_set)
     assert(len(train_set)==8)
     assert(len(val_set)==2)
+    assert(data_set == [1, 2, 3, 4, 5, 6, 7, 8, 9, 0])
+
+
+def test_train_test_split_indices_seed():
+    train_1, val_1 = train_test_split_indices(1000, seed=42)
+    train_2, val_2 = train_test_split_indices(1000, seed=42)
+    assert (train_1 == train_2).all() and (val_1 == val_2).all()
+    assert len(train_1) == 800 and len(val_1) == 200
+    assert sorted(np.concatenate([train_1, val_1])) == list(range(1000))
+
+
+def test_train_test_split_indices_groups():
+    # 20 sessions of 50 records each
+    groups = [i // 50 for i in range(1000)]
+    train_idx, val_idx = train_test_split_indices(1000, groups=groups, seed=1)
+    train_groups = {groups[i] for i in train_idx}
+    val_groups = {groups[i] for i in val_idx}
+    assert not train_groups & val_groups
+    assert len(val_idx) == 200
+    # without shuffle the last groups are used for validation
+    train_idx, val_idx = train_test_split_indices(
+        1000, shuffle=False, groups=groups)
+    assert list(val_idx) == list(range(800, 1000))
+
+
+def test_train_test_split_indices_single_group():
+    # e.g. a split by tub with a single tub
+    with pytest.raises(ValueError, match='TRAIN_SPLIT_BY'):
+        train_test_split_indices(100, groups=['tub'] * 100)
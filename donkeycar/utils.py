@@ -17,7 +17,7 @@ import random
 import time
 import signal
 import logging
-from typing import List, Any, Tuple
+from typing import List, Any, Tuple, Optional, Sequence, Hashable
 
 from PIL import Image
 import numpy as np
@@ -142,13 +142,20 @@ def img_crop(img_arr, top, bottom):
     return img_arr[top:end, ...]
 
 
-def normalize_image(img_arr_uint):
+def normalize_image(img_arr_uint, dtype=np.float32):
     """
     Convert uint8 numpy image array into [0,1] float image array
     :param img_arr_uint:    [0,255]uint8 numpy image array
+    :param dtype:           type of the returned array, for uint8 the image
+                            is returned unchanged to feed models which
+                            normalize internally
     :return:                [0,1] float32 numpy image array
     """
-    return img_arr_uint.astype(np.float64) * ONE_BYTE_SCALE
+    if np.dtype(dtype) == np.uint8:
+        return img_arr_uint
+    norm_arr = img_arr_uint.astype(dtype)
+    norm_arr *= ONE_BYTE_SCALE
+    return norm_arr
 
 
 def denormalize_image(img_arr_float):
@@ -163,7 +170,7 @@ def load_pil_image(filename, cfg):
     """Loads an image from a file path as a PIL image. Also handles resizing.
 
     Args:
-        filename (string): path to the image file
+        filename (string): path to the image file or a file object
         cfg (object): donkey configuration file
 
     Returns: a PIL image.
@@ -186,7 +193,7 @@ def load_pil_image(filename, cfg):
 
 def load_image(filename, cfg):
     """
-    :param string filename:     path to image file
+    :param string filename:     path to image file or a file object
     :param cfg:                 donkey config
     :return np.ndarray:         numpy uint8 image array
     """
@@ -274,9 +281,10 @@ def linear_unbin(arr, N=15, offset=-1, R=2.0):
     '''
     preform inverse linear_bin, taking
     one hot encoded arr, and get max value
-    rescale given R range and offset
+    rescale given R range and offset. A batch
+    of encodings is unbinned along the last axis
     '''
-    b = np.argmax(arr)
+    b = np.argmax(arr, axis=-1)
     a = b * (R / (N + offset)) + offset
     return a
 
@@ -436,20 +444,34 @@ def get_model_by_type(model_type: str, cfg: 'Config') -> 'KerasPilot':
     from donkeycar.parts.keras import KerasCategorical, KerasLinear, \
         KerasInferred, KerasIMU, KerasMemory, KerasBehavioral, KerasLocalizer, \
         KerasLSTM, Keras3D_CNN
-    from donkeycar.parts.interpreter import KerasInterpreter, TfLite, TensorRT
+    from donkeycar.parts.interpreter import KerasInterpreter, TfLite, \
+        TensorRT, OnnxInterpreter
 
     if model_type is None:
         model_type = cfg.DEFAULT_MODEL_TYPE
     logger.info(f'get_model_by_type: model type is: {model_type}')
     input_shape = (cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH)
     if 'tflite_' in model_type:
-        interpreter = TfLite()
+        interpreter = TfLite(
+            num_threads=getattr(cfg, 'TFLITE_NUM_THREADS', None),
+            xnnpack=getattr(cfg, 'TFLITE_XNNPACK', True),
+            delegate=getattr(cfg, 'TFLITE_DELEGATE', None),
+            delegate_options=getattr(cfg, 'TFLITE_DELEGATE_OPTIONS', None))
         used_model_type = model_type.replace('tflite_', '')
+    elif 'onnx_' in model_type:
+        interpreter = OnnxInterpreter(
+            graph_optimization=getattr(cfg, 'ONNX_GRAPH_OPTIMIZATION', 'all'),
+            intra_op_threads=getattr(cfg, 'ONNX_INTRA_OP_THREADS', None),
+            inter_op_threads=getattr(cfg, 'ONNX_INTER_OP_THREADS', None),
+            providers=getattr(cfg, 'ONNX_PROVIDERS', None))
+        used_model_type = model_type.replace('onnx_', '')
     elif 'tensorrt_' in model_type:
         interpreter = TensorRT()
         used_model_type = model_type.replace('tensorrt_', '')
     else:
-        interpreter = KerasInterpreter()
+        interpreter = KerasInterpreter(
+            compiled=getattr(cfg, 'KERAS_COMPILED_INFERENCE', True),
+            xla=getattr(cfg, 'KERAS_XLA_INFERENCE', False))
         used_model_type = model_type
     used_model_type = EqMemorizedString(used_model_type)
     if used_model_type == "linear":
@@ -484,10 +506,12 @@ def get_model_by_type(model_type: str, cfg: 'Config') -> 'KerasPilot':
         kl = Keras3D_CNN(interpreter=interpreter, input_shape=input_shape,
                          seq_length=cfg.SEQUENCE_LENGTH)
     else:
-        known = [k + u for k in ('', 'tflite_', 'tensorrt_')
+        known = [k + u for k in ('', 'tflite_', 'tensorrt_', 'onnx_')
                  for u in used_model_type.mem]
         raise ValueError(f"Unknown model type {model_type}, supported types are"
                          f" { ', '.join(known)}")
+    kl.set_dtype_policy(getattr(cfg, 'MODEL_DTYPE', 'float32'),
+                        getattr(cfg, 'MODEL_IMAGE_DTYPE', None))
     return kl
 
 
@@ -511,31 +535,79 @@ def get_test_img(keras_pilot):
 
 def train_test_split(data_list: List[Any],
                      shuffle: bool = True,
-                     test_size: float = 0.2) -> Tuple[List[Any], List[Any]]:
+                     test_size: float = 0.2,
+                     seed: Optional[int] = None,
+                     groups: Optional[Sequence[Hashable]] = None) \
+        -> Tuple[List[Any], List[Any]]:
     '''
     take a list, split it into two sets while selecting a
     random element in order to shuffle the results.
     use the test_size to choose the split percent.
-    shuffle is always True, left there to be backwards compatible
+    The input list is not modified, see train_test_split_indices() for the
+    seed and groups arguments. Record tables are split into sub tables.
     '''
-    target_train_size = int(len(data_list) * (1. - test_size))
-
-    if shuffle:
-        train_data = []
-        i_sample = 0
-        while i_sample < target_train_size and len(data_list) > 1:
-            i_choice = random.randint(0, len(data_list) - 1)
-            train_data.append(data_list.pop(i_choice))
-            i_sample += 1
-
-        # remainder of the original list is the validation set
-        val_data = data_list
+    train_idx, val_idx = train_test_split_indices(
+        len(data_list), shuffle=shuffle, test_size=test_size, seed=seed,
+        groups=groups)
+    if hasattr(data_list, 'take'):
+        return data_list.take(train_idx), data_list.take(val_idx)
+    train_data = [data_list[i] for i in train_idx]
+    val_data = [data_list[i] for i in val_idx]
+    return train_data, val_data
 
-    else:
-        train_data = data_list[:target_train_size]
-        val_data = data_list[target_train_size:]
 
-    return train_data, val_data
+def train_test_split_indices(size: int,
+                             shuffle: bool = True,
+                             test_size: float = 0.2,
+                             seed: Optional[int] = None,
+                             groups: Optional[Sequence[Hashable]] = None) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits the indices of a list into training and validation indices with a
+    single permutation. With groups all entries of a group end up in the same
+    set, so that near identical neighbouring frames of e.g. a session do not
+    leak from training into validation. Then the validation size is the one
+    closest to test_size which whole groups allow.
+
+    :param size:        length of the list
+    :param shuffle:     shuffle the entries or groups, otherwise the last
+                        ones are used for validation
+    :param test_size:   fraction of the validation entries
+    :param seed:        seed of the permutation, None for a random one
+    :param groups:      optional group key of each entry
+    :return:            training indices, shuffled if requested, and sorted
+                        validation indices
+    :raises ValueError: if there are entries but fewer than two groups
+    """
+    rng = np.random.default_rng(seed)
+    target_train_size = int(size * (1. - test_size))
+    if groups is None or size == 0:
+        order = rng.permutation(size) if shuffle else np.arange(size)
+        return order[:target_train_size], np.sort(order[target_train_size:])
+
+    assert len(groups) == size, 'Need one group key per entry'
+    codes_of = dict()
+    codes = np.fromiter((codes_of.setdefault(g, len(codes_of))
+                         for g in groups), dtype=np.int64, count=size)
+    num_groups = len(codes_of)
+    if num_groups < 2:
+        raise ValueError(f'Splitting by group needs at least two groups but '
+                         f'all {size} records are in one, e.g. one tub or '
+                         f'session. Set TRAIN_SPLIT_BY to block or record.')
+    counts = np.bincount(codes, minlength=num_groups)
+    order = rng.permutation(num_groups) if shuffle else np.arange(num_groups)
+    # number of leading groups whose size is closest to the training size,
+    # keeping at least one group on either side
+    cum_counts = np.cumsum(counts[order])
+    num_train = int(np.argmin(np.abs(cum_counts - target_train_size))) + 1
+    num_train = max(1, min(num_train, num_groups - 1))
+    is_train_group = np.zeros(num_groups, dtype=bool)
+    is_train_group[order[:num_train]] = True
+    is_train = is_train_group[codes]
+    train_idx = np.flatnonzero(is_train)
+    if shuffle:
+        train_idx = rng.permutation(train_idx)
+    return train_idx, np.flatnonzero(~is_train)
 
 
 """
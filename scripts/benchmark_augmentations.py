@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    benchmark_augmentations.py [--config=<path>] [--augs=<list>] [--batch=<n>] [--batches=<n>]
+
+Options:
+    --config=<path>     car config file [default: config.py]
+    --augs=<list>       comma separated augmentations and transformations
+                        [default: CROP,TRAPEZE,MULTIPLY,BLUR]
+    --batch=<n>         images per batch [default: 128]
+    --batches=<n>       number of batches [default: 20]
+
+Note:
+    This script compares the speed of the imgaug and the cv2 augmentation
+    backends on random images of the configured size.
+"""
+
+import time
+
+import numpy as np
+from docopt import docopt
+
+import donkeycar as dk
+from donkeycar.pipeline.augmentations import ImageAugmentation
+
+
+def benchmark(cfg, augs, batch_size, num_batches):
+    cfg.BENCHMARK_AUGMENTATIONS = augs
+    shape = (batch_size, cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH)
+    images = np.random.randint(0, 256, size=shape, dtype=np.uint8)
+    for backend in ('imgaug', 'cv2'):
+        augmentation = ImageAugmentation(cfg, 'BENCHMARK_AUGMENTATIONS',
+                                         backend=backend, seed=0)
+        for run in ('image', 'batch'):
+            start = time.time()
+            for _ in range(num_batches):
+                if run == 'batch':
+                    augmentation.run_batch(images)
+                else:
+                    for image in images:
+                        augmentation.run(image)
+            duration = time.time() - start
+            print(f'{backend:>6} {run:>5}: '
+                  f'{num_batches * batch_size / duration:8.0f} images/s')
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    cfg = dk.load_config(args['--config'])
+    benchmark(cfg, args['--augs'].split(','), int(args['--batch']),
+              int(args['--batches']))
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+'''
+Usage:
+    convert_tub_images.py --tub=<path> [--unpack]
+
+Options:
+    --unpack    convert packed images back into one file per image
+
+Note:
+    This script converts the images of tubs in place between one jpg file per
+    record and one packed image store per catalog.
+'''
+
+from docopt import docopt
+
+from donkeycar.parts.tub_v2 import convert_tub_images
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    packed = not args['--unpack']
+    for path in args['--tub'].split(','):
+        converted = convert_tub_images(path, packed=packed)
+        print(f'Converted {converted} images of {path}')
@@ -85,6 +85,11 @@ setup(name='donkeycar',
               'torchvision',
               'torchaudio'
           ],
+          'onnx': [
+              'onnxruntime',
+              'onnx',
+              'tf2onnx'
+          ],
           'mm1': ['pyserial']
       },
       package_data={